@@ -1,28 +1,59 @@
 import os
 import time
 import streamlit as st
-from typing import List, Set
-from raw_clips_generator import load_config, split_video
-import sys
-from io import StringIO
-from streamlit_output_capturer import StreamlitOutputCapturer
+from typing import Dict, List, Set
+from clip_suggester import suggest_clips, write_suggestions
+from draft_render import clip_drafts
+from job_manager import JobManager
+from preview_proxies import make_poster, make_proxy
+from progress_events import ProgressReader
+from video_config import ConfigError, load_config, validate_config
 
 # Constants
 VIDEO_ROOT = "videos"
 FINAL_DIR = "final"
 CONFIG_FILE = "config.json"
+JOBS_DIR = os.path.join(VIDEO_ROOT, ".jobs")
+# Jobs render on render_worker.py machines sharing VIDEO_ROOT; above 0 the
+# app server renders this many itself as well
+LOCAL_WORKER_SLOTS = 0
+JOB_POLL_SECONDS = 2
+GALLERY_PAGE_SIZE = 6
+JOB_STAGES = {"split": ("split",), "pipeline": ("split", "compose"), "upload": ("upload",)}
+
+@st.cache_resource
+def get_job_manager() -> JobManager:
+    """One job manager per server process, shared by every session"""
+    return JobManager(JOBS_DIR, max_concurrent=LOCAL_WORKER_SLOTS).start()
 
 def initialize_session() -> None:
     """Initialize session state variables"""
-    if "processing" not in st.session_state:
-        st.session_state.processing = False
+    if "job_id" not in st.session_state:
+        st.session_state.job_id = None
+    if "finished_job_id" not in st.session_state:
+        st.session_state.finished_job_id = None
     if "videos_available" not in st.session_state:
         st.session_state.videos_available = False
+    if "progress_readers" not in st.session_state:
+        st.session_state.progress_readers = {}
+    if "gallery_page" not in st.session_state:
+        st.session_state.gallery_page = 1
+    if "playing" not in st.session_state:
+        st.session_state.playing = {}
+    if "suggestions" not in st.session_state:
+        st.session_state.suggestions = {}
+    if "drafts_folder" not in st.session_state:
+        st.session_state.drafts_folder = None
+    if "draft_page" not in st.session_state:
+        st.session_state.draft_page = 1
 
 def get_video_directories() -> Set[str]:
     """Get available video directories with validation"""
     try:
-        return {d for d in os.listdir(VIDEO_ROOT) if os.path.isdir(os.path.join(VIDEO_ROOT, d))}
+        return {
+            d for d in os.listdir(VIDEO_ROOT)
+            if os.path.isdir(os.path.join(VIDEO_ROOT, d)) and not d.startswith(".")
+        }
     except FileNotFoundError:
         st.error(f"Video directory not found: {VIDEO_ROOT}")
         return set()
@@ -46,22 +77,30 @@ def render_sidebar() -> str:
 
         st.divider()
         if st.button("🎬 Generate Raw Clips"):
-            st.session_state.processing = True
-            st.session_state.selected_folder = selected_folder
+            start_job("split", selected_folder)
         
         if st.button("🎬 Show Raw Clips"):
-            st.session_state.processing = False
             st.session_state.videos_available = True
+            st.session_state.drafts_folder = None
             st.session_state.selected_folder = selected_folder
+
+        if st.button("📝 Draft Titles & Layout"):
+            st.session_state.drafts_folder = selected_folder
+            st.session_state.videos_available = False
                
 
-        if st.button("🔄 Resize & Mix Videos", on_click=process_start):
-            pass
-        if st.button("📤 Upload to YouTube", on_click=process_start):
-            pass
+        if st.button("🔄 Resize & Mix Videos"):
+            start_job("pipeline", selected_folder)
+        if st.button("📤 Upload to YouTube"):
+            start_job("upload", selected_folder)
         if st.button("📱 Upload to Facebook", on_click=process_start):
             pass
 
+        st.divider()
+        if st.button("✂️ Suggest Clips") and selected_folder:
+            suggest_clip_boundaries(selected_folder)
+        show_suggestions(selected_folder)
+
         st.divider()
         st.markdown('<div style="text-align: center">Project By Nepali Roots</div>', 
                    unsafe_allow_html=True)
@@ -70,11 +109,58 @@ def render_sidebar() -> str:
 
 def process_start() -> None:
     """Handle processing initialization"""
-    st.session_state.processing = True
+    st.session_state.videos_available = False
+
+def config_problems(selected_folder: str, stages=JOB_STAGES["pipeline"]) -> List[str]:
+    """Problems of the folder's config that would make a job of these stages fail"""
+    try:
+        config = load_config(os.path.join(VIDEO_ROOT, selected_folder, CONFIG_FILE))
+    except ConfigError as e:
+        return e.problems
+    return validate_config(config, stages)
+
+def show_config_check(selected_folder: str) -> None:
+    """Warn about config problems before any job is started"""
+    problems = config_problems(selected_folder)
+    if problems:
+        st.warning(f"**{CONFIG_FILE} needs fixing:**\n" + "\n".join(f"- {problem}" for problem in problems))
+
+def suggest_clip_boundaries(selected_folder: str) -> None:
+    """Analyse the folder's source for clip boundaries at pauses and scene changes"""
+    try:
+        with st.spinner("Analysing source video..."):
+            clips = suggest_clips(os.path.join(VIDEO_ROOT, selected_folder, CONFIG_FILE))
+    except ConfigError as e:
+        st.error("Can't suggest clips: " + "; ".join(e.problems))
+        return
+    st.session_state.suggestions[selected_folder] = clips
+
+def show_suggestions(selected_folder: str) -> None:
+    """List suggested clips with a button to add them to the folder's config"""
+    clips = st.session_state.suggestions.get(selected_folder)
+    if clips is None:
+        return
+    if not clips:
+        st.caption("No new clips found outside the configured ones.")
+        return
+    st.caption("\n".join(f"- **{clip['name']}**: {clip['start_time']} - {clip['end_time']}" for clip in clips))
+    if st.button(f"➕ Add {len(clips)} clip(s) to {CONFIG_FILE}"):
+        write_suggestions(os.path.join(VIDEO_ROOT, selected_folder, CONFIG_FILE), clips)
+        del st.session_state.suggestions[selected_folder]
+        st.success(f"Added to {CONFIG_FILE}, give them titles before composing.")
+
+def start_job(kind: str, selected_folder: str) -> None:
+    """Queue a background job, or reattach to the one already running for the folder"""
+    if config_problems(selected_folder, JOB_STAGES[kind]):
+        st.error(f"Fix {CONFIG_FILE} before starting this job.")
+        return
+    st.session_state.selected_folder = selected_folder
+    st.session_state.job_id = get_job_manager().submit(kind, os.path.join(VIDEO_ROOT, selected_folder))
+    st.session_state.finished_job_id = None
     st.session_state.videos_available = False
 
 def display_videos(videos_dir) -> None:
-    """Display processed videos in main content area"""
+    """Display processed videos as a paginated poster gallery"""
     st.header("🎥 Processed Videos")
     final_path = os.path.join(videos_dir)
     
@@ -82,39 +168,224 @@ def display_videos(videos_dir) -> None:
         st.warning("No processed videos found")
         return
 
-    video_files = [f for f in os.listdir(final_path) if f.endswith((".mp4", ".mov"))]
+    video_files = sorted(f for f in os.listdir(final_path) if f.endswith((".mp4", ".mov")))
     if not video_files:
         st.info("No videos available in final directory")
         return
 
+    # Only the current page is rendered, so only its posters are generated and sent
+    pages = (len(video_files) + GALLERY_PAGE_SIZE - 1) // GALLERY_PAGE_SIZE
+    page = min(st.session_state.gallery_page, pages)
+    if pages > 1:
+        page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=page)
+        st.session_state.gallery_page = page
+    page_files = video_files[(page - 1) * GALLERY_PAGE_SIZE:page * GALLERY_PAGE_SIZE]
+
     cols = st.columns(2)
-    for idx, video_file in enumerate(video_files):
+    for idx, video_file in enumerate(page_files):
         with cols[idx % 2]:
-            st.video(os.path.join(final_path, video_file))
-            st.caption(video_file)
+            show_gallery_item(os.path.join(final_path, video_file))
 
-def generate_raw_clips(selected_folder, log_placeholder, spinner_placeholder):
-    """Process videos with real-time logging"""
-    config = load_config(f"./{VIDEO_ROOT}/{selected_folder}/config.json")
-    output_folder = config.get('output_folder')
-    
-    output_capturer = StreamlitOutputCapturer(log_placeholder)
-    
+def show_gallery_item(video_path: str) -> None:
+    """Poster first; the low-bitrate proxy or the full file only when asked for"""
+    video_file = os.path.basename(video_path)
+    playing = st.session_state.playing.get(video_path)
     try:
-        sys.stdout = output_capturer
-        with st.spinner("Processing videos...", show_time=True):
-            split_video(
-                config.get("main_video_path"),
-                config.get("clips_config"),
-                output_folder
-            )
-        st.success("✅ Clip generation completed!")
-        st.session_state.videos_available = True
+        if playing == "full":
+            st.video(video_path)
+        elif playing == "proxy":
+            with st.spinner("Preparing preview..."):
+                st.video(make_proxy(video_path))
+        else:
+            st.image(make_poster(video_path), use_container_width=True)
     except Exception as e:
-        st.error(f"❌ Error: {str(e)}")
-    finally:
-        sys.stdout = sys.__stdout__  # Reset stdout
-        st.session_state.processing = False
+        st.error(f"❌ Could not preview {video_file}: {type(e).__name__}")
+
+    st.caption(f"{video_file} ({os.path.getsize(video_path) / 1e6:.1f} MB)")
+    play_col, full_col = st.columns(2)
+    if play_col.button("▶️ Preview", key=f"preview-{video_path}", disabled=playing == "proxy"):
+        st.session_state.playing[video_path] = "proxy"
+        st.rerun()
+    if full_col.button("🖥️ Full resolution", key=f"full-{video_path}", disabled=playing == "full"):
+        st.session_state.playing[video_path] = "full"
+        st.rerun()
+
+def show_drafts(selected_folder: str) -> None:
+    """Low-resolution stills of every clip's final layout, to check titles before the full render is queued"""
+    st.header("📝 Title & Layout Drafts")
+    folder_path = os.path.join(VIDEO_ROOT, selected_folder)
+    try:
+        config = load_config(os.path.join(folder_path, CONFIG_FILE))
+    except ConfigError as e:
+        st.error("Can't draft: " + "; ".join(e.problems))
+        return
+    clips = config.get("clips_config") or []
+    if not clips:
+        st.info(f"No clips in {CONFIG_FILE} yet")
+        return
+    st.caption("Same layout as the final render at a quarter of its size. Queue the full render with "
+               "🔄 Resize & Mix Videos once the titles look right.")
+
+    pages = (len(clips) + GALLERY_PAGE_SIZE - 1) // GALLERY_PAGE_SIZE
+    page = min(st.session_state.draft_page, pages)
+    if pages > 1:
+        page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=page, key="draft-page")
+        st.session_state.draft_page = page
+    for clip in clips[(page - 1) * GALLERY_PAGE_SIZE:page * GALLERY_PAGE_SIZE]:
+        show_clip_draft(folder_path, config, clip)
+
+def show_clip_draft(folder_path: str, config: Dict, clip: Dict) -> None:
+    """Contact sheet of each output format of a clip; the draft video only when asked for"""
+    st.subheader(f"{clip.get('name', '?')}: {clip.get('title', '')}")
+    draft_key = f"draft-{folder_path}-{clip.get('name')}"
+    try:
+        with st.spinner("Drafting..."):
+            for name, sheet_path in clip_drafts(folder_path, config, clip).items():
+                st.image(sheet_path, caption=name)
+            if st.session_state.playing.get(draft_key):
+                for name, video_path in clip_drafts(folder_path, config, clip, kind="video").items():
+                    st.caption(name)
+                    st.video(video_path)
+    except Exception as e:
+        st.error(f"❌ Could not draft {clip.get('name', '?')}: {type(e).__name__}: {e}")
+        return
+    if st.button("▶️ Draft video", key=draft_key, disabled=bool(st.session_state.playing.get(draft_key))):
+        st.session_state.playing[draft_key] = True
+        st.rerun()
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_job_progress(job_id: str) -> None:
+    """Poll a background job without blocking the page"""
+    manager = get_job_manager()
+    job = manager.get(job_id)
+    if job is None:
+        st.session_state.job_id = None
+        st.rerun()
+
+    if job["status"] in ("done", "failed"):
+        # Hand over to a full rerun that shows the results
+        st.session_state.job_id = None
+        st.session_state.finished_job_id = job_id
+        st.session_state.videos_available = True
+        st.session_state.progress_readers.pop(job_id, None)
+        st.rerun()
+
+    label = "⏳ Waiting for a free worker..." if job["status"] == "queued" else "⚙️ Processing videos..."
+    st.subheader(f"{label} ({job['kind']}, {os.path.basename(job['folder_path'])})")
+    if job["status"] == "queued":
+        show_workers(manager)
+    if job.get("started"):
+        node = f" on {job['node']}" if job.get("node") else ""
+        attempt = f", attempt {job['attempts']}" if job.get("attempts", 1) > 1 else ""
+        st.caption(f"Running for {int(time.time() - job['started'])}s{node}{attempt}")
+    show_clip_progress(job)
+
+def show_workers(manager: JobManager) -> None:
+    """Say which render workers are online, or how to start one"""
+    workers = manager.workers()
+    if not workers:
+        st.info("No render worker is online. Start one with `python render_worker.py` on a machine sharing "
+                f"the {VIDEO_ROOT} folder.")
+        return
+    busy = sum(len(worker["running"]) for worker in workers)
+    slots = sum(worker["slots"] for worker in workers)
+    st.caption(f"{len(workers)} worker(s) online, {busy} of {slots} slots busy")
+
+def show_clip_progress(job: Dict) -> None:
+    """Render the latest stage, frames, fps and ETA of every clip of a job"""
+    if not job.get("events_path"):
+        # Jobs queued before progress events existed only have a log
+        st.code(get_job_manager().read_log(job["id"]) or "Starting...")
+        return
+    readers = st.session_state.progress_readers
+    if job["id"] not in readers:
+        readers[job["id"]] = ProgressReader(job["events_path"])
+    # Everything emitted since the last refresh is folded into a single redraw
+    clips = readers[job["id"]].poll()
+    if not clips:
+        st.caption("Starting...")
+        return
+
+    rows = []
+    for clip in clips.values():
+        done, total = clip.get("frames_done"), clip.get("frames_total")
+        if clip["status"] in ("done", "cached"):
+            fraction = 1.0
+        elif done is not None and total:
+            fraction = min(done / total, 1.0)
+        else:
+            fraction = 0.0
+        rows.append({
+            "clip": clip["clip"],
+            "stage": clip["stage"],
+            "status": clip["status"],
+            "progress": fraction,
+            "frames": f"{done}/{total}" if done is not None else "",
+            "fps": round(clip["fps"], 1) if clip.get("fps") else None,
+            "eta (s)": round(clip["eta"]) if clip.get("eta") is not None else None,
+        })
+    st.dataframe(
+        rows,
+        hide_index=True,
+        use_container_width=True,
+        column_config={"progress": st.column_config.ProgressColumn("progress", min_value=0.0, max_value=1.0)}
+    )
+
+    failed = [clip for clip in clips.values() if clip["status"] == "failed"]
+    for clip in failed:
+        st.error(f"❌ {clip['clip']} ({clip['stage']}): {clip.get('error', '')}")
+    if failed:
+        # The log tail holds the traceback
+        with st.expander("Log"):
+            st.code(get_job_manager().read_log(job["id"]))
+
+def show_job_result(job: Dict) -> None:
+    """Summarize a finished job"""
+    if job["status"] == "failed":
+        st.error(f"❌ Error: {job['error']}")
+        with st.expander("Log"):
+            st.code(get_job_manager().read_log(job["id"]))
+        return
+
+    outputs = job.get("outputs") or {}
+    reports = outputs.get("reports") or outputs.get("results") or []
+    failed = [r for r in reports if r["status"] == "failed"]
+    for report in failed:
+        st.error(f"❌ {report['name']}: {report['error']}")
+    if len(failed) < len(reports):
+        st.success("✅ Clip generation completed!")
+    inaccurate = [r["name"] for r in reports if r["status"] == "ok" and r.get("frame_accurate") is False]
+    if inaccurate:
+        st.warning(f"Not frame accurate (cut on nearest keyframe): {', '.join(inaccurate)}")
+    if job.get("profile_summary"):
+        show_profile(job)
+
+def show_profile(job: Dict) -> None:
+    """Where the render time went, per stage, excluding nested stages"""
+    with st.expander("⏱️ Render profile"):
+        st.dataframe(
+            [
+                {
+                    "stage": stage["stage"],
+                    "share": stage["self_share"],
+                    "self (s)": round(stage["self_ms"] / 1000, 2),
+                    "total (s)": round(stage["total_ms"] / 1000, 2),
+                    "calls": stage["calls"],
+                    "mean (ms)": round(stage["mean_ms"], 2),
+                }
+                for stage in job["profile_summary"]
+            ],
+            hide_index=True,
+            use_container_width=True,
+            column_config={"share": st.column_config.ProgressColumn("share", min_value=0.0, max_value=1.0)}
+        )
+        if job.get("trace_path") and os.path.exists(job["trace_path"]):
+            with open(job["trace_path"], "rb") as trace:
+                st.download_button(
+                    "Download Chrome trace", trace, file_name=os.path.basename(job["trace_path"]),
+                    mime="application/json"
+                )
+            st.caption("Open in chrome://tracing or ui.perfetto.dev")
 
 def main() -> None:
     """Main application layout"""
@@ -132,12 +403,27 @@ def main() -> None:
     main_container = st.container()
     
     with main_container:
-        if st.session_state.processing:
-            log_placeholder = st.empty()
-            spinner_placeholder = st.empty()
-            generate_raw_clips(st.session_state.selected_folder, log_placeholder, spinner_placeholder)
+        if selected_folder:
+            show_config_check(selected_folder)
+
+        manager = get_job_manager()
+        if st.session_state.job_id is None and selected_folder:
+            # Reattach to a job started before a rerun or from another tab
+            active = manager.active_job(os.path.join(VIDEO_ROOT, selected_folder))
+            if active is not None:
+                st.session_state.job_id = active["id"]
+
+        if st.session_state.finished_job_id:
+            finished_job = manager.get(st.session_state.finished_job_id)
+            if finished_job is not None:
+                show_job_result(finished_job)
+
+        if st.session_state.job_id is not None:
+            show_job_progress(st.session_state.job_id)
         elif st.session_state.videos_available:
             display_videos(os.path.join(VIDEO_ROOT, selected_folder, "raw_clips"))
+        elif selected_folder and st.session_state.drafts_folder == selected_folder:
+            show_drafts(selected_folder)
         else:
             st.info("👋 Select a folder and start processing to see results")
 
@@ -0,0 +1,283 @@
+import glob
+import math
+import os
+import subprocess
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from moviepy.config import FFMPEG_BINARY
+from moviepy.tools import subprocess_call
+
+from media_probe import index_path_for, media_index
+
+# Audio settings of config.json's "audio" section. Without the section clips
+# keep encoding their audio straight from the source, one decode per clip.
+DEFAULT_AUDIO = {
+    "normalize": False,
+    "target_lufs": -16.0,
+    "max_gain_db": 12.0,
+    "peak_db": -1.0,
+    "passthrough": False,
+}
+
+PCM_CHANNELS = 2
+
+# Gains smaller than this aren't worth an audio re-encode when passthrough is allowed
+PASSTHROUGH_TOLERANCE_DB = 0.1
+
+# BS.1770 gating: 400 ms blocks every 100 ms, -70 LUFS absolute and -10 LU relative gates
+SUB_BLOCK_SECONDS = 0.1
+SUB_BLOCKS_PER_BLOCK = 4
+ABSOLUTE_GATE_LUFS = -70.0
+RELATIVE_GATE_LU = -10.0
+
+# Sub-blocks transformed at once, bounds the FFT's working memory
+FFT_BATCH = 600
+
+# Samples per write to the encoder
+ENCODE_CHUNK = 1 << 16
+
+_extract_lock = threading.Lock()
+
+
+class AudioTrack:
+    """
+    A source's audio decoded once to 16-bit PCM on disk and memory-mapped.
+
+    ``samples`` is a read-only ``(frames, channels)`` int16 array backed by
+    the file, so slicing a clip out of it is a view and reads only the pages
+    that are touched.
+    """
+
+    def __init__(self, path: str, sample_rate: int, channels: int = PCM_CHANNELS):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.channels = channels
+        size = os.path.getsize(path)
+        frames = size // (2 * channels)
+        self.samples = np.memmap(path, dtype=np.int16, mode="r", shape=(frames, channels)) if frames else \
+            np.zeros((0, channels), dtype=np.int16)
+
+    @property
+    def duration(self) -> float:
+        return len(self.samples) / self.sample_rate
+
+    def slice(self, start_time: float, end_time: float) -> np.ndarray:
+        """Zero-copy view of ``[start_time, end_time)``."""
+        return self.samples[round(start_time * self.sample_rate):round(end_time * self.sample_rate)]
+
+
+def _pcm_path(video_path: str, fingerprint: str) -> str:
+    index_path = index_path_for(video_path)
+    return os.path.join(os.path.dirname(index_path), f"{os.path.basename(video_path)}.{fingerprint[:16]}.pcm")
+
+
+def _remove_stale(pcm_path: str, video_path: str) -> None:
+    """Drop PCM of older versions of the same source."""
+    pattern = os.path.join(
+        glob.escape(os.path.dirname(pcm_path)), f"{glob.escape(os.path.basename(video_path))}.{'[0-9a-f]' * 16}.pcm"
+    )
+    for old_path in glob.glob(pattern):
+        if old_path != pcm_path:
+            os.remove(old_path)
+
+
+def source_track(video_path: str) -> Optional[AudioTrack]:
+    """
+    The audio track of a source, extracted on first use and kept next to its
+    media index until the source changes. None when the source has no audio.
+    """
+    index = media_index(video_path)
+    infos = index["infos"]
+    if not infos.get("audio_found"):
+        return None
+
+    sample_rate = int(infos.get("audio_fps") or 44100)
+    pcm_path = _pcm_path(video_path, index["fingerprint"])
+    with _extract_lock:
+        if not os.path.exists(pcm_path):
+            os.makedirs(os.path.dirname(pcm_path), exist_ok=True)
+            tmp_path = f"{pcm_path}.{os.getpid()}.tmp"
+            subprocess_call([
+                FFMPEG_BINARY, "-y", "-hide_banner", "-i", video_path,
+                "-map", "0:a:0", "-vn",
+                # Pad a late first sample with silence so sample 0 is at t=0 like the video
+                "-af", "aresample=async=1:first_pts=0",
+                "-f", "s16le", "-acodec", "pcm_s16le", "-ar", str(sample_rate), "-ac", str(PCM_CHANNELS),
+                tmp_path,
+            ], logger=None)
+            os.replace(tmp_path, pcm_path)
+            _remove_stale(pcm_path, video_path)
+    return AudioTrack(pcm_path, sample_rate)
+
+
+def _k_weighting_power(frequencies: np.ndarray, sample_rate: int) -> np.ndarray:
+    """Squared magnitude response of the BS.1770 K-weighting filter (shelf, then high-pass)."""
+    z = np.exp(-2j * np.pi * frequencies / sample_rate)
+
+    # Pre-filter high shelf, with the sample-rate independent coefficients of libebur128
+    gain, q, center = 3.999843853973347, 0.7071752369554196, 1681.974450955533
+    k = math.tan(math.pi * center / sample_rate)
+    vh = 10 ** (gain / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf_b = ((vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0)
+    shelf_a = (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0)
+
+    # RLB high-pass
+    q, center = 0.5003270373238773, 38.13547087602444
+    k = math.tan(math.pi * center / sample_rate)
+    a0 = 1 + k / q + k * k
+    highpass_b = (1.0, -2.0, 1.0)
+    highpass_a = (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0)
+
+    response = np.ones_like(z)
+    for b, a in ((shelf_b, shelf_a), (highpass_b, highpass_a)):
+        response *= (b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z)
+    return np.abs(response) ** 2
+
+
+def clip_loudness(track: AudioTrack, ranges: Sequence[Tuple[float, float]]) -> np.ndarray:
+    """
+    Integrated loudness (LUFS) of every ``(start, end)`` range, -inf for silence.
+
+    Follows BS.1770: K-weighted mean square of 400 ms blocks every 100 ms,
+    gated at -70 LUFS and then 10 LU below the ungated mean. The clips are
+    measured in one pass: each clip's 100 ms sub-blocks are reshaped views
+    of the memory-mapped track, K-weighted in the frequency domain in
+    batches, and the gating of all clips is done with vectorized bincounts.
+    """
+    rate = track.sample_rate
+    sub = int(rate * SUB_BLOCK_SECONDS)
+    spectrum_size = sub // 2 + 1
+    # Parseval weights of a real FFT: interior bins stand for two, K-weighting folded in
+    weights = np.full(spectrum_size, 2.0)
+    weights[0] = 1.0
+    if sub % 2 == 0:
+        weights[-1] = 1.0
+    weights *= _k_weighting_power(np.fft.rfftfreq(sub, 1 / rate), rate) / (sub * sub * 32768.0 ** 2)
+
+    energies, clip_ids = [], []
+    for idx, (start_time, end_time) in enumerate(ranges):
+        samples = track.slice(start_time, end_time)
+        count = len(samples) // sub
+        blocks = samples[:count * sub].reshape(count, sub, track.channels)
+        for offset in range(0, count, FFT_BATCH):
+            spectrum = np.fft.rfft(blocks[offset:offset + FFT_BATCH], axis=1)
+            # Mean square of each channel, summed over channels (all weighted 1.0)
+            energies.append(np.einsum("bfc,f->b", spectrum.real ** 2 + spectrum.imag ** 2, weights))
+        clip_ids.append(np.full(count, idx))
+    energy = np.concatenate(energies) if energies else np.zeros(0)
+    clip_id = np.concatenate(clip_ids) if clip_ids else np.zeros(0, dtype=int)
+
+    # 400 ms blocks: four consecutive sub-blocks of the same clip
+    span = SUB_BLOCKS_PER_BLOCK
+    cumulative = np.concatenate([[0.0], np.cumsum(energy)])
+    block = (cumulative[span:] - cumulative[:-span]) / span
+    same_clip = clip_id[:len(block)] == clip_id[span - 1:]
+    block, block_clip = block[same_clip], clip_id[:len(block)][same_clip]
+
+    def gated_mean(keep: np.ndarray) -> np.ndarray:
+        total = np.bincount(block_clip[keep], block[keep], minlength=len(ranges))
+        count = np.bincount(block_clip[keep], minlength=len(ranges))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(count > 0, total / np.maximum(count, 1), 0.0)
+
+    keep = block > 10 ** ((ABSOLUTE_GATE_LUFS + 0.691) / 10)
+    relative_gate = gated_mean(keep) * 10 ** (RELATIVE_GATE_LU / 10)
+    mean = gated_mean(keep & (block > relative_gate[block_clip]))
+    with np.errstate(divide="ignore"):
+        return np.where(mean > 0, -0.691 + 10 * np.log10(mean), -np.inf)
+
+
+def clip_peaks(track: AudioTrack, ranges: Sequence[Tuple[float, float]]) -> np.ndarray:
+    """Sample peak of every range in dBFS, -inf for silence."""
+    peaks = []
+    for start_time, end_time in ranges:
+        samples = track.slice(start_time, end_time)
+        # max/min rather than abs, abs(-32768) overflows int16
+        peak = max(int(samples.max()), -int(samples.min())) if len(samples) else 0
+        peaks.append(peak / 32768.0)
+    with np.errstate(divide="ignore"):
+        return 20 * np.log10(np.array(peaks, dtype=float))
+
+
+def plan_clip_audio(video_path: str, ranges: Sequence[Tuple[float, float]], settings: Dict) -> List[Optional[Dict]]:
+    """
+    How to make the audio of each ``(start, end)`` clip of a source.
+
+    Loudness and peaks of all clips are measured in one pass over the
+    extracted track. Each plan is None when the source has no audio,
+    otherwise ``{"source", "gain_db", "passthrough"}`` for render_clip_audio.
+    Passthrough copies the AAC packets of the source when no gain is needed.
+    """
+    settings = dict(DEFAULT_AUDIO, **settings)
+    infos = media_index(video_path)["infos"]
+    if not infos.get("audio_found"):
+        return [None] * len(ranges)
+    can_passthrough = settings["passthrough"] and infos.get("audio_codec_name") == "aac"
+
+    gains = np.zeros(len(ranges))
+    if settings["normalize"] and ranges:
+        track = source_track(video_path)
+        gains = settings["target_lufs"] - clip_loudness(track, ranges)
+        headroom = settings["peak_db"] - clip_peaks(track, ranges)
+        gains = np.minimum(np.minimum(gains, settings["max_gain_db"]), headroom)
+        # Silent clips stay as they are
+        gains[~np.isfinite(gains)] = 0.0
+
+    plans = []
+    for gain in gains:
+        passthrough = bool(can_passthrough and abs(gain) < PASSTHROUGH_TOLERANCE_DB)
+        plans.append({"source": video_path, "gain_db": 0.0 if passthrough else float(gain), "passthrough": passthrough})
+    if not all(plan["passthrough"] for plan in plans):
+        # Extract once here, before clips are rendered in parallel
+        source_track(video_path)
+    return plans
+
+
+def copy_audio_range(video_path: str, start_time: float, end_time: float, output_path: str) -> str:
+    """Stream-copy the audio packets of ``[start_time, end_time]``, no decode or encode."""
+    subprocess_call([
+        FFMPEG_BINARY, "-y", "-hide_banner",
+        "-ss", f"{start_time:.6f}", "-i", video_path,
+        "-t", f"{end_time - start_time:.6f}",
+        "-map", "0:a:0", "-vn", "-c:a", "copy",
+        output_path,
+    ], logger=None)
+    return output_path
+
+
+def encode_samples(samples: np.ndarray, sample_rate: int, gain_db: float, output_path: str) -> str:
+    """Encode int16 PCM to AAC, scaled by ``gain_db``; unscaled samples go to the encoder without a copy."""
+    proc = subprocess.Popen(
+        [
+            FFMPEG_BINARY, "-y", "-hide_banner", "-loglevel", "error",
+            "-f", "s16le", "-ar", str(sample_rate), "-ac", str(samples.shape[1]), "-i", "pipe:0",
+            "-c:a", "aac", output_path,
+        ],
+        stdin=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    scale = 10 ** (gain_db / 20)
+    try:
+        for offset in range(0, len(samples), ENCODE_CHUNK):
+            chunk = samples[offset:offset + ENCODE_CHUNK]
+            if gain_db:
+                chunk = np.clip(np.rint(chunk * scale), -32768, 32767).astype(np.int16)
+            proc.stdin.write(np.ascontiguousarray(chunk))
+    finally:
+        proc.stdin.close()
+        stderr = proc.stderr.read()
+        proc.wait()
+    if proc.returncode:
+        raise IOError(stderr.decode("utf8", errors="replace"))
+    return output_path
+
+
+def render_clip_audio(plan: Dict, start_time: float, end_time: float, output_path: str) -> str:
+    """Write the audio of ``[start_time, end_time]`` as planned by plan_clip_audio."""
+    if plan["passthrough"]:
+        return copy_audio_range(plan["source"], start_time, end_time, output_path)
+    track = source_track(plan["source"])
+    return encode_samples(track.slice(start_time, end_time), track.sample_rate, plan["gain_db"], output_path)
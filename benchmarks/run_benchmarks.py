@@ -0,0 +1,293 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import get_context
+from typing import Dict, List, Optional
+
+import moviepy
+from moviepy.config import FFMPEG_BINARY
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+try:
+    import resource
+except ImportError:  # Windows, peak RSS is reported as None
+    resource = None
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+BASELINE_PATH = os.path.join(REPO_ROOT, "benchmarks", "baseline.json")
+
+# Synthetic inputs: a landscape "interview" to split and the 1080x1920 template
+MEDIA = {
+    "source": {"size": (1280, 720), "fps": 30, "tone": 440},
+    "template": {"size": (1080, 1920), "fps": 30, "tone": 220},
+    "raw_clip": {"size": (1280, 720), "fps": 30, "tone": 330},
+}
+DEFAULT_SETTINGS = {
+    "clips": 3,
+    "clip_seconds": 5.0,
+    # Two second GOPs, so smart cuts have partial GOPs to re-encode at both ends
+    "gop": 60,
+}
+
+# Benchmark cases, each run in a fresh process so peak RSS is its own
+CASES = [
+    {"name": "split/reencode", "kind": "split", "cut_mode": "reencode"},
+    {"name": "split/copy", "kind": "split", "cut_mode": "copy"},
+    {"name": "split/smart", "kind": "split", "cut_mode": "smart"},
+    {"name": "compose/moviepy", "kind": "compose", "backend": "moviepy"},
+    {"name": "compose/ffmpeg", "kind": "compose", "backend": "ffmpeg"},
+    {"name": "compose/layers", "kind": "compose", "backend": "layers"},
+    {"name": "compose/stream", "kind": "compose", "backend": "stream"},
+    {"name": "combine_fb_reels", "kind": "combine"},
+]
+
+
+def make_synthetic_video(path: str, size, fps: int, seconds: float, tone: int, gop: int) -> None:
+    """A moving test pattern with a sine tone, encoded like a typical camera file."""
+    width, height = size
+    subprocess.run([
+        FFMPEG_BINARY, "-y", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={fps}:duration={seconds}",
+        "-f", "lavfi", "-i", f"sine=frequency={tone}:sample_rate=44100:duration={seconds}",
+        "-c:v", "libx264", "-preset", "veryfast", "-g", str(gop), "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-shortest", path,
+    ], check=True, stdin=subprocess.DEVNULL)
+
+
+def prepare_media(workdir: str, settings: Dict) -> Dict:
+    """Create the synthetic inputs and the clip configs cut from the source."""
+    clip_seconds = settings["clip_seconds"]
+    # Starts deliberately off the keyframe grid
+    clips_config = [
+        {
+            "name": f"clip{idx + 1}",
+            "start_time": str(round(1.3 + idx * (clip_seconds + 1.7), 3)),
+            "end_time": str(round(1.3 + idx * (clip_seconds + 1.7) + clip_seconds, 3)),
+            "title": f"Benchmark clip number {idx + 1} with a title that wraps",
+        }
+        for idx in range(settings["clips"])
+    ]
+    durations = {
+        "source": float(clips_config[-1]["end_time"]) + 2,
+        "template": clip_seconds + 1,
+        "raw_clip": clip_seconds,
+    }
+    paths = {}
+    for name, media in MEDIA.items():
+        paths[name] = os.path.join(workdir, f"{name}.mp4")
+        make_synthetic_video(paths[name], media["size"], media["fps"], durations[name], media["tone"], settings["gop"])
+    return {"paths": paths, "clips_config": clips_config}
+
+
+def _peak_rss_mb() -> Dict[str, Optional[float]]:
+    if resource is None:
+        return {"peak_rss_mb": None, "peak_child_rss_mb": None}
+    # ru_maxrss is in KiB on Linux, bytes on macOS
+    per_mb = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / per_mb,
+        # The largest ffmpeg process this case spawned
+        "peak_child_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / per_mb,
+    }
+
+
+def _media_stats(paths: List[str]) -> Dict:
+    frames = seconds = 0.0
+    for path in paths:
+        infos = ffmpeg_parse_infos(path)
+        seconds += infos["duration"]
+        frames += infos["duration"] * infos["video_fps"]
+    return {"output_seconds": seconds, "output_frames": round(frames)}
+
+
+def _load_combine_videos():
+    path = os.path.join(REPO_ROOT, "playground", "combined_fb_reels.py")
+    spec = importlib.util.spec_from_file_location("combined_fb_reels", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.combine_videos
+
+
+def _run_case(case: Dict, media: Dict, workdir: str, font: Optional[str], result_queue) -> None:
+    """Worker process entry point: run one case and report its measurements."""
+    import mobile_video_generator
+    from raw_clips_generator import split_video
+
+    mobile_video_generator.TITLE_FONT_PATH = font
+    paths, clips_config = media["paths"], media["clips_config"]
+    out_dir = os.path.join(workdir, case["name"].replace("/", "_"))
+    os.makedirs(out_dir, exist_ok=True)
+
+    per_clip = {}
+    outputs = []
+    started = time.perf_counter()
+    try:
+        if case["kind"] == "split":
+            for clip_config in clips_config:
+                clip_started = time.perf_counter()
+                report = split_video(paths["source"], [clip_config], out_dir, cut_mode=case["cut_mode"])[0]
+                if report["status"] != "ok":
+                    raise RuntimeError(report["error"])
+                per_clip[clip_config["name"]] = time.perf_counter() - clip_started
+                outputs.append(report["output_path"])
+        else:
+            combine_videos = _load_combine_videos() if case["kind"] == "combine" else None
+            for clip_config in clips_config:
+                output_path = os.path.join(out_dir, f"{clip_config['name']}.mp4")
+                clip_started = time.perf_counter()
+                if combine_videos is not None:
+                    combine_videos(paths["template"], paths["raw_clip"], output_path)
+                else:
+                    mobile_video_generator.add_text_overlay(
+                        paths["template"], paths["raw_clip"], output_path, clip_config["title"],
+                        backend=case["backend"]
+                    )
+                per_clip[clip_config["name"]] = time.perf_counter() - clip_started
+                outputs.append(output_path)
+    except Exception as e:
+        result_queue.put({"status": "failed", "error": f"{type(e).__name__}: {e}".splitlines()[-1]})
+        return
+
+    wall = time.perf_counter() - started
+    stats = _media_stats(outputs)
+    result_queue.put({
+        "status": "ok",
+        "wall_seconds": wall,
+        "per_clip_seconds": per_clip,
+        **stats,
+        "output_fps": stats["output_frames"] / wall,
+        "realtime_factor": stats["output_seconds"] / wall,
+        **_peak_rss_mb(),
+    })
+
+
+def run_case(case: Dict, media: Dict, workdir: str, font: Optional[str]) -> Dict:
+    context = get_context("spawn")
+    result_queue = context.Queue()
+    process = context.Process(target=_run_case, args=(case, media, workdir, font, result_queue))
+    process.start()
+    process.join()
+    try:
+        return result_queue.get(timeout=5)
+    except queue.Empty:
+        return {"status": "failed", "error": f"Benchmark process exited with code {process.exitcode}"}
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> Dict:
+    """
+    Wall time ratio of every case against the baseline.
+
+    A case regressed when it got slower by more than ``tolerance`` (0.15 is
+    15%), improved when it got faster by as much.
+    """
+    comparison = {}
+    for name, result in results["cases"].items():
+        base = baseline.get("cases", {}).get(name)
+        if not base or base.get("status") != "ok" or result.get("status") != "ok":
+            continue
+        ratio = result["wall_seconds"] / base["wall_seconds"]
+        verdict = "regressed" if ratio > 1 + tolerance else "improved" if ratio < 1 - tolerance else "unchanged"
+        comparison[name] = {
+            "wall_ratio": ratio,
+            "baseline_wall_seconds": base["wall_seconds"],
+            "realtime_factor_delta": result["realtime_factor"] - base["realtime_factor"],
+            "peak_rss_mb_delta": (
+                result["peak_rss_mb"] - base["peak_rss_mb"]
+                if result.get("peak_rss_mb") is not None and base.get("peak_rss_mb") is not None else None
+            ),
+            "verdict": verdict,
+        }
+    return comparison
+
+
+def _environment() -> Dict:
+    ffmpeg_version = subprocess.run(
+        [FFMPEG_BINARY, "-hide_banner", "-version"], capture_output=True, text=True
+    ).stdout.split("\n")[0]
+    return {
+        "python": platform.python_version(),
+        "moviepy": moviepy.__version__,
+        "ffmpeg": ffmpeg_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the split and compose paths on synthetic media.")
+    parser.add_argument("--cases", nargs="*", help="Case names or prefixes to run, e.g. split compose/ffmpeg")
+    parser.add_argument("--clips", type=int, default=DEFAULT_SETTINGS["clips"])
+    parser.add_argument("--clip-seconds", type=float, default=DEFAULT_SETTINGS["clip_seconds"])
+    parser.add_argument("--font", help="Title font, defaults to the app's font or Pillow's built-in one")
+    parser.add_argument("--output", help="Results file, defaults to benchmarks/results/<timestamp>.json")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed wall time increase before a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 on a regression")
+    args = parser.parse_args()
+
+    settings = dict(DEFAULT_SETTINGS, clips=args.clips, clip_seconds=args.clip_seconds)
+    cases = [
+        case for case in CASES
+        if not args.cases or any(case["name"].startswith(prefix) for prefix in args.cases)
+    ]
+    font = args.font
+    if font is None:
+        from mobile_video_generator import TITLE_FONT_PATH
+
+        font = TITLE_FONT_PATH if os.path.exists(TITLE_FONT_PATH) else None
+
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": _environment(),
+        "settings": dict(settings, font=font),
+        "cases": {},
+    }
+    workdir = tempfile.mkdtemp(prefix="video_automation_bench_")
+    try:
+        media = prepare_media(workdir, settings)
+        for case in cases:
+            print(f"Running {case['name']}...", flush=True)
+            result = run_case(case, media, workdir, font)
+            results["cases"][case["name"]] = result
+            if result["status"] == "ok":
+                print(f"  {result['wall_seconds']:.2f}s, {result['output_fps']:.1f} fps, "
+                      f"{result['realtime_factor']:.2f}x realtime, peak RSS {result['peak_rss_mb'] or 0:.0f} MB")
+            else:
+                print(f"  failed: {result['error']}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as file:
+            results["comparison"] = compare(results, json.load(file), args.tolerance)
+        for name, entry in results["comparison"].items():
+            print(f"{name}: {entry['verdict']} ({entry['wall_ratio']:.2f}x baseline wall time)")
+
+    output_path = args.output or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {output_path}")
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Baseline updated: {args.baseline}")
+
+    regressed = [name for name, entry in results.get("comparison", {}).items() if entry["verdict"] == "regressed"]
+    return 1 if regressed and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,349 @@
+import argparse
+import glob
+import json
+import os
+import subprocess
+import threading
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from moviepy.config import FFMPEG_BINARY
+
+from audio_track import source_track
+from media_probe import index_path_for, keyframe_times, media_index
+from video_config import ClipConfig, ConfigError, format_timestamp, load_config, normalize_clip
+
+# Settings of config.json's "suggest" section
+DEFAULT_SUGGEST = {
+    "min_seconds": 30.0,
+    "max_seconds": 90.0,
+    # A pause is audio this many dB below the speech level for at least min_pause seconds
+    "silence_db": -25.0,
+    "min_pause": 0.4,
+    # Mean absolute luma change (0-1) between analysed frames that counts as a scene cut
+    "scene_threshold": 0.15,
+    # A scene cut ranks like a pause of this many seconds when choosing where to cut
+    "scene_weight": 0.5,
+    # Silence kept around the speech at each end of a clip
+    "padding": 0.15,
+    "name_prefix": "suggested_",
+}
+
+# Frames are compared as gray thumbnails of this size
+ANALYSIS_SIZE = (64, 36)
+
+# GOPs whose keyframes differ by this much (mean absolute luma, 0-1) are
+# decoded in full to find the scene cut in them; lower scene thresholds act as this
+REFINE_FLOOR = 0.05
+
+# Audio level is measured in windows of this length
+RMS_WINDOW_SECONDS = 0.05
+
+# Keyframes are decoded in parallel chunks of at least this many
+MIN_CHUNK_KEYFRAMES = 100
+
+# A scene cut this close to a keyframe is moved onto it
+KEYFRAME_SNAP_SECONDS = 0.02
+
+# Bump when the analysis layout changes, older sidecars are recomputed
+ANALYSIS_VERSION = 1
+
+_analysis_lock = threading.Lock()
+
+
+def _analysis_path(video_path: str, fingerprint: str) -> str:
+    index_path = index_path_for(video_path)
+    return os.path.join(os.path.dirname(index_path), f"{os.path.basename(video_path)}.{fingerprint[:16]}.analysis.npz")
+
+
+def _remove_stale(analysis_path: str, video_path: str) -> None:
+    """Drop analyses of older versions of the same source."""
+    pattern = os.path.join(
+        glob.escape(os.path.dirname(analysis_path)),
+        f"{glob.escape(os.path.basename(video_path))}.{'[0-9a-f]' * 16}.analysis.npz"
+    )
+    for old_path in glob.glob(pattern):
+        if old_path != analysis_path:
+            os.remove(old_path)
+
+
+def _decode_thumbnails(video_path: str, start_time: float, frames: int, keyframes_only: bool,
+                       threads: int = 1) -> np.ndarray:
+    """Gray ``ANALYSIS_SIZE`` thumbnails of up to ``frames`` frames from the keyframe at ``start_time``."""
+    width, height = ANALYSIS_SIZE
+    cmd = [
+        FFMPEG_BINARY, "-hide_banner", "-nostats", "-loglevel", "error",
+        *(["-skip_frame", "nokey"] if keyframes_only else []), "-threads", str(threads),
+        # Start on the keyframe at or before start_time rather than decode
+        # from the one before and drop frames, a hair late so rounding can't miss it
+        "-noaccurate_seek", "-ss", f"{start_time + 0.0005:.6f}", "-i", video_path,
+        "-map", "0:v:0", "-an", "-frames:v", str(frames), "-fps_mode", "passthrough",
+        "-vf", f"scale={width}:{height}:flags=area,format=gray",
+        "-f", "rawvideo", "-",
+    ]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    if proc.returncode:
+        raise IOError(proc.stderr.decode("utf8", errors="replace"))
+    count = len(proc.stdout) // (width * height)
+    return np.frombuffer(proc.stdout, dtype=np.uint8, count=count * width * height).reshape(count, height, width)
+
+
+def _frame_changes(thumbnails: np.ndarray) -> np.ndarray:
+    """Mean absolute luma change (0-1) from each thumbnail to the next."""
+    if len(thumbnails) < 2:
+        return np.zeros(0)
+    return np.abs(np.diff(thumbnails.astype(np.int16), axis=0)).mean(axis=(1, 2)) / 255.0
+
+
+def _refine_cut(video_path: str, start_time: float, end_time: float, fps: float) -> Tuple[float, float]:
+    """Time and change of the largest frame-to-frame change in ``[start_time, end_time]``."""
+    changes = _frame_changes(_decode_thumbnails(video_path, start_time, round((end_time - start_time) * fps) + 1, False))
+    if not len(changes):
+        return end_time, 0.0
+    idx = int(np.argmax(changes))
+    return start_time + (idx + 1) / fps, float(changes[idx])
+
+
+def scene_changes(video_path: str, keyframes: List[float], fps: float) -> np.ndarray:
+    """
+    ``(time, change)`` rows of the strongest frame change in every GOP that
+    may hold a scene cut.
+
+    Only keyframes are decoded at first, in parallel chunks, and their
+    thumbnails compared: within a GOP the picture can't change more than
+    it does from one keyframe to the next, barring a cut and a cut back.
+    The few GOPs whose keyframes differ by ``REFINE_FLOOR`` or more are
+    then decoded frame by frame to place the cut on its exact frame, which
+    tells a cut apart from steady motion over the GOP.
+    """
+    if len(keyframes) < 2:
+        return np.zeros((0, 2))
+    cpus = os.cpu_count() or 1
+    chunks = max(1, min(cpus, len(keyframes) // MIN_CHUNK_KEYFRAMES))
+    bounds = [round(idx * len(keyframes) / chunks) for idx in range(chunks + 1)]
+    with ThreadPoolExecutor(max_workers=cpus) as executor:
+        parts = executor.map(
+            lambda idx: _decode_thumbnails(video_path, keyframes[bounds[idx]], bounds[idx + 1] - bounds[idx], True,
+                                           max(1, cpus // chunks)),
+            range(chunks)
+        )
+        thumbnails = np.concatenate(list(parts))
+        if len(thumbnails) != len(keyframes):
+            raise IOError(f"Decoded {len(thumbnails)} of {len(keyframes)} keyframes of {video_path}")
+
+        suspects = np.flatnonzero(_frame_changes(thumbnails) >= REFINE_FLOOR)
+        cuts = executor.map(lambda idx: _refine_cut(video_path, keyframes[idx], keyframes[idx + 1], fps), suspects)
+        return np.array(list(cuts)).reshape(-1, 2)
+
+
+def rms_levels(video_path: str) -> np.ndarray:
+    """Audio level (dBFS) of every ``RMS_WINDOW_SECONDS`` window, empty without audio."""
+    track = source_track(video_path)
+    if track is None:
+        return np.zeros(0)
+    window = int(track.sample_rate * RMS_WINDOW_SECONDS)
+    count = len(track.samples) // window
+    windows = track.samples[:count * window].reshape(count, window, track.channels)
+    # Batches of a minute bound the float copy of the memory-mapped samples
+    batch = max(1, int(60 / RMS_WINDOW_SECONDS))
+    power = np.concatenate([
+        np.square(windows[offset:offset + batch], dtype=np.float32).mean(axis=(1, 2))
+        for offset in range(0, count, batch)
+    ]) if count else np.zeros(0, np.float32)
+    with np.errstate(divide="ignore"):
+        return 10 * np.log10(power / 32768.0 ** 2)
+
+
+def analyze_source(video_path: str) -> Dict[str, np.ndarray]:
+    """
+    Scene changes and audio levels of a source, see scene_changes and
+    rms_levels, computed once and kept next to its media index until the
+    source changes.
+    """
+    index = media_index(video_path)
+    analysis_path = _analysis_path(video_path, index["fingerprint"])
+    with _analysis_lock:
+        if os.path.exists(analysis_path):
+            with np.load(analysis_path) as saved:
+                if int(saved["version"]) == ANALYSIS_VERSION:
+                    return {"scene": saved["scene"], "rms_db": saved["rms_db"]}
+
+        infos = index["infos"]
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # The audio extract runs while the video decodes
+            levels = executor.submit(rms_levels, video_path)
+            scene = scene_changes(video_path, keyframe_times(video_path), infos["video_fps"]) \
+                if infos.get("video_found") else np.zeros((0, 2))
+            rms_db = levels.result()
+
+        os.makedirs(os.path.dirname(analysis_path), exist_ok=True)
+        tmp_path = f"{analysis_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, version=ANALYSIS_VERSION, scene=scene, rms_db=rms_db)
+        os.replace(tmp_path, analysis_path)
+        _remove_stale(analysis_path, video_path)
+    return {"scene": scene, "rms_db": rms_db}
+
+
+def find_pauses(rms_db: np.ndarray, silence_db: float, min_pause: float) -> List[Tuple[float, float]]:
+    """``(start, end)`` seconds of every run of windows ``silence_db`` below the speech level."""
+    audible = rms_db[np.isfinite(rms_db)]
+    if not len(audible):
+        return []
+    # Speech level: loud enough that pauses and room tone don't pull it down
+    quiet = rms_db < np.percentile(audible, 80) + silence_db
+    edges = np.diff(np.concatenate([[0], quiet.astype(np.int8), [0]]))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    keep = (ends - starts) * RMS_WINDOW_SECONDS >= min_pause
+    return [(start * RMS_WINDOW_SECONDS, end * RMS_WINDOW_SECONDS) for start, end in zip(starts[keep], ends[keep])]
+
+
+def find_scene_cuts(scene: np.ndarray, threshold: float) -> List[float]:
+    """Times of the scene changes of at least ``threshold``, see scene_changes."""
+    return [float(time) for time, change in scene if change >= threshold]
+
+
+def _snap(time: float, low: float, high: float, keyframes: List[float]) -> float:
+    """The keyframe in ``[low, high]`` closest to ``time``, else ``time``."""
+    first, last = bisect_left(keyframes, low), bisect_right(keyframes, high)
+    if first == last:
+        return time
+    return min(keyframes[first:last], key=lambda keyframe: abs(keyframe - time))
+
+
+def _boundaries(pauses: List[Tuple[float, float]], cuts: List[float], settings: Dict,
+                keyframes: List[float]) -> List[Tuple[float, float, float]]:
+    """
+    Places to end one clip and start the next as ``(end, next_start, strength)``.
+
+    A pause ends a clip shortly after the speech stops and starts the next
+    shortly before it resumes, on a keyframe inside the pause when there is
+    one so copy and smart cuts can start without a re-encode. Longer pauses
+    are stronger boundaries.
+    """
+    padding = settings["padding"]
+    boundaries = []
+    for start, end in pauses:
+        middle = (start + end) / 2
+        clip_end = min(start + padding, middle)
+        next_start = _snap(max(end - padding, middle), middle, end, keyframes)
+        boundaries.append((clip_end, next_start, end - start))
+    for cut in cuts:
+        cut = _snap(cut, cut - KEYFRAME_SNAP_SECONDS, cut + KEYFRAME_SNAP_SECONDS, keyframes)
+        boundaries.append((cut, cut, settings["scene_weight"]))
+    return sorted(boundaries)
+
+
+def suggest_ranges(duration: float, pauses: List[Tuple[float, float]], cuts: List[float],
+                   settings: Dict, keyframes: Optional[List[float]] = None) -> List[Tuple[float, float]]:
+    """
+    Cut ``[0, duration]`` into clips of ``min_seconds`` to ``max_seconds``.
+
+    Each clip ends at the strongest boundary inside that window, or at
+    ``max_seconds`` when there is none. Silence at the very start and end
+    of the source is left out, as is a last clip shorter than ``min_seconds``.
+    """
+    settings = dict(DEFAULT_SUGGEST, **settings)
+    boundaries = _boundaries(pauses, cuts, settings, keyframes or [])
+    ends = [boundary[0] for boundary in boundaries]
+
+    start, stop = 0.0, duration
+    if pauses and pauses[0][0] <= 0.0:
+        start = max(0.0, pauses[0][1] - settings["padding"])
+    if pauses and pauses[-1][1] >= duration - RMS_WINDOW_SECONDS:
+        stop = min(duration, pauses[-1][0] + settings["padding"])
+
+    ranges = []
+    while stop - start >= settings["min_seconds"]:
+        if stop - start <= settings["max_seconds"]:
+            ranges.append((start, stop))
+            break
+        first = bisect_left(ends, start + settings["min_seconds"])
+        last = bisect_right(ends, start + settings["max_seconds"])
+        if first < last:
+            # Strongest boundary, the later one of equals for longer clips
+            end, next_start, _ = max(boundaries[first:last], key=lambda boundary: (boundary[2], boundary[0]))
+        else:
+            end = next_start = start + settings["max_seconds"]
+        ranges.append((start, end))
+        start = next_start
+    return ranges
+
+
+def suggest_clips(config_path: str) -> List[ClipConfig]:
+    """
+    Candidate clips of a video folder's source, for someone to title and trim.
+
+    The source is analysed once (see analyze_source) and the candidates are
+    cut at pauses in the speech and at scene changes, start on keyframes
+    where possible and avoid the clips the config already has.
+
+    Raises:
+    ConfigError: If the config can't be read or has no source video.
+    """
+    config = load_config(config_path)
+    settings = dict(DEFAULT_SUGGEST, **config.get("suggest", {}))
+    video_path = config.get("main_video_path")
+    if not video_path or not os.path.isfile(video_path):
+        raise ConfigError([f"Source video not found: {video_path}" if video_path else "main_video_path is missing"])
+    index = media_index(video_path)
+    analysis = analyze_source(video_path)
+
+    pauses = find_pauses(analysis["rms_db"], settings["silence_db"], settings["min_pause"])
+    cuts = find_scene_cuts(analysis["scene"], settings["scene_threshold"])
+    keyframes = keyframe_times(video_path) if index["infos"].get("video_found") else []
+    ranges = suggest_ranges(index["infos"].get("duration") or 0.0, pauses, cuts, settings, keyframes)
+
+    existing = [
+        (clip["start_time"], clip["end_time"]) for clip in config.get("clips_config", [])
+        if isinstance(clip, dict) and isinstance(clip.get("start_time"), float) and isinstance(clip.get("end_time"), float)
+    ]
+    names = {clip.get("name") for clip in config.get("clips_config", []) if isinstance(clip, dict)}
+    suggestions = []
+    number = 0
+    for start, end in ranges:
+        if any(start < taken_end and taken_start < end for taken_start, taken_end in existing):
+            continue
+        number += 1
+        while f"{settings['name_prefix']}{number:02d}" in names:
+            number += 1
+        suggestions.append({
+            "name": f"{settings['name_prefix']}{number:02d}",
+            "start_time": format_timestamp(start),
+            "end_time": format_timestamp(end),
+        })
+    return suggestions
+
+
+def write_suggestions(config_path: str, suggestions: List[ClipConfig]) -> None:
+    """
+    Append clips to a config.json's clips_config.
+
+    The file is rewritten from its own JSON rather than the loaded config,
+    so the existing clips keep their timestamps as they were typed. The new
+    clips have no title yet; validation asks for one before compose.
+    """
+    with open(config_path, "r") as file:
+        config = json.load(file)
+    config.setdefault("clips_config", []).extend(suggestions)
+    tmp_path = f"{config_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(config, file, indent=4, ensure_ascii=False)
+        file.write("\n")
+    os.replace(tmp_path, config_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Suggest clip boundaries at pauses and scene changes")
+    parser.add_argument("config", help="Path to the video folder's config.json")
+    parser.add_argument("--write", action="store_true", help="Append the suggestions to the config's clips_config")
+    args = parser.parse_args()
+
+    suggestions = suggest_clips(args.config)
+    for clip in suggestions:
+        start, end = (normalize_clip(clip)[key] for key in ("start_time", "end_time"))
+        print(f"{clip['name']}: {clip['start_time']} - {clip['end_time']} ({end - start:.1f}s)")
+    if args.write and suggestions:
+        write_suggestions(args.config, suggestions)
+        print(f"Added {len(suggestions)} clip(s) to {args.config}")
@@ -0,0 +1,137 @@
+import glob
+import hashlib
+import json
+import os
+import tempfile
+from typing import Dict, Optional
+
+from ffmpeg_compose import contact_sheet_with_ffmpeg, draft_with_ffmpeg
+from media_probe import media_infos
+from mobile_video_generator import OUTPUT_FORMAT, compute_layout, final_clip_cache_key, rasterize_title, scale_layout
+from preview_proxies import PREVIEW_DIR
+from video_config import ClipConfig, VideoConfig, clip_formats, parse_timestamp
+
+DRAFT_KINDS = ("sheet", "video")
+
+# A quarter of 1080x1920 still shows how a title wraps, at a small fraction of the full encode
+DRAFT_SETTINGS = {
+    "scale": 0.25,
+    "fps": 10,
+    "stills": 4,
+    "codec": "libx264",
+    "preset": "ultrafast",
+    "crf": 30,
+    "audio_bitrate": "48k",
+    "sheet_quality": 4,
+}
+
+
+def render_draft(
+    main_video_path: str,
+    source_video_path: str,
+    start: float,
+    end: float,
+    text: str,
+    output_path: str,
+    kind: str = "sheet",
+    output_format: Optional[Dict] = None,
+    settings: Dict = DRAFT_SETTINGS
+) -> None:
+    """
+    Render a draft of a clip's final composition for title and layout review.
+
+    The layout is computed at full resolution by the same ``compute_layout``
+    as the final render, with the title rasterized at full size so it wraps
+    on the same words, and only then scaled down (see ``scale_layout``).
+    The clip is read from its range of the source, so drafts can be
+    reviewed before the clips are split.
+
+    Args:
+    main_video_path (str): Background template of the output format.
+    source_video_path (str): Source video the clip is cut from.
+    start (float): Clip start in the source.
+    end (float): Clip end in the source.
+    text (str): Title of the clip.
+    output_path (str): Destination, a JPEG for "sheet" and an MP4 for "video".
+    kind (str): "sheet" composites ``stills`` frames spread over the clip
+        into one row, "video" renders the whole clip at ``fps``.
+    output_format (Dict): overlay_scale and title_y of the output format,
+        see ``mobile_video_generator.OUTPUT_FORMAT``.
+    settings (Dict): Draft scale, frame rate and encoder settings.
+    """
+    if kind not in DRAFT_KINDS:
+        raise ValueError(f"Unknown draft kind '{kind}', expected one of {DRAFT_KINDS}")
+    output_format = {key: (output_format or {}).get(key, default) for key, default in OUTPUT_FORMAT.items()}
+    main_infos = media_infos(main_video_path)
+    main_size = main_infos["video_size"]
+    source_size = media_infos(source_video_path)["video_size"]
+    duration = end - start
+
+    with tempfile.TemporaryDirectory() as workdir:
+        title_png = os.path.join(workdir, "title.png")
+        title_size = rasterize_title(text, compute_layout(main_size, source_size)["title_width"], title_png)
+        layout = compute_layout(main_size, source_size, title_size, **output_format)
+        draft_layout = scale_layout(layout, settings["scale"], title_size)
+
+        if kind == "sheet":
+            times = [(idx + 0.5) * duration / settings["stills"] for idx in range(settings["stills"])]
+            contact_sheet_with_ffmpeg(
+                main_video_path, source_video_path, output_path, title_png, draft_layout, start, times,
+                settings["sheet_quality"], main_infos["duration"]
+            )
+        else:
+            draft_with_ffmpeg(
+                main_video_path, source_video_path, output_path, title_png, draft_layout, start, duration,
+                settings["fps"], settings, main_infos["duration"]
+            )
+
+
+def _draft_key(main_video_path: str, source_video_path: str, start: float, end: float, text: str,
+               output_format: Dict, settings: Dict) -> str:
+    # Everything the final render depends on, plus the range and the draft settings
+    payload = json.dumps({
+        "final": final_clip_cache_key(main_video_path, source_video_path, text, "draft", output_format=output_format),
+        "range": [start, end],
+        "settings": settings,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf8")).hexdigest()[:16]
+
+
+def clip_drafts(
+    folder_path: str,
+    config: VideoConfig,
+    clip: ClipConfig,
+    kind: str = "sheet",
+    settings: Dict = DRAFT_SETTINGS
+) -> Dict[str, str]:
+    """
+    Drafts of every output format of a clip by format name, see render_draft.
+
+    Drafts are kept in the folder's preview directory until the template,
+    source, range, title, layout or settings change.
+    """
+    source_video_path = config.get("main_video_path")
+    start, end = parse_timestamp(clip["start_time"]), parse_timestamp(clip["end_time"])
+    draft_dir = os.path.join(folder_path, PREVIEW_DIR)
+    extension = "jpg" if kind == "sheet" else "mp4"
+
+    drafts = {}
+    for name, spec in clip_formats(config, clip).items():
+        stem = f"draft_{clip['name']}_{name}"
+        key = _draft_key(spec["template_video"], source_video_path, start, end, clip.get("title", ""), spec, settings)
+        draft_path = os.path.join(draft_dir, f"{stem}.{key}.{extension}")
+        if not os.path.exists(draft_path):
+            os.makedirs(draft_dir, exist_ok=True)
+            tmp_path = f"{draft_path}.{os.getpid()}.tmp.{extension}"
+            render_draft(
+                spec["template_video"], source_video_path, start, end, clip.get("title", ""), tmp_path, kind, spec,
+                settings
+            )
+            os.replace(tmp_path, draft_path)
+            # Drafts of earlier titles or layouts of the same clip and format
+            pattern = f"{glob.escape(stem)}.{'[0-9a-f]' * 16}.{extension}"
+            for old_path in glob.glob(os.path.join(glob.escape(draft_dir), pattern)):
+                if old_path != draft_path:
+                    os.remove(old_path)
+        drafts[name] = draft_path
+    return drafts
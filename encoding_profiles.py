@@ -0,0 +1,352 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from moviepy.config import FFMPEG_BINARY
+
+from media_probe import media_infos
+
+ENCODING_STAGES = ("split", "compose")
+
+X264_PRESETS = ("ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow")
+
+# Built-in profiles, from fastest to smallest at the same quality target; config.json's
+# "encoding_profiles" adds to and overrides them
+ENCODING_PROFILES = {
+    "ultrafast": {"preset": "ultrafast", "crf": 23},
+    "superfast": {"preset": "superfast", "crf": 23},
+    "veryfast": {"preset": "veryfast", "crf": 23},
+    "fast": {"preset": "fast", "crf": 23},
+    "medium": {"preset": "medium", "crf": 23},
+    "slow": {"preset": "slow", "crf": 23},
+}
+
+# Stands for the profile this machine's auto-tune picked for the stage
+AUTO_PROFILE = "auto"
+
+# Auto-tune results of every machine by host name, so a home folder shared between machines keeps them apart
+TUNE_PATH = os.path.join(os.path.expanduser("~"), ".video_automation", "encoding_tune.json")
+
+DEFAULT_TUNE = {
+    "samples": 3,
+    "sample_seconds": 4.0,
+    # Seconds of video encoded per second of wall time, None for no target
+    "target_realtime": 1.0,
+    "max_bitrate_kbps": None,
+}
+
+
+def encoding_profiles(config: Dict) -> Dict[str, Dict]:
+    """Profiles a config can name: the built-in ones plus its own ``encoding_profiles``."""
+    return {**ENCODING_PROFILES, **(config.get("encoding_profiles") or {})}
+
+
+def profile_name(config: Dict, stage: str) -> Optional[str]:
+    """
+    Profile named for a stage, by ``"encoding_profile": "fast"`` for every
+    stage or ``{"split": "medium", "compose": "auto"}`` per stage.
+    None keeps the stage's built-in encoder settings.
+    """
+    name = config.get("encoding_profile")
+    return name.get(stage) if isinstance(name, dict) else name
+
+
+def tuned_profiles(node: Optional[str] = None, tune_path: str = TUNE_PATH) -> Dict[str, Dict]:
+    """Auto-tune results of a machine (this one by default) by stage."""
+    try:
+        with open(tune_path, "r") as file:
+            results = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    return results.get(node or socket.gethostname(), {})
+
+
+def stage_profile(config: Dict, stage: str, tune_path: str = TUNE_PATH) -> Optional[Dict]:
+    """
+    Encoding profile of a stage: preset, optional crf and optional threads.
+
+    ``auto`` is this machine's auto-tuned profile, or the stage's built-in
+    encoder settings until the machine has been tuned (see untuned_stages).
+    """
+    name = profile_name(config, stage)
+    if name is None:
+        return None
+    if name == AUTO_PROFILE:
+        tuned = tuned_profiles(tune_path=tune_path).get(stage)
+        return tuned["settings"] if tuned is not None else None
+    return encoding_profiles(config)[name]
+
+
+def untuned_stages(config: Dict, stages=ENCODING_STAGES, tune_path: str = TUNE_PATH) -> List[str]:
+    """Stages set to ``auto`` that fall back to their built-in encoder settings on this machine, for the CLIs."""
+    tuned = tuned_profiles(tune_path=tune_path)
+    return [stage for stage in stages if profile_name(config, stage) == AUTO_PROFILE and stage not in tuned]
+
+
+def apply_profile(encoder: Dict, profile: Optional[Dict]) -> Dict:
+    """A stage's built-in encoder settings with a profile's preset, crf and threads in their place."""
+    if profile is None:
+        return encoder
+    applied = {key: value for key, value in encoder.items() if not key.endswith("preset")}
+    applied["preset"] = profile["preset"]
+    for key in ("crf", "threads"):
+        if profile.get(key) is not None:
+            applied[key] = profile[key]
+    return applied
+
+
+def stage_encoder(config: Dict, stage: str) -> Dict:
+    """Encoder settings every write path of a stage uses, see apply_profile."""
+    from mobile_video_generator import FINAL_CLIP_ENCODER
+    from raw_clips_generator import RAW_CLIP_ENCODER
+
+    encoder = RAW_CLIP_ENCODER if stage == "split" else FINAL_CLIP_ENCODER
+    return apply_profile(encoder, stage_profile(config, stage))
+
+
+def crf_params(encoder: Dict) -> List[str]:
+    """x264 rate control arguments of an encoder, empty for x264's default."""
+    return ["-crf", str(encoder["crf"])] if encoder.get("crf") is not None else []
+
+
+def key_encoder(encoder: Dict) -> Dict:
+    """Encoder settings as part of a render cache key; thread counts don't change what is rendered."""
+    return {key: value for key, value in encoder.items() if key != "threads"}
+
+
+def encoding_problems(config: Dict) -> List[str]:
+    """Unknown profile names and malformed profiles, for validate_config."""
+    problems = []
+    profiles = config.get("encoding_profiles") or {}
+    for name, profile in profiles.items() if isinstance(profiles, dict) else ():
+        if not isinstance(profile, dict):
+            problems.append(f"Encoding profile '{name}' must be an object")
+            continue
+        if profile.get("preset") not in X264_PRESETS:
+            problems.append(f"Encoding profile '{name}': preset must be one of {', '.join(X264_PRESETS)}")
+        crf = profile.get("crf")
+        if crf is not None and (isinstance(crf, bool) or not isinstance(crf, (int, float)) or not 0 <= crf <= 51):
+            problems.append(f"Encoding profile '{name}': crf must be a number from 0 to 51")
+        threads = profile.get("threads")
+        if threads is not None and (isinstance(threads, bool) or not isinstance(threads, int) or threads < 1):
+            problems.append(f"Encoding profile '{name}': threads must be a positive integer")
+
+    if not isinstance(config.get("encoding_profile"), (str, dict)) or not isinstance(profiles, dict):
+        # Wrong types are reported with the other settings
+        return problems
+    known = set(encoding_profiles(config)) | {AUTO_PROFILE}
+    for stage in ENCODING_STAGES:
+        name = profile_name(config, stage)
+        if name is not None and (not isinstance(name, str) or name not in known):
+            problems.append(f"encoding_profile of {stage}: unknown profile '{name}'")
+    return problems
+
+
+def _sample_starts(duration: float, samples: int, sample_seconds: float) -> List[float]:
+    """Sample starts spread over the source, away from its intro and outro."""
+    return [
+        max(0.0, min(duration - sample_seconds, (idx + 0.5) * duration / samples - sample_seconds / 2))
+        for idx in range(samples)
+    ]
+
+
+def _encode_sample(config: Dict, stage: str, start: float, seconds: float, encoder: Dict, threads: int,
+                   workdir: str) -> str:
+    """Encode one sample the way the stage would and return the output path."""
+    from ffmpeg_compose import compose_with_ffmpeg
+    from mobile_video_generator import compute_layout
+    from video_config import template_path_for
+
+    source = config["main_video_path"]
+    output_path = os.path.join(workdir, f"{stage}.{start:.3f}.mp4")
+    if stage == "split":
+        # A re-encoded raw clip: decode the source range and encode it at the source's size
+        cmd = [
+            FFMPEG_BINARY, "-y", "-hide_banner", "-ss", f"{start:.6f}", "-t", f"{seconds:.6f}", "-i", source,
+            "-map", "0:v:0", "-c:v", encoder["codec"], "-preset", encoder.get("preset", "medium"),
+            *crf_params(encoder), "-threads", str(threads), output_path,
+        ]
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+        if proc.returncode:
+            raise IOError(proc.stderr.decode("utf8", errors="replace"))
+        return output_path
+
+    # A final clip: the sample composed on the template by the ffmpeg backend, without a title
+    sample_path = os.path.join(workdir, f"sample.{start:.3f}.mp4")
+    subprocess.run(
+        [FFMPEG_BINARY, "-y", "-hide_banner", "-ss", f"{start:.6f}", "-t", f"{seconds:.6f}", "-i", source,
+         "-map", "0:v:0", "-c", "copy", sample_path],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL, check=True
+    )
+    template_path = template_path_for(config)
+    template_infos = media_infos(template_path)
+    layout = compute_layout(template_infos["video_size"], media_infos(source)["video_size"])
+    compose_with_ffmpeg(
+        template_path, sample_path, output_path, None, layout, duration=seconds, fps=template_infos["video_fps"],
+        audio_inputs=(False, False), encoder=encoder, threads=threads
+    )
+    return output_path
+
+
+def measure_profile(config: Dict, stage: str, profile: Dict, settings: Dict = DEFAULT_TUNE) -> Dict:
+    """
+    Test-encode samples of the folder's source with a profile.
+
+    Returns:
+    Dict: ``realtime`` (seconds of video per wall second over all samples)
+        and ``bitrate_kbps`` of the encoded video.
+    """
+    from mobile_video_generator import FINAL_CLIP_ENCODER
+    from raw_clips_generator import RAW_CLIP_ENCODER, threads_per_worker
+
+    encoder = apply_profile(RAW_CLIP_ENCODER if stage == "split" else FINAL_CLIP_ENCODER, profile)
+    # The threads a pipeline run gives each encoder, unless the profile sets its own
+    pipeline = config.get("pipeline") or {}
+    workers = pipeline.get("split_workers", 2) + pipeline.get("compose_workers", 2)
+    threads = encoder.get("threads") or threads_per_worker(workers, config.get("thread_budget"))
+
+    duration = media_infos(config["main_video_path"])["duration"]
+    seconds = min(settings["sample_seconds"], duration)
+    wall = encoded_seconds = encoded_bytes = 0.0
+    with tempfile.TemporaryDirectory() as workdir:
+        for start in _sample_starts(duration, settings["samples"], seconds):
+            started = time.perf_counter()
+            output_path = _encode_sample(config, stage, start, seconds, encoder, threads, workdir)
+            wall += time.perf_counter() - started
+            encoded_seconds += seconds
+            encoded_bytes += os.path.getsize(output_path)
+    return {
+        "realtime": encoded_seconds / wall,
+        "bitrate_kbps": encoded_bytes * 8 / 1000 / encoded_seconds,
+        "threads": threads,
+    }
+
+
+def pick_profile(results: Dict[str, Dict], target_realtime: Optional[float],
+                 max_bitrate_kbps: Optional[float]) -> Dict:
+    """
+    Choose between measured profiles.
+
+    With a realtime target, the smallest output among the profiles that
+    keep up; with only a bitrate ceiling, the fastest profile under it.
+    When no profile meets both, the one closest to the realtime target
+    (the fastest) or else to the ceiling (the smallest).
+
+    Returns:
+    Dict: ``profile`` name and whether it ``met`` the targets.
+    """
+    meeting = [
+        name for name, result in results.items()
+        if (target_realtime is None or result["realtime"] >= target_realtime)
+        and (max_bitrate_kbps is None or result["bitrate_kbps"] <= max_bitrate_kbps)
+    ]
+    def fastest(names):
+        return max(names, key=lambda name: results[name]["realtime"])
+
+    def smallest(names):
+        return min(names, key=lambda name: results[name]["bitrate_kbps"])
+
+    if meeting:
+        return {"profile": smallest(meeting) if target_realtime is not None else fastest(meeting), "met": True}
+    return {"profile": fastest(results) if target_realtime is not None else smallest(results), "met": False}
+
+
+def auto_tune(
+    config: Dict,
+    stages=ENCODING_STAGES,
+    settings: Dict = DEFAULT_TUNE,
+    profiles: Optional[List[str]] = None,
+    tune_path: str = TUNE_PATH
+) -> Dict[str, Dict]:
+    """
+    Measure every profile on samples of the folder's source and store the
+    pick per stage for this machine, where ``"encoding_profile": "auto"``
+    finds it.
+
+    Args:
+    config (Dict): Folder config with main_video_path (and the template
+        for the compose stage).
+    stages: Stages to tune.
+    settings (Dict): Samples and targets, see ``DEFAULT_TUNE``.
+    profiles (List[str]): Profile names to try, all known ones by default.
+    tune_path (str): Results file shared by every machine.
+
+    Returns:
+    Dict[str, Dict]: This machine's results by stage.
+    """
+    known = encoding_profiles(config)
+    names = profiles or list(known)
+    tuned = {}
+    for stage in stages:
+        results = {}
+        for name in names:
+            results[name] = measure_profile(config, stage, known[name], settings)
+            print(f"{stage:<8} {name:<12} {results[name]['realtime']:6.2f}x realtime "
+                  f"{results[name]['bitrate_kbps']:9.0f} kb/s")
+        pick = pick_profile(results, settings["target_realtime"], settings["max_bitrate_kbps"])
+        tuned[stage] = {
+            "profile": pick["profile"],
+            "settings": known[pick["profile"]],
+            "met": pick["met"],
+            "target_realtime": settings["target_realtime"],
+            "max_bitrate_kbps": settings["max_bitrate_kbps"],
+            "results": results,
+            "tuned": time.time(),
+        }
+        print(f"{stage}: {pick['profile']}" + ("" if pick["met"] else " (no profile meets the targets)"))
+
+    try:
+        with open(tune_path, "r") as file:
+            machines = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        machines = {}
+    node = socket.gethostname()
+    machines[node] = {**machines.get(node, {}), **tuned}
+    os.makedirs(os.path.dirname(tune_path), exist_ok=True)
+    tmp_path = f"{tune_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(machines, file, indent=2)
+    os.replace(tmp_path, tune_path)
+    return machines[node]
+
+
+if __name__ == "__main__":
+    from video_config import ConfigError, load_config, require_valid
+
+    parser = argparse.ArgumentParser(
+        description="Pick the encoding profile of each stage for this machine by test-encoding samples of a "
+                    "folder's source. Folders use it with \"encoding_profile\": \"auto\"."
+    )
+    parser.add_argument("folder", help="Video folder containing config.json, e.g. videos/video1")
+    parser.add_argument("--stage", choices=ENCODING_STAGES, action="append", help="Stage to tune, default all")
+    parser.add_argument("--profiles", help="Comma-separated profile names to try, default all")
+    parser.add_argument("--target-realtime", type=float, default=DEFAULT_TUNE["target_realtime"],
+                        help="Seconds of video encoded per wall second each encoder must reach, 0 for no target")
+    parser.add_argument("--max-bitrate", type=float, default=DEFAULT_TUNE["max_bitrate_kbps"],
+                        help="Video bitrate ceiling in kb/s")
+    parser.add_argument("--samples", type=int, default=DEFAULT_TUNE["samples"], help="Samples of the source")
+    parser.add_argument("--sample-seconds", type=float, default=DEFAULT_TUNE["sample_seconds"],
+                        help="Length of each sample")
+    args = parser.parse_args()
+
+    stages = tuple(args.stage or ENCODING_STAGES)
+    try:
+        config = load_config(os.path.join(args.folder, "config.json"))
+        require_valid(config, stages)
+    except ConfigError as e:
+        raise SystemExit("\n".join(e.problems))
+    names = args.profiles.split(",") if args.profiles else None
+    unknown = set(names or ()) - set(encoding_profiles(config))
+    if unknown:
+        raise SystemExit(f"Unknown profile(s): {', '.join(sorted(unknown))}")
+    auto_tune(config, stages, {
+        "samples": args.samples,
+        "sample_seconds": args.sample_seconds,
+        "target_realtime": args.target_realtime or None,
+        "max_bitrate_kbps": args.max_bitrate,
+    }, names)
@@ -0,0 +1,404 @@
+from typing import Dict, List, Optional, Tuple
+
+from moviepy.config import FFMPEG_BINARY
+
+from encoding_profiles import crf_params
+from progress_events import ProgressSink, run_ffmpeg
+
+
+def _layout_filters(
+    background: str,
+    overlay: str,
+    title: Optional[str],
+    overlay_size: Tuple[int, int],
+    margin: int,
+    overlay_position: Tuple[int, int],
+    title_position: Optional[Tuple[int, int]],
+    output: str,
+) -> List[str]:
+    """Filter chains placing the ``overlay`` stream and ``title`` image on ``background``, into ``[output]``."""
+    width, height = overlay_size
+    filters = [
+        # LANCZOS matches the PIL resampling used by MoviePy's Resize
+        f"[{overlay}]scale={width}:{height}:flags=lanczos,"
+        f"pad={width + 2 * margin}:{height + 2 * margin}:{margin}:{margin}:black[ov{output}]",
+        f"[{background}][ov{output}]overlay={overlay_position[0]}:{overlay_position[1]}"
+        + (f"[bg{output}]" if title_position else f",format=yuv420p[{output}]"),
+    ]
+    if title_position:
+        filters.append(f"[bg{output}][{title}]overlay={title_position[0]}:{title_position[1]},format=yuv420p[{output}]")
+    return filters
+
+
+def _template_loops(start: float, duration: float, template_duration: Optional[float]) -> bool:
+    return bool(template_duration) and start + duration > template_duration
+
+
+def _template_input(path: str, start: float, duration: float, template_duration: Optional[float]) -> List[str]:
+    """
+    Input arguments of a background template read for ``duration`` seconds
+    from ``start``, looped when it ends before that (see ``_loop_filter``).
+    """
+    loop = []
+    if _template_loops(start, duration, template_duration):
+        # -ss doesn't seek past the end of the first pass of a looped input
+        loop, start = ["-stream_loop", "-1"], start % template_duration
+    seek = ["-ss", f"{start:.6f}"] if start else []
+    return [*loop, *seek, "-t", f"{duration:.6f}", "-i", path]
+
+
+def _loop_filter(template: str, output: str) -> str:
+    """
+    Number the frames of a looped template in order, into ``[output]``.
+
+    Each pass of a looped input is offset by the container's duration, which
+    the audio's encoder delay makes longer than the video, so passes would
+    drift by a frame each.
+    """
+    return f"[{template}]setpts=N/FRAME_RATE/TB[{output}]"
+
+
+def build_overlay_filtergraph(
+    overlay_size: Tuple[int, int],
+    margin: int,
+    overlay_position: Tuple[int, int],
+    title_position: Optional[Tuple[int, int]],
+    mix_audio: bool,
+    loop_template: bool = False,
+) -> str:
+    """
+    Compile the mobile layout into a single ffmpeg ``filter_complex``.
+
+    Inputs are expected as ``0`` background template, ``1`` overlay video and
+    ``2`` title PNG (optional). The scaled overlay gets a black margin, is
+    placed on the background and the title is alpha-blended on top, so no
+    frame ever passes through Python.
+
+    Args:
+    overlay_size (Tuple[int, int]): Scaled overlay size before the margin.
+    margin (int): Black border around the overlay in pixels.
+    overlay_position (Tuple[int, int]): Top-left corner of the margined overlay.
+    title_position (Tuple[int, int]): Top-left corner of the title, None without a title.
+    mix_audio (bool): Mix the template and overlay audio like CompositeVideoClip does.
+    loop_template (bool): The template input is looped, see ``_loop_filter``.
+    """
+    filters = [_loop_filter("0:v", "tplvout")] if loop_template else []
+    filters += _layout_filters(
+        "tplvout" if loop_template else "0:v", "1:v", "2:v", overlay_size, margin, overlay_position, title_position,
+        "vout"
+    )
+    if mix_audio:
+        # CompositeAudioClip sums its tracks, so don't let amix scale them down
+        filters.append("[0:a][1:a]amix=inputs=2:duration=longest:normalize=0[aout]")
+    return ";".join(filters)
+
+
+def compose_with_ffmpeg(
+    main_video_path: str,
+    overlay_video_path: str,
+    output_path: str,
+    title_png_path: Optional[str],
+    layout: Dict,
+    duration: float,
+    fps: float,
+    audio_inputs: Tuple[bool, bool],
+    encoder: Dict,
+    threads: Optional[int] = None,
+    progress: Optional[ProgressSink] = None,
+    progress_label: str = "",
+    start: float = 0.0,
+    frames: Optional[int] = None,
+    template_duration: Optional[float] = None,
+) -> None:
+    """
+    Render the mobile composition with one native ffmpeg invocation.
+
+    Args:
+    main_video_path (str): Background template video.
+    overlay_video_path (str): Raw clip placed in the middle.
+    output_path (str): Destination file.
+    title_png_path (str): Pre-rasterized RGBA title, None for no title.
+    layout (Dict): Output of ``mobile_video_generator.compute_layout``.
+    duration (float): Output duration, i.e. the overlay duration.
+    fps (float): Output frame rate.
+    audio_inputs (Tuple[bool, bool]): Whether the template and overlay have audio.
+    encoder (Dict): codec, audio_codec, preset and optionally crf of the output.
+    threads (int): Encoder thread limit, None lets x264 decide.
+    progress (ProgressSink): Receives frame progress parsed from ffmpeg.
+    progress_label (str): Clip name used in the progress events.
+    start (float): Render from this time on, for one segment of a segmented render.
+    frames (int): Exact number of frames to render, for a segment.
+    template_duration (float): Length of the template, which loops when the
+        output is longer. None uses the template as is.
+    """
+    template_audio, overlay_audio = audio_inputs
+    graph = build_overlay_filtergraph(
+        layout["overlay_size"],
+        layout["margin"],
+        layout["overlay_position"],
+        layout["title_position"] if title_png_path else None,
+        mix_audio=template_audio and overlay_audio,
+        loop_template=_template_loops(start, duration, template_duration),
+    )
+
+    # Input seeking stays frame accurate since both inputs are decoded anyway
+    seek = ["-ss", f"{start:.6f}"] if start else []
+    inputs: List[str] = [
+        *_template_input(main_video_path, start, duration, template_duration), *seek, "-i", overlay_video_path
+    ]
+    if title_png_path:
+        inputs += ["-i", title_png_path]
+
+    if template_audio and overlay_audio:
+        audio_map = ["-map", "[aout]"]
+    elif overlay_audio:
+        audio_map = ["-map", "1:a:0"]
+    elif template_audio:
+        audio_map = ["-map", "0:a:0"]
+    else:
+        audio_map = []
+
+    cmd = [
+        FFMPEG_BINARY, "-y", "-hide_banner",
+        *inputs,
+        "-filter_complex", graph,
+        "-map", "[vout]", *audio_map,
+        "-t", f"{duration:.6f}",
+        *(["-frames:v", str(frames)] if frames else []),
+        "-r", f"{fps}",
+        "-c:v", encoder["codec"], "-preset", encoder["preset"], *crf_params(encoder),
+        *(["-c:a", encoder["audio_codec"]] if audio_map else []),
+        *(["-threads", str(threads)] if threads else []),
+        output_path,
+    ]
+    run_ffmpeg(cmd, progress, progress_label, "compose", total_frames=frames or int(duration * fps))
+
+
+def fanout_with_ffmpeg(
+    overlay_video_path: str,
+    outputs: List[Dict],
+    duration: float,
+    overlay_audio: bool,
+    encoder: Dict,
+    threads: Optional[int] = None,
+    progress: Optional[ProgressSink] = None,
+    progress_label: str = "",
+) -> None:
+    """
+    Render one raw clip into several compositions with one ffmpeg invocation.
+
+    The overlay is decoded once and split to a layout chain per output,
+    each with its own template, title, frame rate and encoder, so N formats
+    cost one decode of the clip instead of N.
+
+    Args:
+    overlay_video_path (str): Raw clip placed on every template.
+    outputs (List[Dict]): One entry per output with ``template`` path,
+        ``title_png`` path (None for no title), ``layout`` (see
+        ``mobile_video_generator.compute_layout``), ``fps``,
+        ``template_audio`` (bool), ``copy_audio`` (bool, stream-copy the
+        overlay's audio), ``output_path`` and optionally
+        ``template_duration`` (see compose_with_ffmpeg).
+    duration (float): Output duration, i.e. the overlay duration.
+    overlay_audio (bool): Whether the overlay has audio.
+    encoder (Dict): codec, audio_codec, preset and optionally crf of the outputs.
+    threads (int): Encoder thread limit of each output, None lets x264 decide.
+    progress (ProgressSink): Receives frame progress of the first output.
+    progress_label (str): Clip name used in the progress events.
+    """
+    count = len(outputs)
+    inputs: List[str] = ["-i", overlay_video_path]
+    filters = [f"[0:v]split={count}" + "".join(f"[src{idx}]" for idx in range(count))]
+    mixed = [output for output in outputs if output["template_audio"] and overlay_audio]
+    if len(mixed) > 1:
+        filters.append(f"[0:a]asplit={len(mixed)}" + "".join(f"[asrc{idx}]" for idx in range(len(mixed))))
+
+    maps: List[List[str]] = []
+    next_input = 1
+    mix_idx = 0
+    for idx, output in enumerate(outputs):
+        template_input = next_input
+        inputs += _template_input(output["template"], 0.0, duration, output.get("template_duration"))
+        next_input += 1
+        background = f"{template_input}:v"
+        if _template_loops(0.0, duration, output.get("template_duration")):
+            filters.append(_loop_filter(background, f"tpl{idx}"))
+            background = f"tpl{idx}"
+        title = None
+        if output["title_png"]:
+            title = f"{next_input}:v"
+            inputs += ["-i", output["title_png"]]
+            next_input += 1
+        layout = output["layout"]
+        filters += _layout_filters(
+            background, f"src{idx}", title, layout["overlay_size"], layout["margin"],
+            layout["overlay_position"], layout["title_position"] if title else None, f"vout{idx}"
+        )
+
+        audio_codec = ["-c:a", encoder["audio_codec"]]
+        if output["template_audio"] and overlay_audio:
+            overlay_label = f"asrc{mix_idx}" if len(mixed) > 1 else "0:a"
+            mix_idx += 1
+            # CompositeAudioClip sums its tracks, so don't let amix scale them down
+            filters.append(f"[{template_input}:a][{overlay_label}]amix=inputs=2:duration=longest:normalize=0[aout{idx}]")
+            audio_map = ["-map", f"[aout{idx}]"]
+        elif overlay_audio:
+            audio_map = ["-map", "0:a:0"]
+            if output.get("copy_audio"):
+                audio_codec = ["-c:a", "copy"]
+        elif output["template_audio"]:
+            audio_map = ["-map", f"{template_input}:a:0"]
+        else:
+            audio_map, audio_codec = [], []
+
+        maps.append([
+            "-map", f"[vout{idx}]", *audio_map,
+            "-t", f"{duration:.6f}",
+            "-r", f"{output['fps']}",
+            "-c:v", encoder["codec"], "-preset", encoder["preset"], *crf_params(encoder),
+            *audio_codec,
+            *(["-threads", str(threads)] if threads else []),
+            output["output_path"],
+        ])
+
+    cmd = [
+        FFMPEG_BINARY, "-y", "-hide_banner",
+        *inputs,
+        "-filter_complex", ";".join(filters),
+        *[arg for output_args in maps for arg in output_args],
+    ]
+    run_ffmpeg(cmd, progress, progress_label, "compose", total_frames=int(duration * outputs[0]["fps"]))
+
+
+def _draft_layout_filters(template: str, source: str, title: Optional[str], layout: Dict, label: str) -> List[str]:
+    """Scale the full resolution template and title of one draft composition to the draft ``layout``."""
+    width, height = layout["size"]
+    filters = [f"[{template}]scale={width}:{height}:flags=bilinear[draftbg{label}]"]
+    if title:
+        title_width, title_height = layout["title_size"]
+        filters.append(f"[{title}]scale={title_width}:{title_height}:flags=lanczos[drafttitle{label}]")
+    filters += _layout_filters(
+        f"draftbg{label}", source, f"drafttitle{label}" if title else None, layout["overlay_size"], layout["margin"],
+        layout["overlay_position"], layout["title_position"] if title else None, label
+    )
+    return filters
+
+
+def draft_with_ffmpeg(
+    main_video_path: str,
+    source_video_path: str,
+    output_path: str,
+    title_png_path: Optional[str],
+    layout: Dict,
+    source_start: float,
+    duration: float,
+    fps: float,
+    encoder: Dict,
+    template_duration: Optional[float] = None,
+) -> None:
+    """
+    Render a low resolution, low frame rate draft of the mobile composition.
+
+    The clip is read straight from its range of the source video, so a
+    draft needs no raw clip. Frames are dropped before scaling and
+    compositing, and only the clip's own audio is kept.
+
+    Args:
+    main_video_path (str): Background template video.
+    source_video_path (str): Source video the clip is cut from.
+    output_path (str): Destination file.
+    title_png_path (str): Full resolution RGBA title, None for no title.
+    layout (Dict): Draft layout, see ``mobile_video_generator.scale_layout``.
+    source_start (float): Start of the clip in the source.
+    duration (float): Clip duration.
+    fps (float): Draft frame rate.
+    encoder (Dict): codec, preset, crf and audio_bitrate of the draft.
+    template_duration (float): See compose_with_ffmpeg.
+    """
+    inputs = [*_template_input(main_video_path, 0.0, duration, template_duration),
+              "-ss", f"{source_start:.6f}", "-t", f"{duration:.6f}", "-i", source_video_path]
+    if title_png_path:
+        inputs += ["-i", title_png_path]
+    filters = [f"[0:v]fps={fps}[tpl]", f"[1:v]fps={fps}[src]"]
+    if _template_loops(0.0, duration, template_duration):
+        filters[0] = f"{_loop_filter('0:v', 'looped')};[looped]fps={fps}[tpl]"
+    filters += _draft_layout_filters("tpl", "src", "2:v" if title_png_path else None, layout, "vout")
+
+    cmd = [
+        FFMPEG_BINARY, "-y", "-hide_banner",
+        *inputs,
+        "-filter_complex", ";".join(filters),
+        "-map", "[vout]", "-map", "1:a:0?",
+        "-t", f"{duration:.6f}",
+        "-c:v", encoder["codec"], "-preset", encoder["preset"], "-crf", str(encoder["crf"]),
+        "-c:a", "aac", "-b:a", encoder["audio_bitrate"], "-ac", "1",
+        "-movflags", "+faststart",
+        output_path,
+    ]
+    run_ffmpeg(cmd, None, "", "compose")
+
+
+def contact_sheet_with_ffmpeg(
+    main_video_path: str,
+    source_video_path: str,
+    output_path: str,
+    title_png_path: Optional[str],
+    layout: Dict,
+    source_start: float,
+    times: List[float],
+    quality: int,
+    template_duration: Optional[float] = None,
+) -> None:
+    """
+    Composite the draft layout at a few clip times into one row of stills.
+
+    Each still seeks the template and the source to its time, so only a
+    handful of frames are decoded whatever the clip's length. The template
+    shows its last keyframe before that time rather than decoding up to the
+    exact frame, as the background doesn't change the layout.
+
+    Args:
+    main_video_path (str): Background template video.
+    source_video_path (str): Source video the clip is cut from.
+    output_path (str): Destination JPEG.
+    title_png_path (str): Full resolution RGBA title, None for no title.
+    layout (Dict): Draft layout, see ``mobile_video_generator.scale_layout``.
+    source_start (float): Start of the clip in the source.
+    times (List[float]): Clip times of the stills.
+    quality (int): JPEG quality scale, 2 (best) to 31.
+    template_duration (float): Length of the template, which loops when
+        the clip is longer. None uses the template as is.
+    """
+    count = len(times)
+    inputs: List[str] = []
+    for time in times:
+        template_time = time % template_duration if template_duration else time
+        inputs += ["-noaccurate_seek", "-ss", f"{template_time:.6f}", "-i", main_video_path,
+                   "-ss", f"{source_start + time:.6f}", "-i", source_video_path]
+    filters = []
+    if title_png_path:
+        inputs += ["-i", title_png_path]
+        filters.append(f"[{2 * count}:v]split={count}" + "".join(f"[t{idx}]" for idx in range(count)))
+    for idx in range(count):
+        # One frame per input at time zero, so overlay doesn't decode on to line their timestamps up
+        filters += [
+            f"[{2 * idx}:v]trim=end_frame=1,setpts=0[tpl{idx}]",
+            f"[{2 * idx + 1}:v]trim=end_frame=1,setpts=0[src{idx}]",
+        ]
+        filters += _draft_layout_filters(
+            f"tpl{idx}", f"src{idx}", f"t{idx}" if title_png_path else None, layout, f"still{idx}"
+        )
+    if count > 1:
+        filters.append("".join(f"[still{idx}]" for idx in range(count)) + f"hstack=inputs={count}[sheet]")
+    else:
+        filters.append("[still0]null[sheet]")
+
+    cmd = [
+        FFMPEG_BINARY, "-y", "-hide_banner",
+        *inputs,
+        "-filter_complex", ";".join(filters),
+        "-map", "[sheet]", "-frames:v", "1",
+        "-q:v", str(quality),
+        output_path,
+    ]
+    run_ffmpeg(cmd, None, "", "compose")
@@ -0,0 +1,339 @@
+import os
+import queue
+import subprocess
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from moviepy.config import FFMPEG_BINARY
+
+from encoding_profiles import crf_params
+from layer_compositor import StaticLayer, _visible_rect
+from progress_events import ProgressSink
+import render_profiler
+
+# Frames decoded ahead of the compositor per input, when no memory ceiling is set
+DEFAULT_FRAMES_IN_FLIGHT = 4
+
+# Fewer buffers per input and the decoder waits on every frame
+MIN_FRAMES_IN_FLIGHT = 2
+
+# Per-compose ceiling of the frame buffers in MB, read in worker processes too, see set_memory_limit
+MEMORY_LIMIT_ENV = "VIDEO_AUTOMATION_MEMORY_MB"
+
+Size = Tuple[int, int]
+
+
+def set_memory_limit(memory_limit_mb: Optional[float]) -> None:
+    """Bound the frame buffers of every streaming compose of this process and workers started after this call."""
+    if memory_limit_mb:
+        os.environ[MEMORY_LIMIT_ENV] = str(memory_limit_mb)
+    else:
+        os.environ.pop(MEMORY_LIMIT_ENV, None)
+
+
+def memory_limit_mb() -> Optional[float]:
+    value = os.environ.get(MEMORY_LIMIT_ENV)
+    return float(value) if value else None
+
+
+def frames_in_flight(frame_bytes: int, limit_mb: Optional[float] = None) -> int:
+    """
+    Buffers per input that fit the memory ceiling, ``frame_bytes`` being the
+    bytes of one frame of every input together.
+
+    Raises:
+    MemoryError: The ceiling doesn't hold the minimum of two frames.
+    """
+    limit_mb = limit_mb if limit_mb is not None else memory_limit_mb()
+    if limit_mb is None:
+        return DEFAULT_FRAMES_IN_FLIGHT
+    count = min(DEFAULT_FRAMES_IN_FLIGHT, int(limit_mb * 1024 * 1024 // frame_bytes))
+    if count < MIN_FRAMES_IN_FLIGHT:
+        raise MemoryError(
+            f"memory_limit_mb of {limit_mb:g} is below the {MIN_FRAMES_IN_FLIGHT * frame_bytes / 1024 ** 2:.0f} MB "
+            f"of frame buffers this compose needs"
+        )
+    return count
+
+
+class FramePool:
+    """
+    A fixed set of preallocated uint8 frames, handed out and recycled.
+
+    ``acquire`` blocks while every frame is in use, which is what bounds the
+    memory of a streaming compose: a decoder can only run ahead of the
+    compositor by the pool's size.
+    """
+
+    def __init__(self, shape: Tuple[int, ...], count: int):
+        self.shape = shape
+        self.count = count
+        self._free: queue.Queue = queue.Queue()
+        for _ in range(count):
+            self._free.put(np.empty(shape, dtype=np.uint8))
+
+    @property
+    def nbytes(self) -> int:
+        return self.count * int(np.prod(self.shape))
+
+    def acquire(self, stopped: Optional[threading.Event] = None) -> Optional[np.ndarray]:
+        """A free frame, None once ``stopped`` is set while waiting for one."""
+        while True:
+            try:
+                return self._free.get(timeout=0.1)
+            except queue.Empty:
+                if stopped is not None and stopped.is_set():
+                    return None
+
+    def release(self, frame: np.ndarray) -> None:
+        self._free.put(frame)
+
+
+class FrameReader:
+    """
+    Decode a video with ffmpeg straight into the frames of a pool.
+
+    ffmpeg converts, resamples and scales, so each frame arrives at its
+    final size and is read into a recycled buffer with ``readinto``, without
+    an allocation per frame. A thread decodes ahead of the consumer until
+    the pool runs out of free frames.
+
+    Args:
+    path (str): Video to read.
+    size (Size): Frame (width, height) to scale to.
+    fps (float): Frame rate to resample to.
+    frames (int): Frames to read.
+    pool (FramePool): Where the frames go; ``release`` each one when done.
+    start (float): Read from this time on.
+    loop_duration (float): Loop the video every this many seconds, for a
+        background shorter than the output. None reads it once.
+    label (str): Name of the decode in profiles.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        size: Size,
+        fps: float,
+        frames: int,
+        pool: FramePool,
+        start: float = 0.0,
+        loop_duration: Optional[float] = None,
+        label: str = "decode"
+    ):
+        width, height = size
+        filters = [f"fps={fps}", f"scale={width}:{height}:flags=lanczos"]
+        loop = []
+        if loop_duration and start + frames / fps > loop_duration:
+            # Frames numbered in order, as passes of a looped input are offset by the container's duration
+            loop, start = ["-stream_loop", "-1"], start % loop_duration
+            filters.insert(0, "setpts=N/FRAME_RATE/TB")
+        cmd = [
+            FFMPEG_BINARY, "-hide_banner", "-loglevel", "error",
+            *loop, *(["-ss", f"{start:.6f}"] if start else []), "-i", path,
+            "-map", "0:v:0", "-vf", ",".join(filters), "-frames:v", str(frames),
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "-",
+        ]
+        self.pool = pool
+        self.frames = frames
+        self.label = label
+        self._decoded: queue.Queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+        self._thread = threading.Thread(target=self._decode, name=f"{label} reader", daemon=True)
+        self._thread.start()
+
+    def _decode(self) -> None:
+        try:
+            for _ in range(self.frames):
+                frame = self.pool.acquire(self._stopped)
+                if frame is None:
+                    return
+                with render_profiler.span(self.label):
+                    view = memoryview(frame).cast("B")
+                    filled = 0
+                    while filled < len(view):
+                        read = self._proc.stdout.readinto(view[filled:])
+                        if not read:
+                            break
+                        filled += read
+                if filled < len(view):
+                    self.pool.release(frame)
+                    # Fewer frames than expected, e.g. a raw clip a frame short; the consumer repeats the last one
+                    break
+                self._decoded.put(frame)
+        except Exception as e:
+            self._decoded.put(e)
+        finally:
+            self._decoded.put(None)
+
+    def read(self) -> Optional[np.ndarray]:
+        """The next frame, None after the last one."""
+        frame = self._decoded.get()
+        if isinstance(frame, Exception):
+            raise frame
+        if frame is None:
+            # Let later reads see the end too
+            self._decoded.put(None)
+            self._proc.wait()
+            if self._proc.returncode:
+                raise IOError(self._proc.stderr.read().decode("utf8", errors="replace"))
+        return frame
+
+    def close(self) -> None:
+        self._stopped.set()
+        self._proc.kill()
+        self._thread.join()
+        self._proc.wait()
+        self._proc.stdout.close()
+        self._proc.stderr.close()
+
+
+class FrameWriter:
+    """Encode frames with ffmpeg, writing each buffer to its pipe without copying it."""
+
+    def __init__(self, output_path: str, size: Size, fps: float, encoder: Dict, threads: Optional[int] = None):
+        width, height = size
+        cmd = [
+            FFMPEG_BINARY, "-y", "-hide_banner", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", f"{fps}", "-i", "-",
+            "-an", "-c:v", encoder["codec"], "-preset", encoder["preset"], *crf_params(encoder),
+            *(["-threads", str(threads)] if threads else []),
+            "-pix_fmt", "yuv420p", output_path,
+        ]
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def write(self, frame: np.ndarray) -> None:
+        try:
+            self._proc.stdin.write(memoryview(frame).cast("B"))
+        except BrokenPipeError:
+            self._proc.wait()
+            raise IOError(self._proc.stderr.read().decode("utf8", errors="replace"))
+
+    def close(self) -> None:
+        self._proc.stdin.close()
+        self._proc.wait()
+        stderr = self._proc.stderr.read()
+        self._proc.stderr.close()
+        if self._proc.returncode:
+            raise IOError(stderr.decode("utf8", errors="replace"))
+
+    def kill(self) -> None:
+        self._proc.kill()
+        self._proc.wait()
+        self._proc.stdin.close()
+        self._proc.stderr.close()
+
+
+def compose_stream(
+    background_path: str,
+    overlay_path: str,
+    output_path: str,
+    size: Size,
+    overlay_size: Size,
+    overlay_position: Tuple[int, int],
+    fps: float,
+    frames: int,
+    encoder: Dict,
+    threads: Optional[int] = None,
+    underlays: Sequence[StaticLayer] = (),
+    layers: Sequence[StaticLayer] = (),
+    start: float = 0.0,
+    background_duration: Optional[float] = None,
+    limit_mb: Optional[float] = None,
+    progress: Optional[ProgressSink] = None,
+    progress_label: str = ""
+) -> Dict:
+    """
+    Composite an overlay video onto a background video, streaming frames
+    through fixed buffer pools, into a video-only file.
+
+    Each background frame is composited in place: static underlays, the
+    overlay (already scaled by its decoder) and static layers are written
+    into it, it goes to the encoder and back to its pool. Decoding,
+    compositing and encoding overlap, and the memory they use is the pools'
+    whatever the output's length.
+
+    Args:
+    background_path (str): Background video, e.g. the template.
+    overlay_path (str): Video placed on it.
+    output_path (str): Destination file, without audio.
+    size (Size): Output (width, height), the background's size.
+    overlay_size (Size): Size the overlay is scaled to.
+    overlay_position (Tuple[int, int]): Top-left corner of the overlay.
+    fps (float): Output frame rate.
+    frames (int): Output frames.
+    encoder (Dict): codec, preset and optionally crf of the output.
+    threads (int): Encoder thread limit, None lets x264 decide.
+    underlays (Sequence[StaticLayer]): Static layers below the overlay.
+    layers (Sequence[StaticLayer]): Static layers above it.
+    start (float): Render from this time of both inputs on.
+    background_duration (float): Loop the background every this many seconds.
+    limit_mb (float): Ceiling of the frame buffers, see set_memory_limit.
+    progress (ProgressSink): Receives "compose" frame progress events.
+    progress_label (str): Clip name of the events.
+
+    Returns:
+    Dict: ``frames_in_flight`` per input and ``buffer_mb`` of the pools.
+    """
+    width, height = size
+    overlay_rect = _visible_rect(overlay_position, overlay_size, size)
+    overlay_bytes = overlay_size[0] * overlay_size[1] * 3
+    count = frames_in_flight(width * height * 3 + overlay_bytes, limit_mb)
+    background_pool = FramePool((height, width, 3), count)
+    overlay_pool = FramePool((overlay_size[1], overlay_size[0], 3), count)
+
+    readers: List[FrameReader] = []
+    writer = None
+    try:
+        readers.append(FrameReader(
+            background_path, size, fps, frames, background_pool, start, background_duration, "decode template"
+        ))
+        readers.append(FrameReader(overlay_path, overlay_size, fps, frames, overlay_pool, start, None, "decode overlay"))
+        background_reader, overlay_reader = readers
+        writer = FrameWriter(output_path, size, fps, encoder, threads)
+
+        last_overlay = None
+        started = last_emit = time.perf_counter()
+        for done in range(1, frames + 1):
+            frame = background_reader.read()
+            if frame is None:
+                raise IOError(f"{background_path} ended after {done - 1} of {frames} frames")
+            overlay = overlay_reader.read()
+            if overlay is None:
+                # The overlay's last frame holds, as MoviePy does past a clip's end
+                overlay = last_overlay
+            elif last_overlay is not None:
+                overlay_pool.release(last_overlay)
+            last_overlay = overlay
+
+            with render_profiler.span("composite"):
+                for layer in underlays:
+                    layer.blend_into(frame)
+                if overlay_rect is not None and overlay is not None:
+                    dst, src = overlay_rect
+                    np.copyto(frame[dst], overlay[src])
+                for layer in layers:
+                    layer.blend_into(frame)
+            with render_profiler.span("write"):
+                writer.write(frame)
+            background_pool.release(frame)
+
+            if progress is not None and time.perf_counter() - last_emit >= progress.min_interval:
+                last_emit = time.perf_counter()
+                progress.frames(progress_label, "compose", "video", done, frames, last_emit - started)
+        with render_profiler.span("write"):
+            writer.close()
+        writer = None
+    finally:
+        if writer is not None:
+            writer.kill()
+        for reader in readers:
+            reader.close()
+
+    return {
+        "frames_in_flight": count,
+        "buffer_mb": (background_pool.nbytes + overlay_pool.nbytes) / 1024 ** 2,
+    }
@@ -0,0 +1,542 @@
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+import uuid
+from multiprocessing import get_context
+from typing import Callable, Dict, List, Optional
+
+import render_profiler
+from progress_events import ProgressSink
+
+try:
+    import resource
+except ImportError:  # Windows, peak RSS is reported as None
+    resource = None
+
+JOB_STATES = ("queued", "running", "done", "failed")
+ACTIVE_STATES = ("queued", "running")
+
+# A running job's lease is renewed this often and lapses this long after the
+# last renewal; keep it well above the clock skew between machines
+HEARTBEAT_SECONDS = 10
+LEASE_SECONDS = 60
+
+# Runs of a job whose worker died before it is given up on
+MAX_ATTEMPTS = 3
+
+# Heartbeats of the workers, under the jobs folder
+WORKERS_DIR = "workers"
+
+# How often a job samples the resident memory of its processes
+RSS_SAMPLE_SECONDS = 0.5
+
+
+def _run_split(folder_path: str, config: Dict, progress: ProgressSink) -> Dict:
+    from encoding_profiles import stage_encoder
+    from raw_clips_generator import split_video
+    from render_cache import folder_cache
+    from video_config import require_valid
+
+    # Fail before any decode rather than minutes into the batch
+    require_valid(config, ("split",))
+    reports = split_video(
+        config.get("main_video_path"),
+        config.get("clips_config"),
+        config.get("output_folder"),
+        cut_mode=config.get("cut_mode", "reencode"),
+        workers=config.get("workers", 1),
+        thread_budget=config.get("thread_budget"),
+        cache=folder_cache(folder_path, config),
+        progress=progress,
+        segments=config.get("segments"),
+        audio=config.get("audio"),
+        encoder=stage_encoder(config, "split")
+    )
+    return {"reports": reports}
+
+
+def _run_pipeline(folder_path: str, config: Dict, progress: ProgressSink) -> Dict:
+    from pipeline import run_pipeline
+
+    results = run_pipeline(folder_path, config, progress=progress)
+    # Drop the echoed clip configs, the job file only needs the outcome
+    return {"results": [{k: v for k, v in item.items() if k != "clip_config"} for item in results]}
+
+
+def _run_upload(folder_path: str, config: Dict, progress: ProgressSink) -> Dict:
+    from upload_engine import upload_folder
+
+    return {"results": upload_folder(folder_path, config, progress=progress)}
+
+
+# Job kinds and what they run in the worker process
+JOB_KINDS: Dict[str, Callable[[str, Dict, ProgressSink], Dict]] = {
+    "split": _run_split,
+    "pipeline": _run_pipeline,
+    "upload": _run_upload,
+}
+
+
+def _write_json(path: str, data: Dict) -> None:
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(data, file, indent=2, default=str)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: str) -> Optional[Dict]:
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _export_profile(job: Dict) -> None:
+    """Turn a profiled job's spans into a Chrome trace and a per-stage summary."""
+    profiler = render_profiler.active()
+    if profiler is not None:
+        profiler.flush()
+    events = render_profiler.load_events(job["profile_path"]) if job.get("profile_path") else []
+    if not events:
+        return
+    job["trace_path"] = os.path.join(os.path.dirname(job["profile_path"]), f"{job['id']}.trace.json")
+    render_profiler.write_chrome_trace(events, job["trace_path"])
+    job["profile_summary"] = render_profiler.summarize(events)
+
+
+def _release_readers(job: Dict) -> None:
+    """Record how many media readers and ffmpeg processes the job left open, then close them."""
+    from reader_pool import close_readers, reader_stats
+
+    job["readers"] = reader_stats()
+    print(f"Media readers at exit: {job['readers']}")
+    close_readers()
+
+
+def _tree_rss_mb(root_pid: int) -> Optional[float]:
+    """Resident memory of a process and all its descendants (clip workers, ffmpeg), None without /proc."""
+    parents = {}
+    try:
+        names = os.listdir("/proc")
+    except FileNotFoundError:
+        return None
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", "r") as file:
+                # The command name may hold spaces, the fields after it don't
+                parents[int(name)] = int(file.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    tree, pending = set(), [root_pid]
+    while pending:
+        pid = pending.pop()
+        tree.add(pid)
+        pending += [child for child, parent in parents.items() if parent == pid and child not in tree]
+
+    page_kb = os.sysconf("SC_PAGE_SIZE") / 1024
+    total_kb = 0.0
+    for pid in tree:
+        try:
+            with open(f"/proc/{pid}/statm", "r") as file:
+                total_kb += int(file.read().split()[1]) * page_kb
+        except (OSError, IndexError, ValueError):
+            continue
+    return total_kb / 1024
+
+
+def _sample_peak_rss(job: Dict, stopped: threading.Event) -> None:
+    """Keep ``job["peak_rss_mb"]`` at the largest memory the job's process tree held at once."""
+    while True:
+        # One last sample once stopped, so jobs shorter than the interval are measured after their work too
+        done = stopped.wait(RSS_SAMPLE_SECONDS) if job.get("peak_rss_mb") is not None else False
+        rss = _tree_rss_mb(os.getpid())
+        if rss is None:
+            return
+        job["peak_rss_mb"] = max(job.get("peak_rss_mb") or 0.0, round(rss, 1))
+        if done:
+            return
+
+
+def _record_peak_rss(job: Dict) -> None:
+    """Record the job's peak RSS, what the scheduler packs later jobs of the folder by."""
+    if job.get("peak_rss_mb") is None and resource is not None:
+        # Without /proc: the largest single process, a lower bound of the tree's peak (ru_maxrss is in KB on Linux)
+        job["peak_rss_mb"] = round(max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        ) / 1024, 1)
+    print(f"Peak RSS: {job.get('peak_rss_mb')} MB")
+
+
+def _exit_with_parent(parent_pid: int) -> None:
+    """Stop a job whose manager died: its lease lapses and the job runs again elsewhere."""
+    while True:
+        time.sleep(HEARTBEAT_SECONDS)
+        if os.getppid() != parent_pid:
+            os._exit(1)
+
+
+def _job_process(job_path: str, parent_pid: int) -> None:
+    """Worker process entry point: run one job and record the outcome in its file."""
+    threading.Thread(target=_exit_with_parent, args=(parent_pid,), daemon=True).start()
+    job = _read_json(job_path)
+
+    # Output goes to the job's own log, so concurrent jobs never share a stdout
+    log = open(job["log_path"], "a", buffering=1)
+    sys.stdout = sys.stderr = log
+
+    job.update(status="running", pid=os.getpid(), started=time.time(), peak_rss_mb=None)
+    _write_json(job_path, job)
+    sampling = threading.Event()
+    sampler = threading.Thread(target=_sample_peak_rss, args=(job, sampling), daemon=True)
+    sampler.start()
+    try:
+        from video_config import load_config
+
+        config = load_config(os.path.join(job["folder_path"], "config.json"))
+        if config.get("profile") and job.get("profile_path"):
+            # Inherited by the split and compose worker processes
+            render_profiler.enable(job["profile_path"])
+        progress = ProgressSink(job["events_path"])
+        job["outputs"] = JOB_KINDS[job["kind"]](job["folder_path"], config, progress)
+        job["status"] = "done"
+    except Exception as e:
+        traceback.print_exc()
+        job.update(status="failed", error=f"{type(e).__name__}: {e}")
+    finally:
+        sampling.set()
+        sampler.join()
+        _record_peak_rss(job)
+        _release_readers(job)
+        _export_profile(job)
+        job["finished"] = time.time()
+        _write_json(job_path, job)
+        log.close()
+
+
+class JobManager:
+    """
+    A job queue in a shared folder, with the workers that render its jobs.
+
+    Every job is a JSON file under ``jobs_dir`` holding its state (queued,
+    running, done or failed), outputs, log path, progress events path (see
+    ``progress_events``) and, with ``"profile": true`` in the folder's
+    config.json, a Chrome trace and per-stage timing summary, so a page rerun or a
+    second browser tab reattaches to a job instead of starting it again.
+
+    Any number of managers on any number of machines can share ``jobs_dir``
+    (e.g. on the storage holding ``videos/``). Each runs up to
+    ``max_concurrent`` jobs in its own worker processes; with 0 it only
+    queues and watches jobs. A job is claimed by creating its lease file,
+    which is atomic even on network file systems, and the lease is renewed
+    every ``HEARTBEAT_SECONDS`` while the job runs. A job whose lease runs
+    out, because its machine or worker died, is queued again for another
+    worker until it has been tried ``MAX_ATTEMPTS`` times; a worker that
+    finds its lease taken over stops the job rather than run it twice.
+    Jobs of one folder run one at a time, since they write the same clips
+    and render cache; the queue waits behind a job whose folder is busy.
+
+    Every job records the peak RSS of its processes. With a
+    ``memory_budget_mb``, a manager only starts a job while the estimates
+    of its running jobs and the new one fit the budget, each estimate being
+    the peak of the folder's last finished job of that kind. A job without
+    one runs alone, and an idle manager always takes the next job.
+    """
+
+    def __init__(self, jobs_dir: str, max_concurrent: int = 1, poll_interval: float = 1.0,
+                 node: Optional[str] = None, memory_budget_mb: Optional[float] = None):
+        self.jobs_dir = jobs_dir
+        self.max_concurrent = max_concurrent
+        self.memory_budget_mb = memory_budget_mb
+        self.poll_interval = poll_interval
+        self.node = node or socket.gethostname()
+        self._context = get_context("spawn")
+        self._processes = {}
+        self._leases: Dict[str, Dict] = {}
+        # Peak RSS expected of each running job, see _memory_estimate
+        self._estimates: Dict[str, Optional[float]] = {}
+        self._lock = threading.Lock()
+        self._stopping = False
+        os.makedirs(os.path.join(jobs_dir, WORKERS_DIR), exist_ok=True)
+
+    def start(self) -> "JobManager":
+        """Schedule in a background thread."""
+        threading.Thread(target=self.serve_forever, name="job-scheduler", daemon=True).start()
+        return self
+
+    def serve_forever(self) -> None:
+        """Schedule until stop() is called, then hand the running jobs back to the queue."""
+        while not self._stopping:
+            try:
+                self._schedule()
+            except Exception:
+                traceback.print_exc()
+            time.sleep(self.poll_interval)
+        self._hand_back()
+
+    def stop(self) -> None:
+        """Stop claiming jobs; safe to call from a signal handler."""
+        self._stopping = True
+
+    def _hand_back(self) -> None:
+        """
+        Terminate this manager's worker processes and queue their jobs again
+        without counting the attempt, so another worker picks them up.
+        """
+        with self._lock:
+            for job_id, process in list(self._processes.items()):
+                process.terminate()
+                process.join()
+                job = self.get(job_id)
+                if job and job["status"] in ACTIVE_STATES:
+                    job.update(status="queued", attempts=max(0, job.get("attempts", 1) - 1))
+                    _write_json(self._job_path(job_id), job)
+                self._release(job_id)
+                del self._processes[job_id]
+            self._remove_heartbeat()
+
+    def submit(self, kind: str, folder_path: str) -> str:
+        """Queue a job, or return the active job of the same kind for that folder."""
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind '{kind}', expected one of {tuple(JOB_KINDS)}")
+
+        with self._lock:
+            active = self.active_job(folder_path, kind)
+            if active is not None:
+                return active["id"]
+
+            job_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+            job = {
+                "id": job_id,
+                "kind": kind,
+                "folder_path": folder_path,
+                "status": "queued",
+                "created": time.time(),
+                "attempts": 0,
+                "log_path": os.path.join(self.jobs_dir, f"{job_id}.log"),
+                "events_path": os.path.join(self.jobs_dir, f"{job_id}.events.jsonl"),
+                "profile_path": os.path.join(self.jobs_dir, f"{job_id}.profile.jsonl"),
+                "outputs": None,
+                "error": None,
+            }
+            _write_json(self._job_path(job_id), job)
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        return _read_json(self._job_path(job_id))
+
+    def jobs(self) -> List[Dict]:
+        """All known jobs, oldest first."""
+        # Job files are <id>.json, the job's other files (e.g. <id>.trace.json) have a second suffix
+        jobs = [_read_json(os.path.join(self.jobs_dir, name))
+                for name in os.listdir(self.jobs_dir) if name.endswith(".json") and name.count(".") == 1]
+        return sorted((job for job in jobs if job), key=lambda job: job["created"])
+
+    def active_job(self, folder_path: str, kind: Optional[str] = None) -> Optional[Dict]:
+        """The queued or running job of a folder, if any."""
+        for job in self.jobs():
+            if job["folder_path"] == folder_path and job["status"] in ACTIVE_STATES:
+                if kind is None or job["kind"] == kind:
+                    return job
+        return None
+
+    def workers(self) -> List[Dict]:
+        """Workers of every machine that sent a heartbeat within the lease time, busiest first."""
+        workers_dir = os.path.join(self.jobs_dir, WORKERS_DIR)
+        workers = [_read_json(os.path.join(workers_dir, name)) for name in os.listdir(workers_dir)
+                   if name.endswith(".json")]
+        now = time.time()
+        return sorted((worker for worker in workers if worker and worker["expires"] > now),
+                      key=lambda worker: -len(worker["running"]))
+
+    def read_log(self, job_id: str, max_lines: int = 50) -> str:
+        job = self.get(job_id)
+        if job is None or not os.path.exists(job["log_path"]):
+            return ""
+        with open(job["log_path"], "r", errors="replace") as file:
+            # MoviePy progress bars redraw with carriage returns, keep the latest state
+            lines = [line.split("\r")[-1] for line in file.read().split("\n")]
+        return "\n".join(lines[-max_lines:])
+
+    def _job_path(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def _lease_path(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, f"{job_id}.lease")
+
+    def _heartbeat_path(self) -> str:
+        return os.path.join(self.jobs_dir, WORKERS_DIR, f"{self.node}-{os.getpid()}.json")
+
+    def _claim(self, job_id: str) -> bool:
+        """Take the lease of a job, False when another worker holds it."""
+        lease = {"job": job_id, "node": self.node, "pid": os.getpid(), "token": uuid.uuid4().hex,
+                 "expires": time.time() + LEASE_SECONDS}
+        tmp_path = f"{self._lease_path(job_id)}.{self.node}.{os.getpid()}.tmp"
+        _write_json(tmp_path, lease)
+        try:
+            # A hard link appears complete and only if nothing is there yet
+            os.link(tmp_path, self._lease_path(job_id))
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+        self._leases[job_id] = lease
+        return True
+
+    def _renew(self, job_id: str) -> bool:
+        """Extend a held lease, False when it was taken over or removed."""
+        lease = self._leases[job_id]
+        current = _read_json(self._lease_path(job_id))
+        if current is None or current["token"] != lease["token"]:
+            return False
+        if lease["expires"] - time.time() < LEASE_SECONDS - HEARTBEAT_SECONDS:
+            lease["expires"] = time.time() + LEASE_SECONDS
+            _write_json(self._lease_path(job_id), lease)
+        return True
+
+    def _release(self, job_id: str) -> None:
+        lease = self._leases.pop(job_id, None)
+        current = _read_json(self._lease_path(job_id))
+        if lease is not None and current is not None and current["token"] == lease["token"]:
+            os.remove(self._lease_path(job_id))
+
+    def _expire(self, job: Dict) -> None:
+        """Queue a running job again, or fail it, when its worker stopped renewing the lease."""
+        lease_path = self._lease_path(job["id"])
+        lease = _read_json(lease_path)
+        if lease is not None and lease["expires"] > time.time():
+            return
+        if lease is not None or os.path.exists(lease_path):
+            # Only one of the managers noticing the expiry wins the rename
+            stale_path = f"{lease_path}.{self.node}.{os.getpid()}.stale"
+            try:
+                os.rename(lease_path, stale_path)
+            except FileNotFoundError:
+                return
+            os.remove(stale_path)
+
+        job = self.get(job["id"])
+        if job is None or job["status"] not in ACTIVE_STATES:
+            return
+        lost_on = job.get("node", "an unknown machine")
+        if job.get("attempts", 1) >= job.get("max_attempts", MAX_ATTEMPTS):
+            job.update(status="failed", error=f"Worker on {lost_on} stopped responding, tried {job['attempts']} times",
+                       finished=time.time())
+        else:
+            job.update(status="queued", pid=None, started=None)
+        _write_json(self._job_path(job["id"]), job)
+
+    def _memory_estimate(self, job: Dict, jobs: List[Dict]) -> Optional[float]:
+        """Peak RSS of the folder's latest finished job of the same kind, None before the first one."""
+        finished = [other for other in jobs if other["folder_path"] == job["folder_path"]
+                    and other["kind"] == job["kind"] and other["status"] == "done" and other.get("peak_rss_mb")]
+        return max(finished, key=lambda other: other["finished"])["peak_rss_mb"] if finished else None
+
+    def _fits_memory(self, estimate: Optional[float]) -> bool:
+        if self.memory_budget_mb is None or not self._processes:
+            return True
+        if estimate is None:
+            return False
+        reserved = [self._estimates.get(job_id) for job_id in self._processes]
+        if None in reserved:
+            return False
+        return sum(reserved) + estimate <= self.memory_budget_mb
+
+    def _write_heartbeat(self) -> None:
+        workers_dir = os.path.join(self.jobs_dir, WORKERS_DIR)
+        for name in os.listdir(workers_dir):
+            # Heartbeats of workers that are gone for good
+            worker = _read_json(os.path.join(workers_dir, name)) if name.endswith(".json") else None
+            if worker and worker["expires"] < time.time() - LEASE_SECONDS:
+                try:
+                    os.remove(os.path.join(workers_dir, name))
+                except FileNotFoundError:
+                    pass
+        _write_json(self._heartbeat_path(), {
+            "node": self.node,
+            "pid": os.getpid(),
+            "slots": self.max_concurrent,
+            "memory_budget_mb": self.memory_budget_mb,
+            "running": sorted(self._processes),
+            "expires": time.time() + LEASE_SECONDS,
+        })
+
+    def _remove_heartbeat(self) -> None:
+        try:
+            os.remove(self._heartbeat_path())
+        except FileNotFoundError:
+            pass
+
+    def _schedule(self) -> None:
+        with self._lock:
+            # Reap finished workers; a worker killed mid-job never wrote its outcome
+            for job_id, process in list(self._processes.items()):
+                if process.is_alive():
+                    if not self._renew(job_id):
+                        # Another manager gave the job to someone else, don't render it twice
+                        process.terminate()
+                        process.join()
+                        del self._processes[job_id]
+                        self._estimates.pop(job_id, None)
+                        self._leases.pop(job_id, None)
+                    continue
+                process.join()
+                del self._processes[job_id]
+                self._estimates.pop(job_id, None)
+                job = self.get(job_id)
+                if job and job["status"] in ACTIVE_STATES:
+                    job.update(status="failed", error=f"Worker exited with code {process.exitcode}",
+                               finished=time.time())
+                    _write_json(self._job_path(job_id), job)
+                self._release(job_id)
+
+            jobs = self.jobs()
+            for job in jobs:
+                if job["status"] == "running" and job["id"] not in self._processes:
+                    self._expire(job)
+
+            if self.max_concurrent > 0:
+                self._write_heartbeat()
+            busy_folders = {job["folder_path"] for job in jobs if job["status"] == "running"}
+            for job in jobs:
+                if len(self._processes) >= self.max_concurrent:
+                    break
+                job_id = job["id"]
+                if job["status"] != "queued" or job_id in self._processes:
+                    continue
+                if job["folder_path"] in busy_folders:
+                    # Jobs of one folder write the same clips and render cache, one at a time in queue order
+                    break
+                estimate = self._memory_estimate(job, jobs)
+                if not self._fits_memory(estimate):
+                    # Jobs start in queue order, a later smaller one doesn't overtake
+                    break
+                if not self._claim(job_id):
+                    continue
+                # The queue may have moved on since it was listed
+                job = self.get(job_id)
+                if job is None or job["status"] != "queued":
+                    self._release(job_id)
+                    continue
+                if any(other["folder_path"] == job["folder_path"] and other["status"] == "running"
+                       for other in self.jobs()):
+                    # Another manager started a job of the folder meanwhile
+                    self._release(job_id)
+                    break
+                job.update(status="running", node=self.node, attempts=job.get("attempts", 0) + 1,
+                           claimed=time.time(), memory_estimate_mb=estimate)
+                _write_json(self._job_path(job_id), job)
+                process = self._context.Process(
+                    target=_job_process, args=(self._job_path(job_id), os.getpid()), name=f"job-{job_id}"
+                )
+                process.start()
+                self._processes[job_id] = process
+                self._estimates[job_id] = estimate
+                busy_folders.add(job["folder_path"])
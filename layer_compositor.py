@@ -0,0 +1,248 @@
+import hashlib
+import os
+from functools import lru_cache
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from moviepy import TextClip
+
+from render_cache import file_fingerprint
+
+TITLE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "video_automation", "titles")
+TITLE_CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+Position = Tuple[int, int]
+FrameSource = Callable[[float], np.ndarray]
+
+
+def _visible_rect(position: Position, size: Tuple[int, int], frame_size: Tuple[int, int]):
+    """Destination and source slices of a layer clipped to the frame, None when off-screen."""
+    x, y = position
+    w, h = size
+    frame_w, frame_h = frame_size
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, frame_w), min(y + h, frame_h)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    dst = (slice(y0, y1), slice(x0, x1))
+    src = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+    return dst, src
+
+
+@lru_cache(maxsize=16)
+def _font_fingerprint(path: str, size: int, mtime_ns: int) -> str:
+    return file_fingerprint(path)
+
+
+def font_fingerprint(font: str) -> str:
+    """Content fingerprint of a font file, its name when it isn't a file; read once per process until it changes."""
+    if not font or not os.path.exists(font):
+        return str(font)
+    stat = os.stat(font)
+    return _font_fingerprint(os.path.abspath(font), stat.st_size, stat.st_mtime_ns)
+
+
+def rasterize_title_rgba(
+    text: str,
+    font: str,
+    font_size: int,
+    color: str,
+    width: int,
+    cache_dir: str = TITLE_CACHE_DIR,
+    max_bytes: int = TITLE_CACHE_MAX_BYTES
+) -> np.ndarray:
+    """
+    Rasterize a caption title to an RGBA uint8 array, cached on disk.
+
+    The cache key covers text, font (path and content), size, color and
+    wrap width, so a title is only rasterized again when one of them changes.
+    The cache is trimmed least-recently-used first once it exceeds ``max_bytes``.
+    """
+    font_id = font_fingerprint(font)
+    key = hashlib.sha256(
+        "\0".join([text, font_id, str(font_size), color, str(width)]).encode("utf8")
+    ).hexdigest()
+    cache_path = os.path.join(cache_dir, f"{key}.npy")
+    try:
+        rgba = np.load(cache_path)
+        # The modification time orders the cache for eviction, see evict_title_cache
+        os.utime(cache_path)
+        return rgba
+    except (FileNotFoundError, ValueError, EOFError):
+        # Not cached yet, or evicted under us by another render
+        pass
+
+    text_clip = TextClip(
+        text=text,
+        font_size=font_size,
+        color=color,
+        font=font,
+        size=(width, None),
+        method='caption'
+    )
+    try:
+        rgb = text_clip.get_frame(0).astype(np.uint8)
+        alpha = (255 * text_clip.mask.get_frame(0)).astype(np.uint8)
+    finally:
+        text_clip.close()
+    rgba = np.dstack([rgb, alpha])
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write then rename so concurrent renders never read a partial file
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, rgba)
+    os.replace(tmp_path, cache_path)
+    evict_title_cache(cache_dir, max_bytes)
+    return rgba
+
+
+def evict_title_cache(cache_dir: str = TITLE_CACHE_DIR, max_bytes: int = TITLE_CACHE_MAX_BYTES) -> None:
+    """Drop least recently used title rasters until the cache fits in ``max_bytes``."""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".npy") and ".tmp." not in entry.name:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        total -= size
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Another render evicted it first
+            pass
+
+
+def with_background_box(
+    rgba: np.ndarray,
+    padding: int,
+    color: Tuple[int, int, int] = (0, 0, 0),
+    opacity: float = 0.6
+) -> np.ndarray:
+    """
+    Flatten a title onto a padded semi-transparent box, once.
+
+    Same look as the ColorClip + CompositeVideoClip background box in
+    ``playground/combined_with_text_overlay.py``, but the two static layers
+    become a single RGBA image instead of two per-frame blends.
+    """
+    h, w = rgba.shape[:2]
+    box = np.zeros((h + 2 * padding, w + 2 * padding, 4), dtype=np.float32)
+    box[..., :3] = color
+    box[..., 3] = opacity
+
+    inner = box[padding:padding + h, padding:padding + w]
+    text_alpha = rgba[..., 3:4].astype(np.float32) / 255
+    inner[..., :3] = rgba[..., :3] * text_alpha + inner[..., :3] * (1 - text_alpha)
+    inner[..., 3:4] = text_alpha + inner[..., 3:4] * (1 - text_alpha)
+
+    box[..., 3] *= 255
+    return box.round().astype(np.uint8)
+
+
+class StaticLayer:
+    """
+    An RGBA image that never changes, blended into its bounding box only.
+
+    Premultiplied color and inverse alpha are computed once, and blending
+    reuses a scratch buffer, so a frame costs one multiply-add over the
+    layer's own pixels instead of a full-frame composite.
+    """
+
+    def __init__(self, rgba: np.ndarray, position: Position, frame_size: Tuple[int, int]):
+        self.position = position
+        self.size = (rgba.shape[1], rgba.shape[0])
+        self.rect = _visible_rect(position, self.size, frame_size)
+        if self.rect is None:
+            return
+
+        _, src = self.rect
+        visible = rgba[src]
+        self.opaque = bool((visible[..., 3] == 255).all())
+        if self.opaque:
+            # Nothing to blend, a plain copy of the pixels will do
+            self.pixels = np.ascontiguousarray(visible[..., :3])
+            return
+
+        alpha = visible[..., 3:4].astype(np.float32) / 255
+        self.premultiplied = visible[..., :3] * alpha
+        self.inverse_alpha = 1 - alpha
+        self.scratch = np.empty_like(self.premultiplied)
+
+    def blend_into(self, frame: np.ndarray) -> None:
+        if self.rect is None:
+            return
+        dst, _ = self.rect
+        region = frame[dst]
+        if self.opaque:
+            np.copyto(region, self.pixels)
+            return
+        np.multiply(region, self.inverse_alpha, out=self.scratch)
+        self.scratch += self.premultiplied
+        np.copyto(region, self.scratch, casting="unsafe")
+
+
+class LayerCompositor:
+    """
+    Composite a background, one moving layer and static layers into a
+    preallocated output frame.
+
+    Args:
+    size (Tuple[int, int]): Output (width, height).
+    background (FrameSource): Returns the full-size background frame at t.
+    overlay (FrameSource): Returns the moving layer at t, e.g. the resized clip.
+    overlay_position (Position): Top-left corner of the moving layer.
+    overlay_size (Tuple[int, int]): Size of the frames returned by ``overlay``.
+    underlays (List[StaticLayer]): Static layers below the moving layer (e.g. its margin).
+    layers (List[StaticLayer]): Static layers above it (e.g. the title).
+    """
+
+    def __init__(
+        self,
+        size: Tuple[int, int],
+        background: FrameSource,
+        overlay: FrameSource,
+        overlay_position: Position,
+        overlay_size: Tuple[int, int],
+        underlays: Optional[List[StaticLayer]] = None,
+        layers: Optional[List[StaticLayer]] = None
+    ):
+        width, height = size
+        self.size = size
+        self.background = background
+        self.overlay = overlay
+        self.overlay_rect = _visible_rect(overlay_position, overlay_size, size)
+        self.underlays = underlays or []
+        self.layers = layers or []
+        self.output = np.empty((height, width, 3), dtype=np.uint8)
+
+    def frame(self, t: float) -> np.ndarray:
+        """
+        Composite the frame at ``t``.
+
+        The returned array is reused for the next frame, which is safe for
+        ``write_videofile`` since it pipes each frame to ffmpeg right away.
+        """
+        np.copyto(self.output, self.background(t)[:self.size[1], :self.size[0]], casting="unsafe")
+        for layer in self.underlays:
+            layer.blend_into(self.output)
+        if self.overlay_rect is not None:
+            dst, src = self.overlay_rect
+            np.copyto(self.output[dst], self.overlay(t)[src], casting="unsafe")
+        for layer in self.layers:
+            layer.blend_into(self.output)
+        return self.output
+
+
+def solid_rgba(size: Tuple[int, int], color: Tuple[int, int, int] = (0, 0, 0)) -> np.ndarray:
+    """Opaque RGBA rectangle, e.g. the black margin behind the overlay."""
+    width, height = size
+    rgba = np.empty((height, width, 4), dtype=np.uint8)
+    rgba[..., :3] = color
+    rgba[..., 3] = 255
+    return rgba
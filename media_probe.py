@@ -0,0 +1,179 @@
+import json
+import os
+import re
+import subprocess
+import threading
+from bisect import bisect_right
+from typing import Dict, List, Optional
+
+from moviepy.config import FFMPEG_BINARY
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+from render_cache import file_fingerprint
+
+INDEX_DIR = ".media_index"
+
+# Bump when the index layout changes, older sidecars are rebuilt
+INDEX_VERSION = 2
+
+_PTS_TIME_RE = re.compile(r"pts_time:\s*([0-9.]+)")
+_AUDIO_CODEC_RE = re.compile(r"Stream #\d+:\d+.*?: Audio: (\w+)")
+
+# Indexes already read by this process, keyed by path
+_loaded: Dict[str, Dict] = {}
+_loaded_lock = threading.Lock()
+
+
+def list_keyframes(video_path: str) -> List[float]:
+    """
+    Return the presentation timestamps (seconds) of all video keyframes.
+
+    Only keyframes are decoded (``-skip_frame nokey``), so this is much
+    faster than a full decode of the source.
+
+    Args:
+    video_path (str): Path to the video file.
+    """
+    cmd = [
+        FFMPEG_BINARY, "-hide_banner", "-nostats",
+        "-skip_frame", "nokey",
+        "-i", video_path,
+        "-map", "0:v:0",
+        "-vf", "showinfo",
+        "-f", "null", "-",
+    ]
+    proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    if proc.returncode:
+        raise IOError(proc.stderr.decode("utf8", errors="replace"))
+
+    stderr = proc.stderr.decode("utf8", errors="replace")
+    return sorted(float(match) for match in _PTS_TIME_RE.findall(stderr))
+
+
+def _probe(video_path: str) -> Dict:
+    """ffmpeg_parse_infos plus the audio codec, which MoviePy doesn't report."""
+    infos = ffmpeg_parse_infos(video_path)
+    if infos.get("audio_found"):
+        proc = subprocess.run(
+            [FFMPEG_BINARY, "-hide_banner", "-i", video_path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL
+        )
+        match = _AUDIO_CODEC_RE.search(proc.stderr.decode("utf8", errors="replace"))
+        infos["audio_codec_name"] = match.group(1) if match else None
+    return infos
+
+
+def index_path_for(video_path: str) -> str:
+    """The index lives in a hidden folder next to the media it describes."""
+    video_path = os.path.abspath(video_path)
+    return os.path.join(os.path.dirname(video_path), INDEX_DIR, f"{os.path.basename(video_path)}.json")
+
+
+def _stat_key(video_path: str) -> List[int]:
+    stat = os.stat(video_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _read_index(index_path: str) -> Optional[Dict]:
+    try:
+        with open(index_path, "r") as file:
+            index = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    return index if index.get("version") == INDEX_VERSION else None
+
+
+def _write_index(index_path: str, index: Dict) -> None:
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    tmp_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(index, file)
+    os.replace(tmp_path, index_path)
+
+
+def media_index(video_path: str, with_keyframes: bool = False) -> Dict:
+    """
+    Sidecar metadata index of a media file, built on first use and reused
+    until the file changes.
+
+    The index holds what ``ffmpeg_parse_infos`` reports (duration, fps, size,
+    streams) plus ``audio_codec_name`` under ``infos`` and, once asked for, the keyframe timestamp table
+    under ``keyframes``. A matching size and mtime make it current without
+    reading the file; otherwise the content fingerprint decides, so a copied
+    or touched file keeps its index while a re-exported one is probed again.
+
+    Args:
+    video_path (str): Media file to describe.
+    with_keyframes (bool): Also build the keyframe table if it is missing.
+    """
+    index_path = index_path_for(video_path)
+    stat_key = _stat_key(video_path)
+
+    with _loaded_lock:
+        index = _loaded.get(index_path)
+    if index is None or index["stat"] != stat_key:
+        index = _read_index(index_path)
+    changed = False
+    if index is not None and index["stat"] != stat_key:
+        if index["fingerprint"] == file_fingerprint(video_path):
+            index["stat"] = stat_key
+            changed = True
+        else:
+            index = None
+
+    if index is None:
+        index = {
+            "version": INDEX_VERSION,
+            "stat": stat_key,
+            "fingerprint": file_fingerprint(video_path),
+            "infos": _probe(video_path),
+            "keyframes": None,
+        }
+        changed = True
+    if with_keyframes and index["keyframes"] is None and index["infos"].get("video_found"):
+        index["keyframes"] = list_keyframes(video_path)
+        changed = True
+
+    if changed:
+        _write_index(index_path, index)
+    with _loaded_lock:
+        _loaded[index_path] = index
+    return index
+
+
+def media_infos(video_path: str) -> Dict:
+    """Drop-in for ``ffmpeg_parse_infos`` served from the media index."""
+    return media_index(video_path)["infos"]
+
+
+def keyframe_times(video_path: str) -> List[float]:
+    """Keyframe timestamps (seconds) of a video from the media index, see list_keyframes."""
+    return media_index(video_path, with_keyframes=True)["keyframes"] or []
+
+
+def seek_with_keyframes(clip, keyframes: List[float]) -> None:
+    """
+    Make a MoviePy VideoFileClip reseek on a forward jump when that decodes
+    fewer frames than reading on.
+
+    MoviePy reads on through every frame of a jump of up to 100 frames.
+    A reseek lands on the last keyframe a second before the target, so
+    whenever that keyframe lies past the current frame the reseek decodes
+    less and skips piping the frames in between. Other jumps keep MoviePy's
+    own behaviour.
+    """
+    reader = clip.reader
+    get_frame = reader.get_frame
+
+    def keyframe_get_frame(t: float):
+        pos = reader.get_frame_number(t) + 1
+        if reader.proc and reader.pos + 1 < pos <= reader.pos + 100:
+            # ffmpeg's input seek of MoviePy's reader, see FFMPEG_VideoReader.initialize
+            landing_idx = bisect_right(keyframes, max(0.0, t - min(1.0, t))) - 1
+            if landing_idx >= 0 and keyframes[landing_idx] > (reader.pos - 1) / reader.fps:
+                reader.initialize(t)
+                return reader.last_read
+        return get_frame(t)
+
+    reader.get_frame = keyframe_get_frame
+
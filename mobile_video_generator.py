@@ -1,142 +1,999 @@
-from moviepy import VideoFileClip, CompositeVideoClip, TextClip, ColorClip
-from moviepy.video.fx import Resize, Margin
+from moviepy import VideoClip, VideoFileClip, CompositeAudioClip, CompositeVideoClip, TextClip
+from moviepy.video.fx import Loop, Resize, Margin
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import heapq
 import os
-import json
+import shutil
+import tempfile
+import time
+from contextlib import ExitStack, nullcontext
+from functools import partial
+import numpy as np
+from PIL import Image
+from ffmpeg_compose import compose_with_ffmpeg, fanout_with_ffmpeg
+from media_probe import media_infos
+from progress_events import ProgressSink
+from reader_pool import open_clip
+import render_profiler
+from encoding_profiles import crf_params, key_encoder
+from frame_pipeline import compose_stream
+from layer_compositor import (
+    LayerCompositor, StaticLayer, font_fingerprint, rasterize_title_rgba, solid_rgba, with_background_box
+)
+from render_cache import RenderCache, file_fingerprint, folder_cache
+from raw_clips_generator import threads_per_worker
+from segmented_render import mix_audio_tracks, render_segmented, segment_count, segment_range
+from smart_cut import mux
+from template_cache import DEFAULT_TEMPLATE_CACHE_MB, TemplateFrames, template_frames
 
+# Title text properties
+TITLE_FONT_SIZE = 70
+TITLE_COLOR = 'white'
+TITLE_FONT_PATH = "./vid_automation/Arial.ttf"  # Ensure this font is available on your system
+TITLE_PADDING = 10  # Padding in pixels
+TITLE_BACKGROUND_OPACITY = None  # e.g. 0.6 for a semi-transparent black box (ffmpeg and layers backends)
 
-def add_text_overlay(main_video_path: str, overlay_video_path: str, output_path: str, text: str):
-    # Load the main video (assumed to be 1080x1920)
-    main_clip = VideoFileClip(main_video_path)
-    main_width, main_height = main_clip.size
+# Encoder settings of the final clips, part of their render cache key; see encoding_profiles for the
+# profiles that replace the preset and rate control
+FINAL_CLIP_ENCODER = {"codec": "libx264", "audio_codec": "aac", "preset": "ultrafast"}
 
-    # Load the overlay video
-    overlay_clip = VideoFileClip(overlay_video_path)
-    overlay_width, overlay_height = overlay_clip.size
-    overlay_duration = overlay_clip.duration
 
-    # Clip start video template to same as overlay duration
-    main_clip = main_clip.subclipped(0, overlay_duration)
+# Layout of the 1080x1920 composition, shared by every backend
+OVERLAY_MARGIN = 10
+TITLE_WIDTH_RATIO = 0.8
+TITLE_Y_RATIO = 0.15
+
+COMPOSE_BACKENDS = ("moviepy", "ffmpeg", "layers", "stream")
+
+# Layout settings of an entry of config.json's "formats", the reel's layout by default
+OUTPUT_FORMAT = {
+    "overlay_scale": 1.0,
+    "title_y": TITLE_Y_RATIO,
+}
+
+
+def final_clip_cache_key(
+    main_video_path: str, overlay_video_path: str, text: str, backend: str = "moviepy", audio_passthrough: bool = False,
+    output_format: Optional[Dict] = None, encoder: Optional[Dict] = None
+) -> str:
+    """Render cache key of a final clip: template, raw clip, title, layout and encoder settings."""
+    # Only a passthrough or a non-default layout joins the key, so existing keys stay valid
+    extra = {"audio_passthrough": True} if audio_passthrough else {}
+    layout = {key: (output_format or {}).get(key, default) for key, default in OUTPUT_FORMAT.items()}
+    if layout != OUTPUT_FORMAT:
+        extra["layout"] = layout
+    return RenderCache.key_for(
+        kind="final_clip",
+        template=file_fingerprint(main_video_path),
+        overlay=file_fingerprint(overlay_video_path),
+        text=text,
+        font=font_fingerprint(TITLE_FONT_PATH),
+        font_size=TITLE_FONT_SIZE,
+        color=TITLE_COLOR,
+        title_background=TITLE_BACKGROUND_OPACITY,
+        backend=backend,
+        encoder=key_encoder(encoder or FINAL_CLIP_ENCODER),
+        **extra
+    )
+
+
+def compute_layout(
+    main_size: Tuple[int, int],
+    overlay_size: Tuple[int, int],
+    title_size: Optional[Tuple[int, int]] = None,
+    overlay_scale: float = 1.0,
+    title_y: float = TITLE_Y_RATIO
+) -> Dict:
+    """
+    Pixel layout of the composition: overlay fitted and centered with a
+    margin, title centered at 15% of the height.
+
+    Positions are truncated to ints the same way MoviePy's compositing does,
+    so every backend places layers on exactly the same pixels.
+
+    ``overlay_scale`` shrinks the fitted overlay and ``title_y`` moves the
+    title, for the layouts of other output formats (see ``OUTPUT_FORMAT``).
+    """
+    main_width, main_height = main_size
+    overlay_width, overlay_height = overlay_size
 
     # Calculate scaling factor to fit overlay within main video
-    scale_factor = min(main_width / overlay_width, main_height / overlay_height)
+    scale_factor = min(main_width / overlay_width, main_height / overlay_height) * overlay_scale
+    scaled_size = (int(overlay_width * scale_factor), int(overlay_height * scale_factor))
+    boxed_size = (scaled_size[0] + 2 * OVERLAY_MARGIN, scaled_size[1] + 2 * OVERLAY_MARGIN)
+
+    title_position = None
+    if title_size is not None:
+        title_position = (int((main_width - title_size[0]) / 2), int(main_height * title_y))
+
+    return {
+        "size": (main_width, main_height),
+        "scale_factor": scale_factor,
+        "overlay_size": scaled_size,
+        "margin": OVERLAY_MARGIN,
+        "overlay_position": (int((main_width - boxed_size[0]) / 2), int((main_height - boxed_size[1]) / 2)),
+        "title_width": int(main_width * TITLE_WIDTH_RATIO),
+        "title_position": title_position,
+    }
+
+
+def scale_layout(layout: Dict, factor: float, title_size: Optional[Tuple[int, int]] = None) -> Dict:
+    """
+    A layout from ``compute_layout`` shrunk by ``factor``, for draft renders.
 
-    # Resize overlay while maintaining aspect ratio
-    resized_overlay = overlay_clip.with_effects([Resize(scale_factor), Margin(10)])
+    Every position and size is the full resolution one scaled, so a draft
+    shows exactly the final composition with at most a pixel of rounding.
+    The output size stays even for yuv420p. ``title_size`` is the full
+    resolution title's size, its scaled size is returned as ``title_size``.
+    """
+    def scaled(value: float) -> int:
+        return max(1, int(round(value * factor)))
 
-    # Position the resized overlay at the center of the main video
-    positioned_overlay = resized_overlay.with_position(("center", "center"))
+    width, height = layout["size"]
+    return {
+        "size": (2 * scaled(width / 2), 2 * scaled(height / 2)),
+        "scale_factor": layout["scale_factor"] * factor,
+        "overlay_size": tuple(scaled(value) for value in layout["overlay_size"]),
+        "margin": scaled(layout["margin"]),
+        "overlay_position": tuple(int(round(value * factor)) for value in layout["overlay_position"]),
+        "title_width": scaled(layout["title_width"]),
+        "title_position": tuple(int(round(value * factor)) for value in layout["title_position"])
+        if layout["title_position"] is not None else None,
+        "title_size": tuple(scaled(value) for value in title_size) if title_size is not None else None,
+    }
 
-    # Define text properties
-    fontsize = 70
-    text_color = 'white'
-    font_path = font_path = "./vid_automation/Arial.ttf"  # Ensure this font is available on your system
-    #stroke_color = 'black'
-    #stroke_width = 2
 
-    # Create the text clip
-    text_clip = TextClip(
+def create_title_clip(text: str, width: int) -> TextClip:
+    """Caption-wrapped title clip, shared by every backend."""
+    return TextClip(
         text=text,
-        font_size=fontsize,
-        color=text_color,
-        font=font_path,
-        #stroke_color=stroke_color,
-        #stroke_width=stroke_width,
-        size=(int(main_width * 0.8), None),  # 80% of the main video width
+        font_size=TITLE_FONT_SIZE,
+        color=TITLE_COLOR,
+        font=TITLE_FONT_PATH,
+        size=(width, None),
         method='caption'
-    ).with_duration(overlay_duration)
-
-    # Calculate text position (10% below the top)
-    text_y_position = main_height * 0.15
-
-    # Create a background for the text with padding
-    padding = 10  # Padding in pixels
-    #text_background = ColorClip(
-    #    size=(text_clip.w + 2 * padding, text_clip.h + 2 * padding),
-    #    color=(0, 0, 0)  # Black background
-    #).with_opacity(0.6)  # Semi-transparent background
-
-    # Position the text on the background
-    #text_with_background = CompositeVideoClip(
-    #    [text_background, text_clip.with_position((padding, padding))],
-    #    size=text_background.size
-    #)
-
-    # Position the text_with_background on the main video
-    #text_with_background = text_with_background.with_position(
-    #    ('center', text_y_position)
-    #).with_duration(main_clip.duration)
-
-    # Create a composite video with the overlay and text
-    final_clip = CompositeVideoClip(
-        [main_clip, positioned_overlay, text_clip.with_position(('center', text_y_position))],
-        size=(main_width, main_height)
     )
 
-    # Export the final video
-    final_clip.write_videofile(output_path, codec="libx264", fps=main_clip.fps,  audio_codec="aac", preset="ultrafast")
 
-    # Close clips
-    main_clip.close()
-    overlay_clip.close()
-    resized_overlay.close()
-    text_clip.close()
-    #text_background.close()
-    #text_with_background.close()
-    final_clip.close()
+def title_rgba(text: str, width: int) -> np.ndarray:
+    """Rasterized title (with its optional background box) from the on-disk title cache."""
+    rgba = rasterize_title_rgba(text, TITLE_FONT_PATH, TITLE_FONT_SIZE, TITLE_COLOR, width)
+    if TITLE_BACKGROUND_OPACITY:
+        rgba = with_background_box(rgba, TITLE_PADDING, opacity=TITLE_BACKGROUND_OPACITY)
+    return rgba
 
 
-# Function to read JSON config file
-def load_config(file_path):
-    """Loads configuration from a JSON file."""
-    try:
-        with open(file_path, 'r') as file:
-            config = json.load(file)
-        return config
-    except FileNotFoundError:
-        print(f"Error: Config file '{file_path}' not found.")
-        return None
-    except json.JSONDecodeError:
-        print(f"Error: Invalid JSON format in '{file_path}'.")
-        return None
-    
-# Find a clip by name
-def find_clip_by_name(config, clip_name):
-    clips = config.get("clips_config", [])
+def rasterize_title(text: str, width: int, png_path: str) -> Tuple[int, int]:
+    """Write the title as an RGBA PNG and return its size."""
+    rgba = title_rgba(text, width)
+    Image.fromarray(rgba, mode="RGBA").save(png_path)
+    return rgba.shape[1], rgba.shape[0]
+
+
+def _moviepy_logger(progress: Optional[ProgressSink], progress_label: str):
+    """Structured progress events when a sink is given, MoviePy's console bar otherwise."""
+    return progress.logger(progress_label, "compose") if progress else "bar"
+
+
+def _instrument_decode(main_clip: VideoFileClip, overlay_clip: VideoFileClip) -> None:
+    """Time every frame decoded from the template and the overlay when profiling."""
+    main_clip.reader.get_frame = render_profiler.instrument("decode template", main_clip.reader.get_frame)
+    overlay_clip.reader.get_frame = render_profiler.instrument("decode overlay", overlay_clip.reader.get_frame)
+
+
+def loop_template(main_clip: VideoFileClip, duration: float) -> VideoFileClip:
+    """The first ``duration`` seconds of the template, looped when it is shorter."""
+    if main_clip.duration >= duration:
+        return main_clip.subclipped(0, duration)
+    return main_clip.with_effects([Loop(duration=duration)])
+
+
+def add_text_overlay(
+    main_video_path: str,
+    overlay_video_path: str,
+    output_path: str,
+    text: str,
+    cache: Optional[RenderCache] = None,
+    backend: str = "moviepy",
+    threads: Optional[int] = None,
+    progress: Optional[ProgressSink] = None,
+    progress_label: Optional[str] = None,
+    segments: Optional[int] = None,
+    audio_passthrough: bool = False,
+    encoder: Optional[Dict] = None
+):
+    """
+    Place a raw clip and its title on the background template.
+
+    Args:
+    main_video_path (str): Background template (assumed to be 1080x1920),
+        looped when shorter than the raw clip.
+    overlay_video_path (str): Raw clip to place in the middle.
+    output_path (str): Destination file.
+    text (str): Title shown at 15% height.
+    cache (RenderCache): Skip the render when the output is up to date.
+    backend (str): "moviepy" composites frames in Python, "ffmpeg" compiles
+        the same layout into one native filtergraph, "layers" blends the
+        cached static title into a preallocated frame buffer, "stream"
+        decodes both videos at their final size into a fixed pool of frame
+        buffers and composites in place (see ``frame_pipeline``).
+    threads (int): Encoder thread limit, None lets x264 decide.
+    progress (ProgressSink): Receives "compose" stage and frame progress events.
+    progress_label (str): Clip name of the events, the output file name by default.
+    segments (int): Render long outputs as this many parts in parallel
+        processes, joined without re-encoding (see ``segmented_render``).
+    audio_passthrough (bool): Copy the raw clip's AAC audio into the output
+        instead of re-encoding it, when the template is silent so there is
+        nothing to mix.
+    encoder (Dict): Encoder settings of the output, ``FINAL_CLIP_ENCODER``
+        by default (see ``encoding_profiles.stage_encoder``). Its ``threads``
+        replace ``threads``.
+    """
+    if backend not in COMPOSE_BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {COMPOSE_BACKENDS}")
+    progress_label = progress_label or Path(output_path).stem
+    encoder = encoder or FINAL_CLIP_ENCODER
+    threads = encoder.get("threads") or threads
+
+    # Skip the render when neither the inputs nor the title changed
+    if cache is not None:
+        cache_key = final_clip_cache_key(
+            main_video_path, overlay_video_path, text, backend, audio_passthrough, encoder=encoder
+        )
+        if cache.lookup(output_path, cache_key) is not None:
+            print(f"{output_path} is up to date, skipping.")
+            if progress is not None:
+                progress.emit(clip=progress_label, stage="compose", status="cached")
+            return
+
+    with progress.stage(progress_label, "compose") if progress else nullcontext(), \
+            render_profiler.span("compose", clip=progress_label, backend=backend):
+        duration = media_infos(overlay_video_path)["duration"]
+        fps = media_infos(main_video_path)["video_fps"]
+        parts = segment_count(duration, segments)
+        audio_source = _passthrough_audio_source(main_video_path, overlay_video_path) if audio_passthrough else None
+        # MoviePy's audio reader fails on the wrapped times of a looped template, so ffmpeg mixes that audio
+        looped = backend in ("moviepy", "layers") and media_infos(main_video_path)["duration"] < duration
+        if parts > 1:
+            render_segmented(
+                _render_segment,
+                (main_video_path, overlay_video_path, text, backend, encoder),
+                duration,
+                fps,
+                parts,
+                output_path,
+                partial(_existing_audio, audio_source) if audio_source else
+                partial(mix_audio_tracks, [main_video_path, overlay_video_path], duration),
+                threads=threads_per_worker(parts, threads),
+                progress=progress,
+                progress_label=progress_label,
+                shortest=not audio_source
+            )
+        elif audio_source or looped:
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as workdir:
+                # The whole output as one video-only segment, then the clip's audio packets copied in
+                # or both tracks mixed
+                video_only = os.path.join(workdir, "video.mp4")
+                _renderer(backend)(
+                    main_video_path, overlay_video_path, video_only, text, threads, progress, progress_label,
+                    (0, int(duration * fps)), encoder
+                )
+                with render_profiler.span("audio"):
+                    audio_path = audio_source or mix_audio_tracks(
+                        [main_video_path, overlay_video_path], duration, video_only + ".m4a"
+                    )
+                with render_profiler.span("mux"):
+                    mux(video_only, audio_path, output_path, shortest=not audio_source)
+        else:
+            _renderer(backend)(
+                main_video_path, overlay_video_path, output_path, text, threads, progress, progress_label,
+                encoder=encoder
+            )
+
+    if cache is not None:
+        cache.store(output_path, cache_key)
+
+
+def _batch_backend(backend: str, supported: Tuple[str, ...]) -> str:
+    """The backend a batch renders with: ``backend`` when it supports batches, "layers" otherwise."""
+    if backend in supported:
+        return backend
+    print(f"The '{backend}' backend can't share decoded frames across a batch, rendering with 'layers' instead.")
+    return "layers"
+
+
+def compose_formats(
+    overlay_video_path: str,
+    outputs: List[Dict],
+    text: str,
+    cache: Optional[RenderCache] = None,
+    backend: str = "moviepy",
+    threads: Optional[int] = None,
+    progress: Optional[ProgressSink] = None,
+    progress_label: Optional[str] = None,
+    audio_passthrough: bool = False,
+    encoder: Optional[Dict] = None
+) -> None:
+    """
+    Place a raw clip and its title on several templates, decoding the clip once.
+
+    Every output is a format of its own (e.g. 9:16 reel, 1:1 and 16:9) with
+    its template's size and frame rate and the layout of its
+    ``overlay_scale`` and ``title_y`` (see ``OUTPUT_FORMAT``). The "ffmpeg"
+    backend splits the decoded clip to one filtergraph chain and encoder per
+    output in a single ffmpeg process; "layers" feeds the frames of one
+    decoder to a layer compositor and writer per output. "moviepy" and
+    "stream" render through "layers" here, since a MoviePy composite or
+    frame stream per output would decode the clip again, and say so when
+    they do.
+
+    Args:
+    overlay_video_path (str): Raw clip to place on every template.
+    outputs (List[Dict]): ``template``, ``output_path`` and optionally
+        ``overlay_scale`` and ``title_y`` of every format.
+    text (str): Title of every format.
+    cache (RenderCache): Skip the outputs that are up to date.
+    backend (str): See add_text_overlay.
+    threads (int): Encoder thread limit of each output, None lets x264 decide.
+    progress (ProgressSink): Receives "compose" stage and frame progress events.
+    progress_label (str): Clip name of the events, the first output's file name by default.
+    audio_passthrough (bool): See add_text_overlay.
+    encoder (Dict): Encoder settings of every output, see add_text_overlay.
+    """
+    if backend not in COMPOSE_BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {COMPOSE_BACKENDS}")
+    progress_label = progress_label or Path(outputs[0]["output_path"]).stem
+    encoder = encoder or FINAL_CLIP_ENCODER
+    threads = encoder.get("threads") or threads
+    render_backend = _batch_backend(backend, ("ffmpeg", "layers"))
+    outputs = [dict(OUTPUT_FORMAT, **output) for output in outputs]
+
+    keys = {}
+    if cache is not None:
+        for output in outputs:
+            keys[output["output_path"]] = final_clip_cache_key(
+                output["template"], overlay_video_path, text, render_backend, audio_passthrough, output, encoder
+            )
+        pending = [output for output in outputs if cache.lookup(output["output_path"], keys[output["output_path"]]) is None]
+        for output in outputs:
+            if output not in pending:
+                print(f"{output['output_path']} is up to date, skipping.")
+        if not pending:
+            if progress is not None:
+                progress.emit(clip=progress_label, stage="compose", status="cached")
+            return
+        outputs = pending
+
+    with progress.stage(progress_label, "compose") if progress else nullcontext(), \
+            render_profiler.span("compose formats", clip=progress_label, backend=render_backend, formats=len(outputs)):
+        fanout = _fanout_ffmpeg if render_backend == "ffmpeg" else _fanout_layers
+        fanout(overlay_video_path, outputs, text, threads, progress, progress_label, audio_passthrough, encoder)
+
+    if cache is not None:
+        for output in outputs:
+            cache.store(output["output_path"], keys[output["output_path"]])
+
+
+def _fanout_ffmpeg(
+    overlay_video_path: str,
+    outputs: List[Dict],
+    text: str,
+    threads: Optional[int],
+    progress: Optional[ProgressSink],
+    progress_label: str,
+    audio_passthrough: bool,
+    encoder: Dict
+) -> None:
+    overlay_infos = media_infos(overlay_video_path)
+    with tempfile.TemporaryDirectory() as workdir:
+        renders = []
+        for idx, output in enumerate(outputs):
+            main_infos = media_infos(output["template"])
+            title_width = compute_layout(main_infos["video_size"], overlay_infos["video_size"])["title_width"]
+            title_png = os.path.join(workdir, f"title{idx}.png")
+            with render_profiler.span("title"):
+                title_size = rasterize_title(text, title_width, title_png)
+            renders.append({
+                "template": output["template"],
+                "title_png": title_png,
+                "layout": compute_layout(
+                    main_infos["video_size"], overlay_infos["video_size"], title_size,
+                    output["overlay_scale"], output["title_y"]
+                ),
+                "fps": main_infos["video_fps"],
+                "template_audio": main_infos["audio_found"],
+                "template_duration": main_infos["duration"],
+                "copy_audio": bool(audio_passthrough and _passthrough_audio_source(output["template"], overlay_video_path)),
+                "output_path": output["output_path"],
+            })
+
+        # Decode, filtering and every encode happen inside one ffmpeg, so they are one span
+        with render_profiler.span("ffmpeg filtergraph"):
+            fanout_with_ffmpeg(
+                overlay_video_path,
+                renders,
+                duration=overlay_infos["duration"],
+                overlay_audio=overlay_infos["audio_found"],
+                encoder=encoder,
+                threads=threads,
+                progress=progress,
+                progress_label=progress_label
+            )
+
+
+def _fanout_layers(
+    overlay_video_path: str,
+    outputs: List[Dict],
+    text: str,
+    threads: Optional[int],
+    progress: Optional[ProgressSink],
+    progress_label: str,
+    audio_passthrough: bool,
+    encoder: Dict
+) -> None:
+    with ExitStack() as leases:
+        with render_profiler.span("open inputs"):
+            overlay_clip = leases.enter_context(open_clip(overlay_video_path))
+            main_clips = [leases.enter_context(open_clip(output["template"])) for output in outputs]
+        duration = overlay_clip.duration
+        overlay_clip.reader.get_frame = render_profiler.instrument("decode overlay", overlay_clip.reader.get_frame)
+
+        workdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outputs[0]["output_path"])))
+        renders = []
+        try:
+            for idx, (output, main_clip) in enumerate(zip(outputs, main_clips)):
+                main_clip.reader.get_frame = render_profiler.instrument("decode template", main_clip.reader.get_frame)
+                main_clip = loop_template(main_clip, duration)
+                with render_profiler.span("title"):
+                    title = title_rgba(text, compute_layout(main_clip.size, overlay_clip.size)["title_width"])
+                layout = compute_layout(
+                    main_clip.size, overlay_clip.size, (title.shape[1], title.shape[0]),
+                    output["overlay_scale"], output["title_y"]
+                )
+
+                # Copies of the same clip share its reader, which returns the frame it
+                # decoded last without decoding again, so every format gets the same decode
+                resized_overlay = overlay_clip.with_effects([Resize(layout["scale_factor"])])
+                margin = layout["margin"]
+                box_x, box_y = layout["overlay_position"]
+                box_size = (layout["overlay_size"][0] + 2 * margin, layout["overlay_size"][1] + 2 * margin)
+                compositor = LayerCompositor(
+                    main_clip.size,
+                    background=main_clip.get_frame,
+                    overlay=resized_overlay.get_frame,
+                    overlay_position=(box_x + margin, box_y + margin),
+                    overlay_size=layout["overlay_size"],
+                    underlays=[StaticLayer(solid_rgba(box_size), (box_x, box_y), main_clip.size)],
+                    layers=[StaticLayer(title, layout["title_position"], main_clip.size)]
+                )
+                video_path = os.path.join(workdir, f"video{idx}.mp4")
+                renders.append({
+                    "frame": render_profiler.instrument("composite", compositor.frame, output=idx),
+                    "fps": main_clip.fps,
+                    "video_path": video_path,
+                    "writer": FFMPEG_VideoWriter(
+                        video_path, main_clip.size, main_clip.fps, codec=encoder["codec"],
+                        preset=encoder["preset"], threads=threads, ffmpeg_params=crf_params(encoder)
+                    ),
+                })
+
+            # Frames of every output in time order, so the shared reader only ever reads on
+            schedule = heapq.merge(*[
+                [(frame / render["fps"], idx) for frame in range(int(duration * render["fps"]))]
+                for idx, render in enumerate(renders)
+            ])
+            total = sum(int(duration * render["fps"]) for render in renders)
+            started = last_emit = time.perf_counter()
+            with render_profiler.span("write"):
+                for done, (t, idx) in enumerate(schedule, 1):
+                    renders[idx]["writer"].write_frame(renders[idx]["frame"](t))
+                    if progress is not None and time.perf_counter() - last_emit >= progress.min_interval:
+                        last_emit = time.perf_counter()
+                        progress.frames(progress_label, "compose", "video", done, total, last_emit - started)
+                for render in renders:
+                    render["writer"].close()
+
+            for output, main_clip, render in zip(outputs, main_clips, renders):
+                audio_source = _passthrough_audio_source(output["template"], overlay_video_path) \
+                    if audio_passthrough else None
+                with render_profiler.span("audio"):
+                    audio_path = audio_source or mix_audio_tracks(
+                        [output["template"], overlay_video_path], duration, render["video_path"] + ".m4a"
+                    )
+                with render_profiler.span("mux"):
+                    mux(render["video_path"], audio_path, output["output_path"], shortest=not audio_source)
+        finally:
+            for render in renders:
+                render["writer"].close()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compose_clips(
+    main_video_path: str,
+    clips: List[Dict],
+    cache: Optional[RenderCache] = None,
+    backend: str = "moviepy",
+    threads: Optional[int] = None,
+    progress: Optional[ProgressSink] = None,
+    audio_passthrough: bool = False,
+    encoder: Optional[Dict] = None,
+    template_cache_mb: float = DEFAULT_TEMPLATE_CACHE_MB
+) -> None:
+    """
+    Place every raw clip of a batch and its title on one background template.
+
+    The template is decoded once into a memory-mapped frame store (see
+    ``template_cache``) that every clip reads its background from, looping
+    it when a clip is longer, instead of each clip decoding the template
+    again from its first frame. Titles are rasterized and the layout's
+    static layers built once for the batch. "layers" composites through
+    the layer compositor, and so does "moviepy" here, which says so as a
+    MoviePy composite can't read the shared template; "ffmpeg" and
+    "stream" decode the template themselves, so their clips render one by
+    one as add_text_overlay.
+    Templates whose frames exceed ``template_cache_mb`` are decoded per clip
+    the same way.
+
+    Args:
+    main_video_path (str): Background template of every clip.
+    clips (List[Dict]): ``overlay`` (raw clip path), ``output_path`` and
+        ``title`` of every clip.
+    cache (RenderCache): Skip the clips that are up to date.
+    backend (str): See add_text_overlay.
+    threads (int): Encoder thread limit, None lets x264 decide.
+    progress (ProgressSink): Receives "compose" stage and frame progress
+        events, labelled by output file name.
+    audio_passthrough (bool): See add_text_overlay.
+    encoder (Dict): See add_text_overlay.
+    template_cache_mb (float): Size limit of the decoded template.
+    """
+    if backend not in COMPOSE_BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {COMPOSE_BACKENDS}")
+    encoder = encoder or FINAL_CLIP_ENCODER
+    threads = encoder.get("threads") or threads
+    render_backend = _batch_backend(backend, ("ffmpeg", "layers", "stream"))
+
+    pending = []
     for clip in clips:
-        if clip.get("name") == clip_name:
-            return clip  # Return the clip details
-    return None  # Return None if not found
+        key = final_clip_cache_key(
+            main_video_path, clip["overlay"], clip["title"], render_backend, audio_passthrough, encoder=encoder
+        ) if cache is not None else None
+        if key is not None and cache.lookup(clip["output_path"], key) is not None:
+            print(f"{clip['output_path']} is up to date, skipping.")
+            if progress is not None:
+                progress.emit(clip=Path(clip["output_path"]).stem, stage="compose", status="cached")
+            continue
+        pending.append(dict(clip, key=key))
+    if not pending:
+        return
+
+    frames = None
+    if render_backend == "layers":
+        with render_profiler.span("decode template"):
+            frames = template_frames(
+                main_video_path, max(media_infos(clip["overlay"])["duration"] for clip in pending), template_cache_mb
+            )
+    if frames is None:
+        for clip in pending:
+            add_text_overlay(
+                main_video_path, clip["overlay"], clip["output_path"], clip["title"], backend=render_backend,
+                threads=threads, progress=progress, audio_passthrough=audio_passthrough, encoder=encoder
+            )
+            if cache is not None:
+                cache.store(clip["output_path"], clip["key"])
+        return
+
+    # Titles and the static layers of each layout, once for the batch
+    title_width = compute_layout(frames.size, media_infos(pending[0]["overlay"])["video_size"])["title_width"]
+    with render_profiler.span("title"):
+        titles = {title: title_rgba(title, title_width) for title in {clip["title"] for clip in pending}}
+    margin_boxes: Dict[Tuple, StaticLayer] = {}
+    for clip in pending:
+        label = Path(clip["output_path"]).stem
+        with progress.stage(label, "compose") if progress else nullcontext(), \
+                render_profiler.span("compose", clip=label, backend="layers", batch=True):
+            _compose_on_frames(
+                frames, main_video_path, clip["overlay"], clip["output_path"], titles[clip["title"]], margin_boxes,
+                encoder, threads, progress, label, audio_passthrough
+            )
+        if cache is not None:
+            cache.store(clip["output_path"], clip["key"])
+
+
+def _compose_on_frames(
+    frames: TemplateFrames,
+    main_video_path: str,
+    overlay_video_path: str,
+    output_path: str,
+    title: np.ndarray,
+    margin_boxes: Dict[Tuple, StaticLayer],
+    encoder: Dict,
+    threads: Optional[int],
+    progress: Optional[ProgressSink],
+    progress_label: str,
+    audio_passthrough: bool
+) -> None:
+    """One clip of compose_clips, with the background read from the decoded template."""
+    with open_clip(overlay_video_path) as overlay_clip:
+        duration = overlay_clip.duration
+        overlay_clip.reader.get_frame = render_profiler.instrument("decode overlay", overlay_clip.reader.get_frame)
+        layout = compute_layout(frames.size, overlay_clip.size, (title.shape[1], title.shape[0]))
+        margin = layout["margin"]
+        box_x, box_y = layout["overlay_position"]
+        box_key = (layout["overlay_position"], layout["overlay_size"])
+        if box_key not in margin_boxes:
+            box_size = (layout["overlay_size"][0] + 2 * margin, layout["overlay_size"][1] + 2 * margin)
+            margin_boxes[box_key] = StaticLayer(solid_rgba(box_size), (box_x, box_y), frames.size)
+        resized_overlay = overlay_clip.with_effects([Resize(layout["scale_factor"])])
+        compositor = LayerCompositor(
+            frames.size,
+            background=render_profiler.instrument("template frames", frames.get_frame),
+            overlay=resized_overlay.get_frame,
+            overlay_position=(box_x + margin, box_y + margin),
+            overlay_size=layout["overlay_size"],
+            underlays=[margin_boxes[box_key]],
+            layers=[StaticLayer(title, layout["title_position"], frames.size)]
+        )
+        frame = render_profiler.instrument("composite", compositor.frame)
+
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as workdir:
+            video_path = os.path.join(workdir, "video.mp4")
+            total = int(duration * frames.fps)
+            writer = FFMPEG_VideoWriter(
+                video_path, frames.size, frames.fps, codec=encoder["codec"], preset=encoder["preset"],
+                threads=threads, ffmpeg_params=crf_params(encoder)
+            )
+            try:
+                started = last_emit = time.perf_counter()
+                with render_profiler.span("write"):
+                    for done in range(1, total + 1):
+                        writer.write_frame(frame((done - 1) / frames.fps))
+                        if progress is not None and time.perf_counter() - last_emit >= progress.min_interval:
+                            last_emit = time.perf_counter()
+                            progress.frames(progress_label, "compose", "video", done, total, last_emit - started)
+            finally:
+                writer.close()
+
+            audio_source = _passthrough_audio_source(main_video_path, overlay_video_path) if audio_passthrough else None
+            with render_profiler.span("audio"):
+                audio_path = audio_source or mix_audio_tracks(
+                    [main_video_path, overlay_video_path], duration, video_path + ".m4a"
+                )
+            with render_profiler.span("mux"):
+                mux(video_path, audio_path, output_path, shortest=not audio_source)
+
+
+def _passthrough_audio_source(main_video_path: str, overlay_video_path: str) -> Optional[str]:
+    """The raw clip, when its AAC audio can be the output's audio as is: the template has none to mix in."""
+    if media_infos(main_video_path).get("audio_found"):
+        return None
+    return overlay_video_path if media_infos(overlay_video_path).get("audio_codec_name") == "aac" else None
+
+
+def _existing_audio(audio_path: str, output_path: str) -> str:
+    """render_audio of a segmented render whose audio is muxed from an existing file."""
+    return audio_path
+
+
+def _renderer(backend: str):
+    return {
+        "ffmpeg": _add_text_overlay_ffmpeg,
+        "layers": _add_text_overlay_layers,
+        "moviepy": _add_text_overlay_moviepy,
+        "stream": _add_text_overlay_stream,
+    }[backend]
+
+
+def _render_segment(
+    main_video_path: str,
+    overlay_video_path: str,
+    text: str,
+    backend: str,
+    encoder: Dict,
+    first_frame: int,
+    frames: int,
+    part_path: str,
+    threads: Optional[int]
+):
+    """Segment worker of a segmented render: the video of frames [first_frame, first_frame + frames)."""
+    with render_profiler.span("segment", first_frame=first_frame, frames=frames):
+        _renderer(backend)(
+            main_video_path, overlay_video_path, part_path, text, threads, None, "", (first_frame, frames), encoder
+        )
+
+
+def _add_text_overlay_ffmpeg(
+    main_video_path: str,
+    overlay_video_path: str,
+    output_path: str,
+    text: str,
+    threads: Optional[int] = None,
+    progress: Optional[ProgressSink] = None,
+    progress_label: str = "",
+    segment: Optional[Tuple[int, int]] = None,
+    encoder: Dict = FINAL_CLIP_ENCODER
+):
+    main_infos = media_infos(main_video_path)
+    overlay_infos = media_infos(overlay_video_path)
+
+    main_width, main_height = main_infos["video_size"]
+    title_width = compute_layout(main_infos["video_size"], overlay_infos["video_size"])["title_width"]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # The title is static, so rasterize it once instead of blending a clip per frame
+        title_png = os.path.join(workdir, "title.png")
+        with render_profiler.span("title"):
+            title_size = rasterize_title(text, title_width, title_png)
+        layout = compute_layout((main_width, main_height), overlay_infos["video_size"], title_size)
+
+        fps = main_infos["video_fps"]
+        duration = overlay_infos["duration"]
+        audio_inputs = (main_infos["audio_found"], overlay_infos["audio_found"])
+        start, frames = 0.0, None
+        if segment is not None:
+            # Video only, the segmented render mixes the audio once for the whole output
+            start, frames = segment[0] / fps, segment[1]
+            duration = frames / fps
+            audio_inputs = (False, False)
+
+        # Decode, filtering and encode all happen inside ffmpeg, so they are one span
+        with render_profiler.span("ffmpeg filtergraph"):
+            compose_with_ffmpeg(
+                main_video_path,
+                overlay_video_path,
+                output_path,
+                title_png,
+                layout,
+                duration=duration,
+                fps=fps,
+                audio_inputs=audio_inputs,
+                encoder=encoder,
+                threads=threads,
+                progress=progress,
+                progress_label=progress_label,
+                start=start,
+                frames=frames,
+                template_duration=main_infos["duration"]
+            )
+
+
+def _add_text_overlay_layers(
+    main_video_path: str,
+    overlay_video_path: str,
+    output_path: str,
+    text: str,
+    threads: Optional[int] = None,
+    progress: Optional[ProgressSink] = None,
+    progress_label: str = "",
+    segment: Optional[Tuple[int, int]] = None,
+    encoder: Dict = FINAL_CLIP_ENCODER
+):
+    with ExitStack() as leases:
+        with render_profiler.span("open inputs"):
+            main_clip = leases.enter_context(open_clip(main_video_path))
+            overlay_clip = leases.enter_context(open_clip(overlay_video_path))
+        overlay_duration = overlay_clip.duration
+        _instrument_decode(main_clip, overlay_clip)
+
+        # Clip start video template to same as overlay duration
+        main_clip = loop_template(main_clip, overlay_duration)
+
+        with render_profiler.span("title"):
+            title = title_rgba(text, compute_layout(main_clip.size, overlay_clip.size)["title_width"])
+        layout = compute_layout(main_clip.size, overlay_clip.size, (title.shape[1], title.shape[0]))
+
+        # Only the overlay is resized per frame, its margin is a static black box underneath
+        resized_overlay = overlay_clip.with_effects([Resize(layout["scale_factor"])])
+        resized_overlay.frame_function = render_profiler.instrument("resize", resized_overlay.frame_function)
+        margin = layout["margin"]
+        box_x, box_y = layout["overlay_position"]
+        box_size = (layout["overlay_size"][0] + 2 * margin, layout["overlay_size"][1] + 2 * margin)
+
+        compositor = LayerCompositor(
+            main_clip.size,
+            background=main_clip.get_frame,
+            overlay=resized_overlay.get_frame,
+            overlay_position=(box_x + margin, box_y + margin),
+            overlay_size=layout["overlay_size"],
+            underlays=[StaticLayer(solid_rgba(box_size), (box_x, box_y), main_clip.size)],
+            layers=[StaticLayer(title, layout["title_position"], main_clip.size)]
+        )
+
+        # Same audio as CompositeVideoClip would produce: both tracks mixed
+        audio_tracks = [clip.audio for clip in (main_clip, overlay_clip) if clip.audio is not None]
+        final_clip = VideoClip(render_profiler.instrument("composite", compositor.frame), duration=overlay_duration)
+        if segment is not None:
+            # Video only, the segmented render mixes the audio once for the whole output
+            start, length = segment_range(*segment, main_clip.fps)
+            final_clip = final_clip.subclipped(start).with_duration(length)
+        elif audio_tracks:
+            final_clip = final_clip.with_audio(CompositeAudioClip(audio_tracks))
+
+        # Encode plus audio, what is left after the nested composite spans
+        with render_profiler.span("write"):
+            final_clip.write_videofile(
+                output_path,
+                codec=encoder["codec"],
+                fps=main_clip.fps,
+                audio_codec=encoder["audio_codec"],
+                preset=encoder["preset"],
+                threads=threads,
+                ffmpeg_params=crf_params(encoder),
+                logger=_moviepy_logger(progress, progress_label)
+            )
+
+
+def _add_text_overlay_stream(
+    main_video_path: str,
+    overlay_video_path: str,
+    output_path: str,
+    text: str,
+    threads: Optional[int] = None,
+    progress: Optional[ProgressSink] = None,
+    progress_label: str = "",
+    segment: Optional[Tuple[int, int]] = None,
+    encoder: Dict = FINAL_CLIP_ENCODER
+):
+    main_infos = media_infos(main_video_path)
+    overlay_infos = media_infos(overlay_video_path)
+    size = tuple(main_infos["video_size"])
+    fps = main_infos["video_fps"]
+    duration = overlay_infos["duration"]
+
+    with render_profiler.span("title"):
+        title = title_rgba(text, compute_layout(size, overlay_infos["video_size"])["title_width"])
+    layout = compute_layout(size, overlay_infos["video_size"], (title.shape[1], title.shape[0]))
+    margin = layout["margin"]
+    box_x, box_y = layout["overlay_position"]
+    box_size = (layout["overlay_size"][0] + 2 * margin, layout["overlay_size"][1] + 2 * margin)
+
+    first_frame, frames = segment if segment is not None else (0, int(duration * fps))
+    stream = partial(
+        compose_stream,
+        main_video_path,
+        overlay_video_path,
+        size=size,
+        overlay_size=layout["overlay_size"],
+        overlay_position=(box_x + margin, box_y + margin),
+        fps=fps,
+        frames=frames,
+        encoder=encoder,
+        threads=threads,
+        underlays=[StaticLayer(solid_rgba(box_size), (box_x, box_y), size)],
+        layers=[StaticLayer(title, layout["title_position"], size)],
+        start=first_frame / fps,
+        background_duration=main_infos["duration"],
+        progress=progress,
+        progress_label=progress_label
+    )
+    if segment is not None:
+        # Video only, the segmented render mixes the audio once for the whole output
+        stream(output_path)
+        return
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as workdir:
+        video_path = os.path.join(workdir, "video.mp4")
+        stream(video_path)
+        # Same audio as CompositeVideoClip would produce: both tracks mixed
+        with render_profiler.span("audio"):
+            audio_path = mix_audio_tracks([main_video_path, overlay_video_path], duration, video_path + ".m4a")
+        with render_profiler.span("mux"):
+            mux(video_path, audio_path, output_path)
+
+
+def _add_text_overlay_moviepy(
+    main_video_path: str,
+    overlay_video_path: str,
+    output_path: str,
+    text: str,
+    threads: Optional[int] = None,
+    progress: Optional[ProgressSink] = None,
+    progress_label: str = "",
+    segment: Optional[Tuple[int, int]] = None,
+    encoder: Dict = FINAL_CLIP_ENCODER
+):
+    with ExitStack() as leases:
+        with render_profiler.span("open inputs"):
+            # Load the main video (assumed to be 1080x1920)
+            main_clip = leases.enter_context(open_clip(main_video_path))
+
+            # Load the overlay video
+            overlay_clip = leases.enter_context(open_clip(overlay_video_path))
+        main_width, main_height = main_clip.size
+        overlay_duration = overlay_clip.duration
+        _instrument_decode(main_clip, overlay_clip)
+
+        # Clip start video template to same as overlay duration
+        main_clip = loop_template(main_clip, overlay_duration)
+
+        # Create the text clip, 80% of the main video width
+        layout = compute_layout(main_clip.size, overlay_clip.size)
+        with render_profiler.span("title"):
+            text_clip = create_title_clip(text, layout["title_width"]).with_duration(overlay_duration)
+        layout = compute_layout(main_clip.size, overlay_clip.size, text_clip.size)
+
+        # Resize overlay while maintaining aspect ratio
+        resized_overlay = overlay_clip.with_effects([Resize(layout["scale_factor"]), Margin(layout["margin"])])
+        resized_overlay.frame_function = render_profiler.instrument("resize + margin", resized_overlay.frame_function)
+
+        # Position the resized overlay at the center of the main video
+        positioned_overlay = resized_overlay.with_position(layout["overlay_position"])
+
+        # Create a composite video with the overlay and text (15% below the top)
+        final_clip = CompositeVideoClip(
+            [main_clip, positioned_overlay, text_clip.with_position(layout["title_position"])],
+            size=(main_width, main_height)
+        )
+        final_clip.frame_function = render_profiler.instrument("composite", final_clip.frame_function)
+        if segment is not None:
+            # Video only, the segmented render mixes the audio once for the whole output
+            start, length = segment_range(*segment, main_clip.fps)
+            final_clip = final_clip.subclipped(start).with_duration(length).without_audio()
+
+        # Export the final video; the write span's own time is encode plus audio
+        with render_profiler.span("write"):
+            final_clip.write_videofile(
+                output_path,
+                codec=encoder["codec"],
+                fps=main_clip.fps,
+                audio_codec=encoder["audio_codec"],
+                preset=encoder["preset"],
+                threads=threads,
+                ffmpeg_params=crf_params(encoder),
+                logger=_moviepy_logger(progress, progress_label)
+            )
+
+        # Close clips, the pool keeps the template and overlay readers
+        text_clip.close()
+        final_clip.close()
+
 
 if __name__ == "__main__":
-    raw_clips_dir = "./vid_automation/video1/raw_clips"
-    main_video = "./vid_automation/video1/raw_clips/start.mp4"
-    overlay_video = "./vid_automation/video1/raw_clips/clip1.mp4"
-    output_video = "./vid_automation/video1/final/final_clip1.mp4"
-    
-    config = load_config('./vid_automation/video1/config.json')
-    clips_config = config.get('clips_config')
-    overlay_text = find_clip_by_name(config, "clip1")["title"]
-
-    # Ensure input files exist
-    if not Path(main_video).exists():
-        raise FileNotFoundError(f"Main video {main_video} not found!")
-    if not Path(overlay_video).exists():
-        raise FileNotFoundError(f"Overlay video {overlay_video} not found!")
-    
-    # List all files in the directory
-    #try:
-        #raw_clips = os.listdir(raw_clips_dir)
-        #for clip in raw_clips:
-        #    print(clip)
-        #    if clip.startswith('clip'):
-        #        clip_name = clip.split(".")[0]
-        #        final_video_name = f"./vid_automation/video1/final/final_{clip}"
-        #        video_title = find_clip_by_name(config, clip_name)["title"]
-        #        #add_text_overlay(main_video, clip, final_video_name, video_title)
-        #        print(f"Processed video saved as {final_video_name} - {video_title}")
-    #except FileNotFoundError:
-    #    print(f"Error: raw clicps directory '{raw_clips_dir}' does not exist.")
-
-    add_text_overlay(main_video, overlay_video, output_video, overlay_text)
-    print(f"Processed video saved as {output_video}")
+    import argparse
+
+    from encoding_profiles import stage_encoder, untuned_stages
+    from frame_pipeline import set_memory_limit
+    from pipeline import final_path_for
+    from video_config import ConfigError, load_config, require_valid, template_path_for
+
+    parser = argparse.ArgumentParser(
+        description="Compose the reel of every split clip of a video folder, decoding the template once."
+    )
+    parser.add_argument("folder", nargs="?", default="./vid_automation/video1",
+                        help="Video folder containing config.json, e.g. videos/video1")
+    args = parser.parse_args()
+
+    try:
+        config = load_config(os.path.join(args.folder, "config.json"))
+        require_valid(config, ("compose",))
+    except ConfigError as e:
+        raise SystemExit("\n".join(e.problems))
+    for stage in untuned_stages(config, ("compose",)):
+        print(f"No auto-tuned {stage} profile on this machine, using the built-in encoder settings")
+    final_folder = config.get("final_folder", os.path.join(args.folder, "final"))
+    os.makedirs(final_folder, exist_ok=True)
+    set_memory_limit(config.get("memory_limit_mb"))
+
+    clips = []
+    for clip_config in config["clips_config"]:
+        overlay_video = os.path.join(config["output_folder"], f"{clip_config['name']}.mp4")
+        if not Path(overlay_video).exists():
+            print(f"Raw clip {overlay_video} not found, split the folder first. Skipping.")
+            continue
+        clips.append({
+            "overlay": overlay_video,
+            "output_path": final_path_for(final_folder, clip_config["name"]),
+            "title": clip_config["title"],
+        })
+
+    compose_clips(
+        template_path_for(config), clips,
+        cache=folder_cache(args.folder, config), backend=config.get("compose_backend", "moviepy"),
+        audio_passthrough=(config.get("audio") or {}).get("passthrough", False),
+        encoder=stage_encoder(config, "compose"),
+        template_cache_mb=config.get("template_cache_mb", DEFAULT_TEMPLATE_CACHE_MB)
+    )
+    for clip in clips:
+        print(f"Processed video saved as {clip['output_path']} - {clip['title']}")
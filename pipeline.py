@@ -0,0 +1,359 @@
+import argparse
+import os
+import queue
+import threading
+import time
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Callable, Dict, List, Optional
+
+from encoding_profiles import stage_encoder, untuned_stages
+from frame_pipeline import set_memory_limit
+from mobile_video_generator import add_text_overlay, compose_formats, final_clip_cache_key
+from progress_events import ProgressSink
+import render_profiler
+from raw_clips_generator import split_clip, threads_per_worker
+from render_cache import folder_cache
+from audio_track import plan_clip_audio
+from media_probe import keyframe_times
+from video_config import (
+    REEL_FORMAT, ConfigError, clip_formats, clip_index, load_config, require_valid, template_path_for
+)
+
+STAGES = ("split", "compose", "upload")
+
+DEFAULT_PIPELINE = {
+    "split_workers": 2,
+    "compose_workers": 2,
+    "upload_workers": 1,
+    "queue_size": 2,
+    "upload": False,
+}
+
+# Marks the end of a stage's input
+_DONE = object()
+
+
+def _compose_worker(
+    template_path: str,
+    raw_clip_path: str,
+    final_path: str,
+    title: str,
+    backend: str,
+    threads: int,
+    progress: Optional[ProgressSink],
+    clip_name: str,
+    segments: Optional[int] = None,
+    audio_passthrough: bool = False,
+    encoder: Optional[Dict] = None
+):
+    """Process pool entry point of the compose stage."""
+    add_text_overlay(
+        template_path, raw_clip_path, final_path, title,
+        backend=backend, threads=threads, progress=progress, progress_label=clip_name, segments=segments,
+        audio_passthrough=audio_passthrough, encoder=encoder
+    )
+
+
+def _compose_formats_worker(
+    raw_clip_path: str,
+    outputs: List[Dict],
+    title: str,
+    backend: str,
+    threads: int,
+    progress: Optional[ProgressSink],
+    clip_name: str,
+    audio_passthrough: bool = False,
+    encoder: Optional[Dict] = None
+):
+    """Process pool entry point of the compose stage for clips with several output formats."""
+    compose_formats(
+        raw_clip_path, outputs, title,
+        backend=backend, threads=threads, progress=progress, progress_label=clip_name,
+        audio_passthrough=audio_passthrough, encoder=encoder
+    )
+
+
+def final_path_for(final_folder: str, clip_name: str, format_name: str = REEL_FORMAT) -> str:
+    """Final clip of a format: final_<clip>.mp4 for the reel, final_<clip>_<format>.mp4 otherwise."""
+    suffix = "" if format_name == REEL_FORMAT else f"_{format_name}"
+    return os.path.join(final_folder, f"final_{clip_name}{suffix}.mp4")
+
+
+class _Stage:
+    """
+    A pool of threads pulling clips from a bounded inbox and pushing them to
+    the next stage's bounded outbox.
+
+    The inbox bound is what makes the pipeline stream: a fast stage blocks
+    once the next stage is ``queue_size`` clips behind, instead of finishing
+    the whole batch first.
+    """
+
+    def __init__(self, name: str, workers: int, work: Callable[[Dict], None], inbox: queue.Queue, outbox: queue.Queue):
+        self.name = name
+        self.work = work
+        self.inbox = inbox
+        self.outbox = outbox
+        self._remaining = workers
+        self._lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self._run, name=f"{name}-{idx}", daemon=True)
+            for idx in range(workers)
+        ]
+
+    def start(self) -> None:
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self) -> None:
+        while True:
+            item = self.inbox.get()
+            if item is _DONE:
+                # Let sibling workers see the end marker too, the last one forwards it
+                self.inbox.put(_DONE)
+                with self._lock:
+                    self._remaining -= 1
+                    last = self._remaining == 0
+                if last:
+                    self.outbox.put(_DONE)
+                return
+
+            if item["status"] == "ok":
+                started = time.perf_counter()
+                try:
+                    self.work(item)
+                except Exception as e:
+                    item.update(status="failed", failed_stage=self.name, error=f"{type(e).__name__}: {e}")
+                item["timings"][self.name] = time.perf_counter() - started
+            self.outbox.put(item)
+
+
+def run_pipeline(
+    folder_path: str,
+    config: Dict,
+    upload: Optional[bool] = None,
+    uploader=None,
+    progress: Optional[ProgressSink] = None
+) -> List[Dict]:
+    """
+    Stream every clip of a folder through split -> compose -> upload.
+
+    Each stage has its own worker count and bounded queues connect them, so
+    clip 1 is composed (and uploaded) while clip 2 is still being cut and the
+    wall time approaches that of the slowest stage rather than the sum.
+    Settings come from the ``pipeline`` section of ``config.json`` (see
+    ``DEFAULT_PIPELINE``). Split and compose run in process pools; cache
+    bookkeeping stays in this process.
+
+    Args:
+    folder_path (str): Video folder containing config.json.
+    config (Dict): The folder's parsed config.
+    upload (bool): Override the config's ``upload`` flag.
+    uploader (UploadEngine): Upload engine, built from the config on first upload if None.
+    progress (ProgressSink): Receives per-clip stage and frame progress events.
+
+    Returns:
+    List[Dict]: One result per clip in config order with status, output
+        paths, the failing stage (if any) and per-stage timings.
+    """
+    settings = dict(DEFAULT_PIPELINE, **config.get("pipeline", {}))
+    if upload is not None:
+        settings["upload"] = upload
+    enabled = [stage for stage in STAGES if stage != "upload" or settings["upload"]]
+    # Fail before any decode rather than minutes into the batch
+    require_valid(config, enabled)
+
+    main_video_path = config.get("main_video_path")
+    output_folder = config.get("output_folder")
+    template_path = template_path_for(config)
+    final_folder = config.get("final_folder", os.path.join(folder_path, "final"))
+    cut_mode = config.get("cut_mode", "reencode")
+    backend = config.get("compose_backend", "moviepy")
+    segments = config.get("segments")
+    audio = config.get("audio")
+    audio_passthrough = bool(audio and audio.get("passthrough"))
+    cache = folder_cache(folder_path, config)
+    os.makedirs(final_folder, exist_ok=True)
+
+    # Encoders of the split and compose stages share the thread budget, unless their profile sets threads
+    threads = threads_per_worker(
+        settings["split_workers"] + settings["compose_workers"], config.get("thread_budget")
+    )
+    split_encoder = stage_encoder(config, "split")
+    compose_encoder = stage_encoder(config, "compose")
+    keyframes = keyframe_times(main_video_path) if cut_mode != "reencode" else None
+    audio_plans = {}
+    if audio is not None:
+        # One pass over the source track for every clip, before clips render in parallel
+        with render_profiler.span("plan audio"):
+            audio_plans = dict(zip(
+                clip_index(config),
+                plan_clip_audio(
+                    main_video_path,
+                    [(clip_config["start_time"], clip_config["end_time"]) for clip_config in config["clips_config"]],
+                    audio
+                )
+            ))
+    # Frame buffer ceiling of "stream" composes, read by the workers spawned below
+    set_memory_limit(config.get("memory_limit_mb"))
+    context = get_context("spawn")
+    split_pool = ProcessPoolExecutor(max_workers=settings["split_workers"], mp_context=context)
+    compose_pool = ProcessPoolExecutor(max_workers=settings["compose_workers"], mp_context=context)
+    uploader_lock = threading.Lock()
+
+    def split(item: Dict) -> None:
+        report = split_clip(
+            main_video_path, item["clip_config"], output_folder,
+            cut_mode=cut_mode, keyframes=keyframes, threads=threads, cache=cache, executor=split_pool,
+            progress=progress, segments=segments, audio=audio, audio_plan=audio_plans.get(item["name"]),
+            encoder=split_encoder
+        )
+        if report["status"] != "ok":
+            raise RuntimeError(report["error"])
+        item["raw_clip"] = report["output_path"]
+
+    def compose(item: Dict) -> None:
+        formats = clip_formats(config, item["clip_config"])
+        if list(formats) != [REEL_FORMAT] or formats[REEL_FORMAT].keys() != {"template_video"}:
+            compose_formats_of(item, formats)
+            return
+        title = item["clip_config"]["title"]
+        final_path = final_path_for(final_folder, item["name"])
+        key = final_clip_cache_key(
+            template_path, item["raw_clip"], title, backend, audio_passthrough, encoder=compose_encoder
+        )
+        if cache.lookup(final_path, key) is None:
+            compose_pool.submit(
+                _compose_worker, template_path, item["raw_clip"], final_path, title, backend, threads, progress, item["name"],
+                segments, audio_passthrough, compose_encoder
+            ).result()
+            cache.store(final_path, key)
+        elif progress is not None:
+            progress.emit(clip=item["name"], stage="compose", status="cached")
+        item["final_clip"] = final_path
+
+    def compose_formats_of(item: Dict, formats: Dict[str, Dict]) -> None:
+        # Every format of the clip from one decode of the raw clip, segments don't apply
+        title = item["clip_config"]["title"]
+        render_backend = "ffmpeg" if backend == "ffmpeg" else "layers"
+        outputs = []
+        for name, spec in formats.items():
+            output = {
+                "template": spec["template_video"],
+                "output_path": final_path_for(final_folder, item["name"], name),
+                **{key: spec[key] for key in ("overlay_scale", "title_y") if key in spec},
+            }
+            output["key"] = final_clip_cache_key(
+                output["template"], item["raw_clip"], title, render_backend, audio_passthrough, output,
+                compose_encoder
+            )
+            outputs.append(output)
+
+        pending = [output for output in outputs if cache.lookup(output["output_path"], output["key"]) is None]
+        if pending:
+            compose_pool.submit(
+                _compose_formats_worker, item["raw_clip"],
+                [{key: value for key, value in output.items() if key != "key"} for output in pending],
+                title, render_backend, threads, progress, item["name"], audio_passthrough, compose_encoder
+            ).result()
+            for output in pending:
+                cache.store(output["output_path"], output["key"])
+        elif progress is not None:
+            progress.emit(clip=item["name"], stage="compose", status="cached")
+        item["final_clips"] = {name: output["output_path"] for name, output in zip(formats, outputs)}
+        # Uploads take the reel, or the first format of clips without one
+        item["final_clip"] = item["final_clips"].get(REEL_FORMAT, outputs[0]["output_path"])
+
+    def publish(item: Dict) -> None:
+        nonlocal uploader
+        from upload_engine import DEFAULT_UPLOAD, engine_for_folder, video_metadata
+
+        # Authenticate once, the first upload to get here does it for everybody
+        with uploader_lock:
+            if uploader is None:
+                uploader = engine_for_folder(folder_path, config)
+        upload_settings = dict(DEFAULT_UPLOAD, **config.get("upload", {}))
+        with progress.stage(item["name"], "upload") if progress else nullcontext():
+            item["video_id"] = uploader.upload(
+                item["final_clip"], video_metadata(item["clip_config"], upload_settings), progress, item["name"]
+            )
+
+    stage_work = {"split": split, "compose": compose, "upload": publish}
+    queues = [queue.Queue(maxsize=settings["queue_size"]) for _ in range(len(enabled) + 1)]
+    stages = [
+        _Stage(name, max(1, settings[f"{name}_workers"]), stage_work[name], queues[idx], queues[idx + 1])
+        for idx, name in enumerate(enabled)
+    ]
+
+    clips = config.get("clips_config", [])
+    started = time.perf_counter()
+    try:
+        for stage in stages:
+            stage.start()
+
+        # Feed from a thread so results can be drained while the inbox is full
+        def feed() -> None:
+            for clip_config in clips:
+                queues[0].put({
+                    "name": clip_config.get("name"),
+                    "clip_config": clip_config,
+                    "status": "ok",
+                    "timings": {},
+                })
+            queues[0].put(_DONE)
+
+        threading.Thread(target=feed, name="feed", daemon=True).start()
+
+        results = {}
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                break
+            results[item["name"]] = item
+            if item["status"] == "ok":
+                print(f"Clip '{item['name']}' finished: " + ", ".join(
+                    f"{stage} {seconds:.1f}s" for stage, seconds in item["timings"].items()
+                ))
+            else:
+                print(f"Clip '{item['name']}' failed in {item['failed_stage']}: {item['error']}")
+    finally:
+        split_pool.shutdown(cancel_futures=True)
+        compose_pool.shutdown(cancel_futures=True)
+
+    wall = time.perf_counter() - started
+    busiest = {stage.name: sum(item["timings"].get(stage.name, 0) for item in results.values()) for stage in stages}
+    print(f"Pipeline finished in {wall:.1f}s (stage totals: " + ", ".join(
+        f"{name} {seconds:.1f}s" for name, seconds in busiest.items()
+    ) + ")")
+
+    return [results[clip_config.get("name")] for clip_config in clips]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split, compose and optionally upload every clip of a video folder.")
+    parser.add_argument("folder", help="Video folder containing config.json, e.g. videos/video1")
+    parser.add_argument("--upload", action="store_true", help="Upload final clips to YouTube")
+    parser.add_argument("--profile", metavar="TRACE", help="Write a Chrome trace of every render stage to TRACE")
+    args = parser.parse_args()
+
+    try:
+        config = load_config(os.path.join(args.folder, "config.json"))
+        require_valid(config, [stage for stage in STAGES if stage != "upload" or args.upload])
+    except ConfigError as e:
+        raise SystemExit("\n".join(e.problems))
+    for stage in untuned_stages(config):
+        print(f"No auto-tuned {stage} profile on this machine, using the built-in encoder settings")
+    if args.profile:
+        events_path = f"{args.profile}.jsonl"
+        if os.path.exists(events_path):
+            os.remove(events_path)
+        render_profiler.enable(events_path)
+    run_pipeline(args.folder, config, upload=args.upload or None)
+    if args.profile:
+        render_profiler.active().flush()
+        events = render_profiler.load_events(events_path)
+        render_profiler.write_chrome_trace(events, args.profile)
+        for stage in render_profiler.summarize(events):
+            print(f"{stage['stage']:<20} {stage['self_ms'] / 1000:8.2f}s self  {stage['calls']:6d} calls")
@@ -1,36 +1,55 @@
-from moviepy import VideoFileClip, CompositeVideoClip
-from moviepy.video.fx import Resize
+import os
+import sys
+import tempfile
 from pathlib import Path
 
-def combine_videos(main_video_path: str, overlay_video_path: str, output_path: str):
-    # Load the main video (assumed to be 1080x1920)
-    main_clip = VideoFileClip(main_video_path)
-    main_width, main_height = main_clip.size
+# The frame pipeline lives at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-    # Load the overlay video
-    overlay_clip = VideoFileClip(overlay_video_path)
-    overlay_width, overlay_height = overlay_clip.size
+from frame_pipeline import compose_stream
+from media_probe import media_infos
+from segmented_render import mix_audio_tracks
+from smart_cut import mux
 
-    # Calculate scaling factor to fit overlay within main video
-    scale_factor = min(main_width / overlay_width, main_height / overlay_height)
+def combine_videos(main_video_path: str, overlay_video_path: str, output_path: str):
+    # Main video (assumed to be 1080x1920) and overlay video, composited as a stream of
+    # pooled frame buffers instead of new arrays per frame
+    main_infos = media_infos(main_video_path)
+    overlay_infos = media_infos(overlay_video_path)
+    main_width, main_height = main_infos["video_size"]
+    overlay_width, overlay_height = overlay_infos["video_size"]
+    fps = main_infos["video_fps"]
+    # As long as the longer of the two, like a composite of both clips; unlike one, a shorter main
+    # video and its audio loop and a shorter overlay holds its last frame, as in the reel pipeline
+    duration = max(main_infos["duration"], overlay_infos["duration"])
 
-    # Resize overlay while maintaining aspect ratio
-    resized_overlay = overlay_clip.with_effects([Resize(scale_factor)])
+    # Calculate scaling factor to fit overlay within main video, ffmpeg resizes while decoding
+    scale_factor = min(main_width / overlay_width, main_height / overlay_height)
+    overlay_size = (int(overlay_width * scale_factor), int(overlay_height * scale_factor))
 
     # Position the resized overlay at the center of the main video
-    positioned_overlay = resized_overlay.with_position(("center", "center"))
-
-    # Create a composite video with the overlay on top of the main video
-    final_clip = CompositeVideoClip([main_clip, positioned_overlay], size=(main_width, main_height))
-
-    # Export the final video
-    final_clip.write_videofile(output_path, codec="libx264", fps=main_clip.fps, audio_codec="aac", preset="ultrafast")
+    overlay_position = (int((main_width - overlay_size[0]) / 2), int((main_height - overlay_size[1]) / 2))
 
-    # Close clips
-    main_clip.close()
-    overlay_clip.close()
-    resized_overlay.close()
-    final_clip.close()
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as workdir:
+        video_path = os.path.join(workdir, "video.mp4")
+        compose_stream(
+            main_video_path,
+            overlay_video_path,
+            video_path,
+            size=(main_width, main_height),
+            overlay_size=overlay_size,
+            overlay_position=overlay_position,
+            fps=fps,
+            frames=int(duration * fps),
+            encoder={"codec": "libx264", "preset": "ultrafast"},
+            background_duration=main_infos["duration"]
+        )
+        # Export the final video with both audio tracks mixed; the overlay's audio ends with it
+        # instead of repeating under its last frame
+        audio_path = mix_audio_tracks(
+            [main_video_path, overlay_video_path], duration, video_path + ".m4a", loop=[True, False]
+        )
+        mux(video_path, audio_path, output_path)
 
 if __name__ == "__main__":
     main_video = "./vid_automation/clips/start.mp4"
@@ -0,0 +1,112 @@
+import glob
+import hashlib
+import json
+import os
+from typing import Dict, Optional
+
+from moviepy.config import FFMPEG_BINARY
+from moviepy.tools import subprocess_call
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+from render_cache import file_fingerprint
+
+PREVIEW_DIR = ".previews"
+
+# Small enough to stream dozens of clips, sharp enough to judge a cut
+PREVIEW_SETTINGS = {
+    "height": 360,
+    "video_bitrate": "400k",
+    "audio_bitrate": "64k",
+    "preset": "veryfast",
+    "poster_quality": 5,
+}
+
+
+def _ffmpeg(args) -> None:
+    subprocess_call([FFMPEG_BINARY, "-y", "-hide_banner", *args], logger=None)
+
+
+def preview_dir_for(video_path: str) -> str:
+    """Previews live in a hidden folder next to the clip they preview."""
+    return os.path.join(os.path.dirname(os.path.abspath(video_path)), PREVIEW_DIR)
+
+
+def _preview_key(video_path: str, settings: Dict) -> str:
+    # The clip's content and the preview settings, so re-rendering a clip or
+    # changing the settings invalidates its previews
+    payload = json.dumps({"source": file_fingerprint(video_path), "settings": settings}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf8")).hexdigest()[:16]
+
+
+def _preview_paths(video_path: str, settings: Dict, preview_dir: Optional[str]) -> Dict[str, str]:
+    preview_dir = preview_dir or preview_dir_for(video_path)
+    stem = os.path.splitext(os.path.basename(video_path))[0]
+    base = os.path.join(preview_dir, f"{stem}.{_preview_key(video_path, settings)}")
+    return {"proxy": f"{base}.mp4", "poster": f"{base}.jpg"}
+
+
+def _remove_stale(path: str, video_path: str) -> None:
+    """Drop previews of older versions of the same clip."""
+    stem = os.path.splitext(os.path.basename(video_path))[0]
+    extension = os.path.splitext(path)[1]
+    pattern = os.path.join(glob.escape(os.path.dirname(path)), f"{glob.escape(stem)}.{'[0-9a-f]' * 16}{extension}")
+    for old_path in glob.glob(pattern):
+        if old_path != path:
+            os.remove(old_path)
+
+
+def make_poster(video_path: str, preview_dir: Optional[str] = None, settings: Dict = PREVIEW_SETTINGS) -> str:
+    """
+    A scaled-down JPEG still of a clip, cached until the clip changes.
+
+    Returns:
+    str: Path of the poster.
+    """
+    poster_path = _preview_paths(video_path, settings, preview_dir)["poster"]
+    if os.path.exists(poster_path):
+        return poster_path
+
+    os.makedirs(os.path.dirname(poster_path), exist_ok=True)
+    duration = ffmpeg_parse_infos(video_path).get("duration") or 0
+    tmp_path = f"{poster_path}.{os.getpid()}.tmp.jpg"
+    _ffmpeg([
+        # One second in skips fades from black, short clips use their middle
+        "-ss", f"{min(1.0, duration / 2):.3f}", "-i", video_path,
+        "-frames:v", "1", "-vf", f"scale=-2:{settings['height']}",
+        "-q:v", str(settings["poster_quality"]), tmp_path,
+    ])
+    os.replace(tmp_path, poster_path)
+    _remove_stale(poster_path, video_path)
+    return poster_path
+
+
+def make_proxy(video_path: str, preview_dir: Optional[str] = None, settings: Dict = PREVIEW_SETTINGS) -> str:
+    """
+    A low-resolution, low-bitrate playback copy of a clip, cached until the
+    clip changes.
+
+    The moov atom is moved to the front so the browser starts playing before
+    the whole file has arrived.
+
+    Returns:
+    str: Path of the proxy.
+    """
+    proxy_path = _preview_paths(video_path, settings, preview_dir)["proxy"]
+    if os.path.exists(proxy_path):
+        return proxy_path
+
+    os.makedirs(os.path.dirname(proxy_path), exist_ok=True)
+    tmp_path = f"{proxy_path}.{os.getpid()}.tmp.mp4"
+    _ffmpeg([
+        "-i", video_path,
+        "-vf", f"scale=-2:{settings['height']}",
+        "-c:v", "libx264", "-preset", settings["preset"],
+        "-b:v", settings["video_bitrate"], "-maxrate", settings["video_bitrate"], "-bufsize", settings["video_bitrate"],
+        "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", settings["audio_bitrate"], "-ac", "1",
+        "-movflags", "+faststart",
+        tmp_path,
+    ])
+    os.replace(tmp_path, proxy_path)
+    _remove_stale(proxy_path, video_path)
+    return proxy_path
@@ -0,0 +1,186 @@
+import json
+import os
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from proglog import ProgressBarLogger
+
+# MoviePy's progress bars and what they measure
+BAR_STEPS = {"frame_index": "video", "chunk": "audio"}
+
+# Seconds between two progress events of the same clip
+DEFAULT_MIN_INTERVAL = 0.5
+
+
+class ProgressSink:
+    """
+    Append-only JSON-lines file of progress events.
+
+    Only the path is stored, so a sink can be handed to worker processes;
+    every event is a single short ``write`` in append mode, which keeps
+    lines from concurrent writers intact.
+
+    Every event has ``ts``, ``clip`` and ``stage`` plus either a ``status``
+    (started, done, cached, failed) or frame progress: ``step`` (video or
+    audio), ``frames_done``, ``frames_total``, ``fps`` and ``eta``.
+    """
+
+    def __init__(self, path: str, min_interval: float = DEFAULT_MIN_INTERVAL):
+        self.path = path
+        self.min_interval = min_interval
+
+    def emit(self, **event) -> None:
+        event.setdefault("ts", time.time())
+        line = json.dumps(event, default=str) + "\n"
+        with open(self.path, "a") as file:
+            file.write(line)
+
+    def logger(self, clip: str, stage: str) -> "ClipProgressLogger":
+        """A proglog logger to pass as ``logger=`` to MoviePy's writers."""
+        return ClipProgressLogger(self, clip, stage, self.min_interval)
+
+    @contextmanager
+    def stage(self, clip: str, stage: str):
+        """Emit started, then done or failed, around a block of work."""
+        started = time.perf_counter()
+        self.emit(clip=clip, stage=stage, status="started")
+        try:
+            yield
+        except Exception as e:
+            # ffmpeg errors carry its whole stderr, the last line says what went wrong
+            lines = [line for line in str(e).splitlines() if line.strip()]
+            self.emit(clip=clip, stage=stage, status="failed",
+                      error=f"{type(e).__name__}: {lines[-1] if lines else ''}",
+                      elapsed=time.perf_counter() - started)
+            raise
+        self.emit(clip=clip, stage=stage, status="done", elapsed=time.perf_counter() - started)
+
+    def frames(self, clip: str, stage: str, step: str, done: int, total: Optional[int], elapsed: float) -> None:
+        fps = done / elapsed if elapsed > 0 else 0.0
+        eta = (total - done) / fps if total and fps > 0 else None
+        self.emit(clip=clip, stage=stage, step=step, frames_done=done, frames_total=total, fps=fps, eta=eta)
+
+
+class ClipProgressLogger(ProgressBarLogger):
+    """
+    Turn MoviePy's proglog bar updates into throttled progress events.
+
+    Nothing is printed or kept in memory, unlike the default bar logger.
+    """
+
+    def __init__(self, sink: ProgressSink, clip: str, stage: str, min_interval: float = DEFAULT_MIN_INTERVAL):
+        super().__init__(logged_bars=None, min_time_interval=min_interval)
+        self.sink = sink
+        self.clip = clip
+        self.stage = stage
+        self._started = {}
+
+    def callback(self, **changes):
+        # MoviePy's "Writing video ..." messages, not needed with structured events
+        pass
+
+    def bars_callback(self, bar, attr, value, old_value=None):
+        if attr == "total":
+            self._started[bar] = time.perf_counter()
+            return
+        if attr != "index" or value < 0:
+            return
+        started = self._started.setdefault(bar, time.perf_counter())
+        self.sink.frames(
+            self.clip, self.stage, BAR_STEPS.get(bar, bar), value, self.bars[bar]["total"],
+            time.perf_counter() - started
+        )
+
+
+def run_ffmpeg(cmd: List[str], progress: Optional[ProgressSink], clip: str, stage: str,
+               total_frames: Optional[int] = None) -> None:
+    """
+    Run an ffmpeg command, reporting ``frame=`` updates from ``-progress``.
+
+    Raises IOError with ffmpeg's stderr when it fails, like MoviePy's
+    ``subprocess_call``.
+    """
+    if progress is None:
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+        if proc.returncode:
+            raise IOError(proc.stderr.decode("utf8", errors="replace"))
+        return
+
+    cmd = [cmd[0], "-progress", "pipe:1", "-nostats", *cmd[1:]]
+    # stderr goes to a file so a chatty ffmpeg can't block on a full pipe while we read stdout
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, stdin=subprocess.DEVNULL)
+        started = last_emit = time.perf_counter()
+        frame = 0
+        for raw_line in proc.stdout:
+            key, _, value = raw_line.decode("utf8", errors="replace").strip().partition("=")
+            if key == "frame":
+                frame = int(value or 0)
+            elif key == "progress":
+                now = time.perf_counter()
+                if value == "end" or now - last_emit >= progress.min_interval:
+                    progress.frames(clip, stage, "video", frame, total_frames, now - started)
+                    last_emit = now
+        proc.wait()
+        if proc.returncode:
+            stderr.seek(0)
+            raise IOError(stderr.read().decode("utf8", errors="replace"))
+
+
+def fold_events(events: List[Dict], state: Optional[Dict[str, Dict]] = None) -> Dict[str, Dict]:
+    """
+    Fold events into the latest state of every clip.
+
+    The result maps clip name to its current stage, status, frames done and
+    total, fps and ETA, ready to be shown as one table row per clip.
+    """
+    state = state if state is not None else {}
+    for event in events:
+        clip = state.setdefault(event["clip"], {"clip": event["clip"]})
+        if clip.get("stage") != event["stage"]:
+            # A new stage starts from scratch
+            for key in ("step", "frames_done", "frames_total", "fps", "eta", "error"):
+                clip.pop(key, None)
+        clip["stage"] = event["stage"]
+        clip["updated"] = event["ts"]
+        if "status" in event:
+            clip["status"] = event["status"]
+            if "error" in event:
+                clip["error"] = event["error"]
+        else:
+            clip["status"] = "running"
+            for key in ("step", "frames_done", "frames_total", "fps", "eta"):
+                clip[key] = event.get(key)
+    return state
+
+
+class ProgressReader:
+    """
+    Incrementally read a progress events file.
+
+    Only bytes appended since the previous ``poll`` are parsed, so a UI
+    refreshing at a fixed rate coalesces any number of events into one
+    redraw.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0
+        self.clips: Dict[str, Dict] = {}
+
+    def poll(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.path):
+            return self.clips
+        with open(self.path, "rb") as file:
+            file.seek(self.offset)
+            chunk = file.read()
+        # Keep a trailing partial line for the next poll
+        complete, _, _ = chunk.rpartition(b"\n")
+        if complete:
+            self.offset += len(complete) + 1
+            events = [json.loads(line) for line in complete.split(b"\n") if line]
+            fold_events(events, self.clips)
+        return self.clips
@@ -1,13 +1,39 @@
 import os
-from typing import List, Dict
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from multiprocessing import get_context
+from typing import Iterator, List, Dict, Optional
 from moviepy import VideoFileClip
-import json
+from audio_track import DEFAULT_AUDIO, plan_clip_audio, render_clip_audio
+from encoding_profiles import crf_params, key_encoder
+from media_probe import keyframe_times, media_index, seek_with_keyframes
+from progress_events import ProgressSink
+from reader_pool import open_clip
+import render_profiler
+from render_cache import RenderCache, file_fingerprint
+from segmented_render import render_segmented, segment_count, segment_range
+from smart_cut import CUT_MODES, cut_clip, encode_audio_range, mux
+from video_config import parse_timestamp
+
+# Encoder settings of the raw clips, part of their render cache key. Re-encodes use x264's default preset
+# and rate control, see encoding_profiles for the profiles that replace them
+RAW_CLIP_ENCODER = {"codec": "libx264", "audio_codec": "aac", "smart_cut_preset": "veryfast"}
 
 def split_video(
     main_video_path: str,
     clips_config: List[Dict[str, str]],
-    output_folder: str
-) -> None:
+    output_folder: str,
+    cut_mode: str = "reencode",
+    workers: int = 1,
+    thread_budget: Optional[int] = None,
+    cache: Optional[RenderCache] = None,
+    progress: Optional[ProgressSink] = None,
+    segments: Optional[int] = None,
+    audio: Optional[Dict] = None,
+    encoder: Optional[Dict] = None
+) -> List[Dict]:
     """
     Split a main video into smaller clips based on provided configurations.
 
@@ -15,48 +41,450 @@ def split_video(
     main_video_path (str): Path to the main video file.
     clips_config (List[Dict[str, str]]): List of clip configurations.
     output_folder (str): Destination folder for output clips.
+    cut_mode (str): "reencode" (full libx264 encode), "copy" (stream copy from
+        the nearest keyframe) or "smart" (stream copy, re-encoding only the
+        partial GOPs at the cut points).
+    workers (int): Number of clips cut at the same time, each in its own
+        process with its own reader. 1 keeps everything in this process.
+    thread_budget (int): Total encoder threads shared by all workers,
+        defaults to the number of CPUs.
+    cache (RenderCache): When given, clips that are already up to date are
+        skipped and fresh renders are recorded.
+    progress (ProgressSink): Receives per-clip stage and frame progress events.
+    segments (int): Re-encode long clips as this many parts in parallel
+        processes, joined without re-encoding (see ``segmented_render``).
+    audio (Dict): Audio settings (see ``audio_track.DEFAULT_AUDIO``). When
+        given, the source audio is extracted once and every clip's audio is
+        sliced from it, optionally loudness-normalized or passed through.
+    encoder (Dict): Encoder settings of the clips, ``RAW_CLIP_ENCODER`` by
+        default (see ``encoding_profiles.stage_encoder``). Its ``threads``
+        replace the per-worker share of the thread budget.
+
+    Returns:
+    List[Dict]: One report per clip in config order. Failed clips have
+        status "failed" and an error message instead of aborting the batch.
     """
+    if cut_mode not in CUT_MODES:
+        raise ValueError(f"Unknown cut_mode '{cut_mode}', expected one of {CUT_MODES}")
+
+    encoder = encoder or RAW_CLIP_ENCODER
+
     # Ensure output folder exists
     os.makedirs(output_folder, exist_ok=True)
 
-    # Load the main video
-    with VideoFileClip(main_video_path) as video:
-        for clip_config in clips_config:
-            start_time = float(clip_config['start_time'])
-            end_time = float(clip_config['end_time'])
-            clip_name = clip_config['name']
+    reports: Dict[int, Dict] = {}
+    keys: Dict[int, str] = {}
+    if cache is not None:
+        # Skip clips whose source, range and encoder settings are unchanged
+        source_fingerprint = file_fingerprint(main_video_path)
+        for idx, clip_config in enumerate(clips_config):
+            try:
+                keys[idx] = raw_clip_cache_key(source_fingerprint, clip_config, cut_mode, audio, encoder)
+            except (KeyError, ValueError):
+                # Malformed clip, let the render report the error
+                continue
+            cached = cache.lookup(_clip_output_path(output_folder, clip_config), keys[idx])
+            if cached is not None:
+                reports[idx] = dict(cached, cached=True)
+                _report_cached(clip_config, progress)
+    pending = [idx for idx in range(len(clips_config)) if idx not in reports]
 
-            # Extract the subclip
-            subclip = video.subclipped(start_time, end_time)
+    # Measure and plan the audio of all clips in one pass over the source track
+    audio_plans: Dict[int, Optional[Dict]] = {}
+    if audio is not None and pending:
+        ranges = {}
+        for idx in pending:
+            try:
+                ranges[idx] = _clip_range(clips_config[idx])
+            except (KeyError, ValueError):
+                # Malformed clip, let the render report the error
+                continue
+        with render_profiler.span("plan audio"):
+            audio_plans = dict(zip(ranges, plan_clip_audio(main_video_path, list(ranges.values()), audio)))
 
-            # Generate output path
-            output_path = os.path.join(output_folder, f"{clip_name}.mp4")
+    # Probe keyframes once for all clips of the source
+    keyframes = None
+    if cut_mode != "reencode" and pending:
+        with render_profiler.span("keyframes"):
+            keyframes = keyframe_times(main_video_path)
 
-            # Write the subclip to file
-            subclip.write_videofile(output_path, codec="libx264", audio_codec="aac")
+    workers = max(1, min(workers, len(pending)))
+    threads = encoder.get("threads") or threads_per_worker(workers, thread_budget)
+
+    def finish(idx: int, report: Dict) -> None:
+        if cache is not None and report["status"] == "ok":
+            cache.store(report["output_path"], keys[idx], report)
+        reports[idx] = report
+        print(_describe_report(report))
+
+    if workers == 1:
+        # Load the main video once and reuse it for every clip
+        with open_source(main_video_path) if cut_mode == "reencode" and pending else nullcontext() as video:
+            for idx in pending:
+                finish(idx, _run_clip(
+                    video, main_video_path, clips_config[idx], output_folder, cut_mode, keyframes, threads, progress,
+                    segments, audio_plans.get(idx), encoder
+                ))
+    else:
+        # Spawned workers don't inherit the parent's open readers or Streamlit state
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as executor:
+            futures = {
+                idx: executor.submit(
+                    _render_clip_worker, main_video_path, clips_config[idx], output_folder, cut_mode, keyframes,
+                    threads, progress, segments, audio_plans.get(idx), encoder
+                )
+                for idx in pending
+            }
+            for idx, future in futures.items():
+                try:
+                    report = future.result()
+                except Exception as e:
+                    # The worker itself died (e.g. killed by the OOM killer)
+                    report = _failed_report(clips_config[idx], output_folder, cut_mode, e)
+                finish(idx, report)
+
+    return [reports[idx] for idx in range(len(clips_config))]
+
+def raw_clip_cache_key(
+    source_fingerprint: str,
+    clip_config: Dict[str, str],
+    cut_mode: str,
+    audio: Optional[Dict] = None,
+    encoder: Optional[Dict] = None
+) -> str:
+    """Render cache key of a raw clip: everything that affects its encoded bytes."""
+    # Audio settings only join the key when given, so existing keys stay valid
+    extra = {"audio": dict(DEFAULT_AUDIO, **audio)} if audio is not None else {}
+    return RenderCache.key_for(
+        kind="raw_clip",
+        source=source_fingerprint,
+        start_time=parse_timestamp(clip_config['start_time']),
+        end_time=parse_timestamp(clip_config['end_time']),
+        cut_mode=cut_mode,
+        encoder=key_encoder(encoder or RAW_CLIP_ENCODER),
+        **extra
+    )
+
+def _clip_range(clip_config: Dict[str, str]):
+    return parse_timestamp(clip_config['start_time']), parse_timestamp(clip_config['end_time'])
+
+def _clip_output_path(output_folder: str, clip_config: Dict[str, str]) -> str:
+    return os.path.join(output_folder, f"{clip_config['name']}.mp4")
+
+def split_clip(
+    main_video_path: str,
+    clip_config: Dict[str, str],
+    output_folder: str,
+    cut_mode: str = "reencode",
+    keyframes: Optional[List[float]] = None,
+    threads: Optional[int] = None,
+    cache: Optional[RenderCache] = None,
+    executor: Optional[ProcessPoolExecutor] = None,
+    progress: Optional[ProgressSink] = None,
+    segments: Optional[int] = None,
+    audio: Optional[Dict] = None,
+    audio_plan: Optional[Dict] = None,
+    encoder: Optional[Dict] = None
+) -> Dict:
+    """
+    Cut a single clip, the unit of work of the streaming pipeline.
 
-            print(f"Clip '{clip_name}' created successfully.")
+    Args:
+    main_video_path (str): Path to the main video file.
+    clip_config (Dict[str, str]): Configuration of the clip.
+    output_folder (str): Destination folder for the clip.
+    cut_mode (str): See split_video.
+    keyframes (List[float]): Keyframes of the source for copy/smart cuts,
+        probed when not given.
+    threads (int): Encoder thread limit.
+    cache (RenderCache): Skip the cut when the clip is up to date.
+    executor (ProcessPoolExecutor): Run the cut in this pool instead of the
+        calling thread. Cache bookkeeping always stays in this process.
+    progress (ProgressSink): Receives stage and frame progress events.
+    segments (int): See split_video.
+    audio (Dict): See split_video.
+    audio_plan (Dict): The clip's audio from ``audio_track.plan_clip_audio``,
+        planned for this clip alone when not given.
+    encoder (Dict): See split_video.
+
+    Returns:
+    Dict: The clip's report, see split_video.
+    """
+    encoder = encoder or RAW_CLIP_ENCODER
+    os.makedirs(output_folder, exist_ok=True)
+
+    key = None
+    if cache is not None:
+        try:
+            key = raw_clip_cache_key(file_fingerprint(main_video_path), clip_config, cut_mode, audio, encoder)
+        except (KeyError, ValueError):
+            # Malformed clip, let the render report the error
+            key = None
+        cached = cache.lookup(_clip_output_path(output_folder, clip_config), key) if key else None
+        if cached is not None:
+            _report_cached(clip_config, progress)
+            return dict(cached, cached=True)
+
+    if cut_mode != "reencode" and keyframes is None:
+        keyframes = keyframe_times(main_video_path)
 
-# Function to read JSON config file
-def load_config(file_path):
-    """Loads configuration from a JSON file."""
     try:
-        with open(file_path, 'r') as file:
-            config = json.load(file)
-        return config
-    except FileNotFoundError:
-        print(f"Error: Config file '{file_path}' not found.")
-        return None
-    except json.JSONDecodeError:
-        print(f"Error: Invalid JSON format in '{file_path}'.")
+        if audio is not None and audio_plan is None:
+            audio_plan = plan_clip_audio(main_video_path, [_clip_range(clip_config)], audio)[0]
+        args = (
+            main_video_path, clip_config, output_folder, cut_mode, keyframes,
+            encoder.get("threads") or threads or threads_per_worker(1), progress, segments, audio_plan, encoder
+        )
+        if executor is not None:
+            report = executor.submit(_render_clip_worker, *args).result()
+        else:
+            report = _render_clip_worker(*args)
+    except Exception as e:
+        report = _failed_report(clip_config, output_folder, cut_mode, e)
+
+    if cache is not None and key and report["status"] == "ok":
+        cache.store(report["output_path"], key, report)
+    print(_describe_report(report))
+    return report
+
+def threads_per_worker(workers: int, thread_budget: Optional[int] = None) -> int:
+    """Split the thread budget evenly so parallel encoders don't oversubscribe the CPUs."""
+    budget = thread_budget or os.cpu_count() or 1
+    return max(1, budget // max(1, workers))
+
+def _report_cached(clip_config: Dict[str, str], progress: Optional[ProgressSink]) -> None:
+    print(f"Clip '{clip_config['name']}' is up to date, skipping.")
+    if progress is not None:
+        progress.emit(clip=clip_config['name'], stage="split", status="cached")
+
+@contextmanager
+def open_source(main_video_path: str) -> Iterator[VideoFileClip]:
+    """
+    Lease the source video from the reader pool for reading clip after clip.
+
+    When the media index already has the source's keyframe table, forward
+    jumps seek through it instead of decoding every frame in between.
+    """
+    with open_clip(main_video_path) as video:
+        keyframes = media_index(main_video_path)["keyframes"]
+        if keyframes:
+            seek_with_keyframes(video, keyframes)
+        yield video
+
+def _render_clip_worker(
+    main_video_path: str,
+    clip_config: Dict[str, str],
+    output_folder: str,
+    cut_mode: str,
+    keyframes: Optional[List[float]],
+    threads: int,
+    progress: Optional[ProgressSink] = None,
+    segments: Optional[int] = None,
+    audio_plan: Optional[Dict] = None,
+    encoder: Dict = RAW_CLIP_ENCODER
+) -> Dict:
+    """Process pool entry point: cut one clip with a reader of its own."""
+    if cut_mode != "reencode":
+        return _run_clip(
+            None, main_video_path, clip_config, output_folder, cut_mode, keyframes, threads, progress, segments,
+            audio_plan, encoder
+        )
+
+    with open_source(main_video_path) as video:
+        return _run_clip(
+            video, main_video_path, clip_config, output_folder, cut_mode, keyframes, threads, progress, segments,
+            audio_plan, encoder
+        )
+
+def _run_clip(
+    video: Optional[VideoFileClip],
+    main_video_path: str,
+    clip_config: Dict[str, str],
+    output_folder: str,
+    cut_mode: str,
+    keyframes: Optional[List[float]],
+    threads: int,
+    progress: Optional[ProgressSink] = None,
+    segments: Optional[int] = None,
+    audio_plan: Optional[Dict] = None,
+    encoder: Dict = RAW_CLIP_ENCODER
+) -> Dict:
+    """Cut a single clip and return its report, capturing any error."""
+    clip_name = clip_config['name']
+
+    # Generate output path
+    output_path = _clip_output_path(output_folder, clip_config)
+
+    try:
+        with progress.stage(clip_name, "split") if progress else nullcontext(), \
+                render_profiler.span("split", clip=clip_name, mode=cut_mode):
+            report = _cut(
+                video, main_video_path, clip_config, output_path, cut_mode, keyframes, threads, progress, segments,
+                audio_plan, encoder
+            )
+    except Exception as e:
+        return _failed_report(clip_config, output_folder, cut_mode, e)
+
+    report.update(name=clip_name, output_path=output_path, status="ok")
+    return report
+
+def _cut(
+    video: Optional[VideoFileClip],
+    main_video_path: str,
+    clip_config: Dict[str, str],
+    output_path: str,
+    cut_mode: str,
+    keyframes: Optional[List[float]],
+    threads: int,
+    progress: Optional[ProgressSink],
+    segments: Optional[int] = None,
+    audio_plan: Optional[Dict] = None,
+    encoder: Dict = RAW_CLIP_ENCODER
+) -> Dict:
+    """Cut with the configured mode and return the cut report."""
+    start_time = parse_timestamp(clip_config['start_time'])
+    end_time = parse_timestamp(clip_config['end_time'])
+
+    if cut_mode != "reencode":
+        report = cut_clip(
+            main_video_path,
+            start_time,
+            end_time,
+            output_path,
+            mode=cut_mode,
+            keyframes=keyframes,
+            # Edges keep their own near-lossless rate control, they are spliced between copied GOPs
+            preset=encoder.get("smart_cut_preset", encoder.get("preset")),
+            threads=threads,
+            render_audio=partial(render_clip_audio, audio_plan) if audio_plan else None
+        )
+    elif segment_count(end_time - start_time, segments) > 1:
+        parts = segment_count(end_time - start_time, segments)
+        render_segmented(
+            _render_split_segment,
+            (main_video_path, start_time, encoder),
+            end_time - start_time,
+            video.fps,
+            parts,
+            output_path,
+            partial(render_clip_audio, audio_plan, start_time, end_time) if audio_plan else
+            partial(_split_audio, main_video_path, start_time, end_time, video.audio is not None),
+            threads=threads_per_worker(parts, threads),
+            progress=progress,
+            progress_label=clip_config['name'],
+            progress_stage="split"
+        )
+        report = {
+            "mode": cut_mode,
+            "method": "reencode",
+            "frame_accurate": True,
+            "requested_start": start_time,
+            "requested_end": end_time,
+            "actual_start": start_time,
+            "actual_end": end_time,
+            "copied_seconds": 0.0,
+            "segments": parts,
+        }
+    else:
+        # Extract the subclip
+        subclip = video.subclipped(start_time, end_time)
+        subclip.frame_function = render_profiler.instrument("decode", subclip.frame_function)
+
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as workdir:
+            # With an audio plan the video is written alone and the planned audio muxed in
+            video_path = output_path if audio_plan is None else os.path.join(workdir, "video.mp4")
+
+            # Write the subclip to file
+            with render_profiler.span("write"):
+                subclip.write_videofile(
+                    video_path,
+                    codec=encoder["codec"],
+                    audio=audio_plan is None,
+                    audio_codec=encoder["audio_codec"],
+                    preset=encoder.get("preset", "medium"),
+                    threads=threads,
+                    ffmpeg_params=crf_params(encoder),
+                    logger=progress.logger(clip_config['name'], "split") if progress else "bar"
+                )
+            if audio_plan is not None:
+                with render_profiler.span("audio"):
+                    audio_path = render_clip_audio(audio_plan, start_time, end_time, os.path.join(workdir, "audio.m4a"))
+                with render_profiler.span("mux"):
+                    mux(video_path, audio_path, output_path)
+
+        report = {
+            "mode": cut_mode,
+            "method": "reencode",
+            "frame_accurate": True,
+            "requested_start": start_time,
+            "requested_end": end_time,
+            "actual_start": start_time,
+            "actual_end": end_time,
+            "copied_seconds": 0.0,
+        }
+    return report
+
+def _render_split_segment(
+    main_video_path: str,
+    clip_start: float,
+    encoder: Dict,
+    first_frame: int,
+    frames: int,
+    part_path: str,
+    threads: int
+) -> None:
+    """Segment worker of a segmented re-encode: the video of one run of frames of the clip."""
+    with render_profiler.span("segment", first_frame=first_frame, frames=frames), \
+            open_clip(main_video_path, audio=False) as video:
+        start, length = segment_range(first_frame, frames, video.fps)
+        segment = video.subclipped(clip_start + start).with_duration(length)
+        segment.frame_function = render_profiler.instrument("decode", segment.frame_function)
+        with render_profiler.span("write"):
+            # Same encoder settings as the unsegmented write, so the parts concat losslessly
+            segment.write_videofile(
+                part_path,
+                codec=encoder["codec"],
+                audio=False,
+                preset=encoder.get("preset", "medium"),
+                threads=threads,
+                ffmpeg_params=crf_params(encoder),
+                logger=None
+            )
+
+def _split_audio(main_video_path: str, start_time: float, end_time: float, has_audio: bool,
+                 output_path: str) -> Optional[str]:
+    if not has_audio:
         return None
-    
-# Example usage
-# if __name__ == "__main__":
-#    main_video = "./vid_automation/clips/original.mov"
-#    output_folder = "./vid_automation/clips"
-#    config = load_config('./vid_automation/video1/config.json')
-#    clips_config = config.get('clips_config')
+    encode_audio_range(main_video_path, start_time, end_time, output_path)
+    return output_path
+
+def _failed_report(clip_config: Dict[str, str], output_folder: str, cut_mode: str, error: Exception) -> Dict:
+    clip_name = clip_config.get('name', '?')
+    # ffmpeg errors carry the whole stderr, the last line is the one that matters
+    message = (str(error).strip().splitlines() or [""])[-1]
+    return {
+        "name": clip_name,
+        "output_path": os.path.join(output_folder, f"{clip_name}.mp4"),
+        "mode": cut_mode,
+        "status": "failed",
+        "error": f"{type(error).__name__}: {message}",
+    }
 
-#    split_video(config.get("main_video_path"), clips_config, config.get('output_folder'))
+def _describe_report(report: Dict) -> str:
+    """Human readable one-line summary of a cut report."""
+    if report["status"] == "failed":
+        return f"Clip '{report['name']}' failed: {report['error']}"
 
+    clip_length = report["actual_end"] - report["actual_start"]
+    copied = 100 * report["copied_seconds"] / clip_length if clip_length > 0 else 0
+    early = report["requested_start"] - report["actual_start"]
+    if report["frame_accurate"]:
+        accuracy = "yes"
+    elif early > 0:
+        accuracy = f"no, starts {early:.3f}s early"
+    else:
+        accuracy = "no, frame count or timestamps off"
+    return (
+        f"Clip '{report['name']}' created successfully "
+        f"({report['method']}, {copied:.0f}% stream-copied, frame accurate: {accuracy})."
+    )
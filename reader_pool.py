@@ -0,0 +1,166 @@
+import atexit
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+from moviepy import VideoFileClip
+
+# Readers kept open per process, idle ones beyond it are closed least recently used first
+DEFAULT_MAX_READERS = 4
+
+# MoviePy reader methods that callers wrap per use, see media_probe.seek_with_keyframes
+_READER_OVERRIDES = ("get_frame",)
+
+
+def _reader_key(path: str, audio: bool) -> Tuple:
+    # A re-rendered file at the same path gets a reader of its own
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return path, audio, stat.st_size, stat.st_mtime_ns
+
+
+def _readers_of(clip: VideoFileClip) -> List:
+    readers = [clip.reader]
+    if clip.audio is not None:
+        readers.append(clip.audio.reader)
+    return [reader for reader in readers if reader is not None]
+
+
+def _subprocesses_of(clip: VideoFileClip) -> int:
+    return sum(
+        1 for reader in _readers_of(clip)
+        if getattr(reader, "proc", None) is not None and reader.proc.poll() is None
+    )
+
+
+class ReaderPool:
+    """
+    MoviePy ``VideoFileClip`` readers of source files, reused across renders.
+
+    Opening a clip probes the file and starts an ffmpeg subprocess per
+    stream, and a clip that is never closed keeps them and their pipes for
+    the life of the process. A lease hands out an open clip of a file,
+    exclusively until it ends: a lease that completes returns the clip for
+    the next lease of the same file, one that raises (an error, a
+    KeyboardInterrupt, a cancelled generator) closes it, as its reader may
+    have stopped mid-read. At most ``max_readers`` clips are kept; beyond
+    that, idle clips are closed least recently used first.
+
+    Leased clips must not be closed or modified: derive copies
+    (``subclipped``, ``with_effects``) from them instead, and note that
+    closing a copied ``VideoFileClip`` closes the shared reader too.
+    Methods are safe to call from several threads of one process.
+    """
+
+    def __init__(self, max_readers: int = DEFAULT_MAX_READERS):
+        self.max_readers = max_readers
+        # Idle clips, least recently used first
+        self._idle: List[Tuple[Tuple, VideoFileClip]] = []
+        self._leased: Dict[int, Tuple[Tuple, VideoFileClip]] = {}
+        self._counts = {"opened": 0, "reused": 0, "evicted": 0, "discarded": 0, "peak": 0}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lease(self, path: str, audio: bool = True) -> Iterator[VideoFileClip]:
+        """
+        Open clip of ``path`` for the duration of the ``with`` block.
+
+        Args:
+        path (str): Media file to read.
+        audio (bool): Also open the audio reader, as ``VideoFileClip(audio=...)``.
+        """
+        key, clip = self._take(path, audio)
+        try:
+            yield clip
+        except BaseException:
+            self._discard(clip)
+            raise
+        self._give_back(key, clip)
+
+    def stats(self) -> Dict[str, int]:
+        """Live readers and ffmpeg subprocesses, for monitoring, plus lease counters since start."""
+        with self._lock:
+            clips = [clip for _, clip in self._idle] + [clip for _, clip in self._leased.values()]
+            return {
+                "readers": len(clips),
+                "idle": len(self._idle),
+                "leased": len(self._leased),
+                "subprocesses": sum(_subprocesses_of(clip) for clip in clips),
+                **self._counts,
+            }
+
+    def close_all(self) -> None:
+        """Close the idle clips; leased ones are closed when their lease ends."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _, clip in idle:
+            clip.close()
+
+    def _take(self, path: str, audio: bool) -> Tuple[Tuple, VideoFileClip]:
+        key = _reader_key(path, audio)
+        stale = []
+        with self._lock:
+            for idx in range(len(self._idle) - 1, -1, -1):
+                idle_key, clip = self._idle[idx]
+                if idle_key == key:
+                    del self._idle[idx]
+                    self._leased[id(clip)] = (key, clip)
+                    self._counts["reused"] += 1
+                    return key, clip
+                if idle_key[:2] == key[:2]:
+                    # The file changed since this reader opened it
+                    stale.append(self._idle.pop(idx)[1])
+        for clip in stale:
+            clip.close()
+
+        clip = VideoFileClip(path, audio=audio)
+        with self._lock:
+            self._leased[id(clip)] = (key, clip)
+            self._counts["opened"] += 1
+            self._counts["peak"] = max(self._counts["peak"], len(self._idle) + len(self._leased))
+        return key, clip
+
+    def _give_back(self, key: Tuple, clip: VideoFileClip) -> None:
+        for reader in _readers_of(clip):
+            for name in _READER_OVERRIDES:
+                reader.__dict__.pop(name, None)
+
+        evicted = []
+        with self._lock:
+            del self._leased[id(clip)]
+            if clip.reader is None:
+                # Closed by the caller after all
+                self._counts["discarded"] += 1
+                return
+            self._idle.append((key, clip))
+            while self._idle and len(self._idle) + len(self._leased) > self.max_readers:
+                evicted.append(self._idle.pop(0)[1])
+                self._counts["evicted"] += 1
+        for idle_clip in evicted:
+            idle_clip.close()
+
+    def _discard(self, clip: VideoFileClip) -> None:
+        with self._lock:
+            self._leased.pop(id(clip), None)
+            self._counts["discarded"] += 1
+        clip.close()
+
+
+_pool = ReaderPool()
+atexit.register(_pool.close_all)
+
+
+def open_clip(path: str, audio: bool = True):
+    """Lease a clip of ``path`` from this process's reader pool, see ReaderPool.lease."""
+    return _pool.lease(path, audio)
+
+
+def reader_stats() -> Dict[str, int]:
+    """Live readers and ffmpeg subprocesses of this process's reader pool, see ReaderPool.stats."""
+    return _pool.stats()
+
+
+def close_readers() -> None:
+    """Close the idle readers of this process's reader pool."""
+    _pool.close_all()
@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows, the cache is only shared between threads of one process
+    fcntl = None
+
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+
+# Bytes hashed from each end of a file for its fingerprint
+FINGERPRINT_SAMPLE = 1024 * 1024
+
+
+def file_fingerprint(path: str) -> str:
+    """
+    Cheap content fingerprint of a (potentially huge) media file.
+
+    Hashes the size together with the first and last megabyte, which changes
+    whenever a video is re-exported or re-cut without reading the whole file.
+
+    Args:
+    path (str): File to fingerprint.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as file:
+        digest.update(file.read(FINGERPRINT_SAMPLE))
+        if size > FINGERPRINT_SAMPLE:
+            file.seek(max(FINGERPRINT_SAMPLE, size - FINGERPRINT_SAMPLE))
+            digest.update(file.read(FINGERPRINT_SAMPLE))
+    return digest.hexdigest()
+
+
+def folder_cache(folder_path: str, config: Dict) -> "RenderCache":
+    """Render cache of a video folder, sized by ``render_cache_max_mb`` in its config."""
+    max_mb = config.get("render_cache_max_mb")
+    max_bytes = int(max_mb * 1024 ** 2) if max_mb else DEFAULT_MAX_BYTES
+    return RenderCache(os.path.join(folder_path, ".render_cache"), max_bytes)
+
+
+class RenderCache:
+    """
+    Content-addressed store of rendered outputs.
+
+    Every output is described by a key hashed from everything that affects
+    its pixels (source fingerprints, clip range, title, template, encoder
+    settings). The manifest remembers which key each output path was rendered
+    for, so unchanged outputs are skipped and only edited clips re-render.
+    Rendered files are also kept in ``objects/`` (hard-linked when possible),
+    so reverting an edit restores the earlier render instead of re-encoding.
+    The store is trimmed least-recently-used first once it exceeds ``max_bytes``.
+    Methods are safe to call from several threads and processes sharing one
+    cache: each one locks ``manifest.lock`` and reloads the manifest before
+    changing it, so no process writes back another's stale copy.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.manifest_path = os.path.join(cache_dir, "manifest.json")
+        self.lock_path = os.path.join(cache_dir, "manifest.lock")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.manifest = self._load_manifest()
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        self._lock_file = None
+
+    @staticmethod
+    def key_for(**params) -> str:
+        """Hash render parameters into a cache key."""
+        canonical = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def lookup(self, output_path: str, key: str) -> Optional[Dict]:
+        """
+        Make ``output_path`` up to date for ``key`` without rendering, if possible.
+
+        Returns the report stored with the render when the output is already
+        current or could be restored from the store, otherwise None. On a miss
+        the stale output is unlinked so a new render can't write through a
+        hard link into the store.
+        """
+        with self._locked():
+            output_path = os.path.abspath(output_path)
+            entry = self.manifest["outputs"].get(output_path)
+            if entry and entry["key"] == key and self._matches_stat(output_path, entry):
+                self._touch(key)
+                return entry.get("report") or {}
+
+            if os.path.exists(output_path):
+                os.remove(output_path)
+
+            obj = self.manifest["objects"].get(key)
+            object_path = self._object_path(key)
+            if obj and os.path.exists(object_path):
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                self._link_or_copy(object_path, output_path)
+                self._record_output(output_path, key, obj.get("report"))
+                self._touch(key)
+                return obj.get("report") or {}
+
+            self.manifest["outputs"].pop(output_path, None)
+            return None
+
+    def store(self, output_path: str, key: str, report: Optional[Dict] = None) -> None:
+        """Record a fresh render of ``output_path`` for ``key`` and trim the store."""
+        with self._locked():
+            output_path = os.path.abspath(output_path)
+            object_path = self._object_path(key)
+            if os.path.exists(object_path):
+                os.remove(object_path)
+            self._link_or_copy(output_path, object_path)
+
+            self.manifest["objects"][key] = {
+                "size": os.path.getsize(object_path),
+                "last_used": time.time(),
+                "report": report,
+            }
+            self._record_output(output_path, key, report)
+            self.evict()
+
+    def evict(self) -> None:
+        """Drop least recently used objects until the store fits in ``max_bytes``."""
+        with self._locked():
+            objects = self.manifest["objects"]
+            total = sum(obj["size"] for obj in objects.values())
+            for key in sorted(objects, key=lambda k: objects[k]["last_used"]):
+                if total <= self.max_bytes:
+                    break
+                total -= objects[key]["size"]
+                del objects[key]
+                if os.path.exists(self._object_path(key)):
+                    os.remove(self._object_path(key))
+            self._save_manifest()
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold the cache against other threads and processes, with the manifest
+        as it is on disk. Re-entrant; the outermost holder reloads it.
+        """
+        with self._lock:
+            if self._lock_depth == 0:
+                if fcntl is not None:
+                    self._lock_file = open(self.lock_path, "a")
+                    fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+                self.manifest = self._load_manifest()
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and self._lock_file is not None:
+                    # Closing the file releases the lock
+                    self._lock_file.close()
+                    self._lock_file = None
+
+    def _object_path(self, key: str) -> str:
+        return os.path.join(self.objects_dir, f"{key}.mp4")
+
+    def _record_output(self, output_path: str, key: str, report: Optional[Dict]) -> None:
+        stat = os.stat(output_path)
+        self.manifest["outputs"][output_path] = {
+            "key": key,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "report": report,
+        }
+        self._save_manifest()
+
+    def _touch(self, key: str) -> None:
+        if key in self.manifest["objects"]:
+            self.manifest["objects"][key]["last_used"] = time.time()
+            self._save_manifest()
+
+    @staticmethod
+    def _matches_stat(path: str, entry: Dict) -> bool:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        return stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime_ns"]
+
+    @staticmethod
+    def _link_or_copy(src: str, dst: str) -> None:
+        try:
+            os.link(src, dst)
+        except OSError:
+            # Different filesystem or no hard link support
+            shutil.copy2(src, dst)
+
+    def _load_manifest(self) -> Dict:
+        try:
+            with open(self.manifest_path, "r") as file:
+                manifest = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            manifest = {}
+        manifest.setdefault("objects", {})
+        manifest.setdefault("outputs", {})
+        return manifest
+
+    def _save_manifest(self) -> None:
+        # Write to a temp file first so a crash never leaves a truncated manifest
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.manifest, file, indent=2)
+        os.replace(tmp_path, self.manifest_path)
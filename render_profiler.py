@@ -0,0 +1,175 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, List, Optional
+
+# Set to an events file to profile this process and the workers it spawns
+PROFILE_ENV = "VIDEO_AUTOMATION_PROFILE"
+
+# Buffered spans are appended to the events file once this many pile up
+FLUSH_EVERY = 2000
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+
+class Profiler:
+    """
+    Records timing spans of render stages to a JSON-lines file.
+
+    Spans are buffered in memory and appended in one write whenever a
+    top-level span ends, so per-frame spans cost a list append rather than
+    a file write. Every span carries wall-clock start (``ts``) and duration
+    (``dur``) in microseconds plus the pid and thread, i.e. it already is a
+    complete Chrome trace event.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._events: List[Dict] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def span(self, name: str, category: str = "stage", **args):
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        ts = time.time()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, category, ts, time.perf_counter() - started, args)
+            self._local.depth = depth
+            if depth == 0:
+                self.flush()
+
+    def timed(self, name: str, function: Callable, category: str = "frame", **args) -> Callable:
+        """Wrap a per-frame function, e.g. a clip's ``frame_function``, in a span per call."""
+        record = self._record
+
+        def wrapper(*call_args, **call_kwargs):
+            ts = time.time()
+            started = time.perf_counter()
+            try:
+                return function(*call_args, **call_kwargs)
+            finally:
+                record(name, category, ts, time.perf_counter() - started, args)
+
+        return wrapper
+
+    def _record(self, name: str, category: str, ts: float, duration: float, args: Dict) -> None:
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": int(ts * 1e6),
+            "dur": int(duration * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with self._lock:
+            self._events.append(event)
+            full = len(self._events) >= FLUSH_EVERY
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            events, self._events = self._events, []
+        if events:
+            with open(self.path, "a") as file:
+                file.write("".join(json.dumps(event, default=str) + "\n" for event in events))
+
+
+def enable(path: str) -> None:
+    """Profile this process, and worker processes started after this call, into ``path``."""
+    os.environ[PROFILE_ENV] = path
+
+
+def active() -> Optional[Profiler]:
+    """The process profiler, None (and zero per-frame overhead) when profiling is off."""
+    global _profiler
+    path = os.environ.get(PROFILE_ENV)
+    if not path:
+        return None
+    with _profiler_lock:
+        if _profiler is None or _profiler.path != path:
+            if _profiler is not None:
+                _profiler.flush()
+            _profiler = Profiler(path)
+        return _profiler
+
+
+def span(name: str, **args):
+    """A span on the active profiler, a no-op context manager when profiling is off."""
+    profiler = active()
+    return profiler.span(name, **args) if profiler is not None else nullcontext()
+
+
+def instrument(name: str, function: Callable, **args) -> Callable:
+    """``function`` wrapped in per-call spans, or unchanged when profiling is off."""
+    profiler = active()
+    return profiler.timed(name, function, **args) if profiler is not None else function
+
+
+def load_events(path: str) -> List[Dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def _self_times(events: List[Dict]) -> List[float]:
+    """Duration of every event minus the spans nested directly inside it on the same thread."""
+    self_times = [float(event["dur"]) for event in events]
+    by_thread: Dict = {}
+    for idx, event in enumerate(events):
+        by_thread.setdefault((event["pid"], event["tid"]), []).append(idx)
+
+    for indices in by_thread.values():
+        # Parents first: earlier start, then longer duration
+        indices.sort(key=lambda idx: (events[idx]["ts"], -events[idx]["dur"]))
+        stack: List[int] = []
+        for idx in indices:
+            event = events[idx]
+            while stack and events[stack[-1]]["ts"] + events[stack[-1]]["dur"] < event["ts"] + event["dur"]:
+                stack.pop()
+            if stack:
+                self_times[stack[-1]] -= event["dur"]
+            stack.append(idx)
+    return self_times
+
+
+def summarize(events: List[Dict]) -> List[Dict]:
+    """
+    Totals per stage, slowest first.
+
+    ``self_ms`` excludes nested spans, so e.g. the encode share of a write is
+    what remains after frame composition and decoding are taken out.
+    """
+    stages: Dict[str, Dict] = {}
+    for event, self_time in zip(events, _self_times(events)):
+        stage = stages.setdefault(event["name"], {
+            "stage": event["name"], "category": event["cat"], "calls": 0, "total_ms": 0.0, "self_ms": 0.0,
+            "max_ms": 0.0,
+        })
+        stage["calls"] += 1
+        stage["total_ms"] += event["dur"] / 1000
+        stage["self_ms"] += self_time / 1000
+        stage["max_ms"] = max(stage["max_ms"], event["dur"] / 1000)
+
+    all_self = sum(stage["self_ms"] for stage in stages.values()) or 1.0
+    for stage in stages.values():
+        stage["mean_ms"] = stage["total_ms"] / stage["calls"]
+        stage["self_share"] = stage["self_ms"] / all_self
+    return sorted(stages.values(), key=lambda stage: stage["self_ms"], reverse=True)
+
+
+def write_chrome_trace(events: List[Dict], trace_path: str) -> None:
+    """Write events as a trace for chrome://tracing or https://ui.perfetto.dev."""
+    with open(trace_path, "w") as file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
@@ -0,0 +1,40 @@
+import argparse
+import os
+import signal
+import socket
+
+from job_manager import JobManager
+
+# Same jobs folder as the Streamlit app, see app.JOBS_DIR
+DEFAULT_JOBS_DIR = os.path.join("videos", ".jobs")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Render queued split, pipeline and upload jobs. Run from the project root on every "
+                    "machine that shares the videos folder; each one adds its slots to the pool."
+    )
+    parser.add_argument("--jobs-dir", default=DEFAULT_JOBS_DIR, help="Shared job queue folder")
+    parser.add_argument("--slots", type=int, default=1,
+                        help="Jobs this machine renders at once, each with its own clip workers")
+    parser.add_argument("--node", default=socket.gethostname(), help="Name of this machine in job records")
+    parser.add_argument("--poll", type=float, default=1.0, help="Seconds between queue checks")
+    parser.add_argument("--memory-mb", type=float,
+                        help="Memory this machine's jobs may use together, estimated from each folder's last run")
+    args = parser.parse_args()
+
+    manager = JobManager(args.jobs_dir, max_concurrent=args.slots, poll_interval=args.poll, node=args.node,
+                         memory_budget_mb=args.memory_mb)
+
+    def shut_down(signum, frame):
+        # Running jobs go back to the queue for the other machines once the loop ends
+        manager.stop()
+
+    signal.signal(signal.SIGTERM, shut_down)
+    signal.signal(signal.SIGINT, shut_down)
+    print(f"Worker {args.node} rendering up to {args.slots} job(s) from {args.jobs_dir}", flush=True)
+    manager.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from moviepy.config import FFMPEG_BINARY
+from moviepy.tools import subprocess_call
+
+import render_profiler
+from media_probe import media_infos
+from progress_events import ProgressSink
+from smart_cut import concat_copy, mux
+
+# Outputs are never cut into segments shorter than this, process start-up
+# and the extra keyframes aren't worth it
+MIN_SEGMENT_SECONDS = 10.0
+
+
+def segment_count(duration: float, segments: Optional[int]) -> int:
+    """How many segments ``segments`` really gives for an output of ``duration`` seconds."""
+    if not segments or segments <= 1:
+        return 1
+    return max(1, min(segments, int(duration // MIN_SEGMENT_SECONDS)))
+
+
+def segment_frames(duration: float, fps: float, segments: int) -> List[Tuple[int, int]]:
+    """
+    Split an output into ``segments`` runs of whole frames.
+
+    The frame count is ``int(duration * fps)``, the same MoviePy's writer
+    produces, and each segment is ``(first_frame, frames)``.
+    """
+    total = int(duration * fps)
+    bounds = [round(idx * total / segments) for idx in range(segments + 1)]
+    return [(bounds[idx], bounds[idx + 1] - bounds[idx]) for idx in range(segments) if bounds[idx + 1] > bounds[idx]]
+
+
+def segment_range(first_frame: int, frames: int, fps: float) -> Tuple[float, float]:
+    """
+    Start time and duration to render a segment with MoviePy.
+
+    Half a frame of slack keeps ``int(duration * fps)`` from losing the
+    last frame to float rounding.
+    """
+    return first_frame / fps, (frames + 0.5) / fps
+
+
+def mix_audio_tracks(
+    inputs: Sequence[str],
+    duration: float,
+    output_path: str,
+    loop: Optional[Sequence[bool]] = None
+) -> Optional[str]:
+    """
+    Sum the audio of ``inputs`` over the first ``duration`` seconds into one AAC file.
+
+    Tracks are summed without scaling, like MoviePy's CompositeAudioClip,
+    and ones shorter than ``duration`` (e.g. a template) loop, or end where
+    they end when their ``loop`` flag is False.
+    Returns None when none of the inputs has audio.
+    """
+    loop = list(loop) if loop is not None else [True] * len(inputs)
+    with_audio = [(path, looped) for path, looped in zip(inputs, loop) if media_infos(path).get("audio_found")]
+    if not with_audio:
+        return None
+    args = [FFMPEG_BINARY, "-y", "-hide_banner"]
+    for path, looped in with_audio:
+        args += [*(["-stream_loop", "-1"] if looped else []), "-t", f"{duration:.6f}", "-i", path]
+    if len(with_audio) > 1:
+        labels = "".join(f"[{idx}:a]" for idx in range(len(with_audio)))
+        args += ["-filter_complex", f"{labels}amix=inputs={len(with_audio)}:duration=longest:normalize=0[aout]",
+                 "-map", "[aout]"]
+    else:
+        args += ["-map", "0:a:0"]
+    args += ["-vn", "-t", f"{duration:.6f}", "-c:a", "aac", output_path]
+    subprocess_call(args, logger=None)
+    return output_path
+
+
+def render_segmented(
+    segment_worker: Callable,
+    worker_args: tuple,
+    duration: float,
+    fps: float,
+    segments: int,
+    output_path: str,
+    render_audio: Callable[[str], Optional[str]],
+    threads: Optional[int] = None,
+    progress: Optional[ProgressSink] = None,
+    progress_label: str = "",
+    progress_stage: str = "compose",
+    shortest: bool = True
+) -> None:
+    """
+    Render one output as ``segments`` video-only parts in parallel processes
+    and join them losslessly.
+
+    Every part starts on a keyframe of its own and all parts are encoded by
+    the same worker with the same encoder settings, so the concat demuxer
+    can join them with a stream copy. Audio is rendered once for the whole
+    output while the video parts encode, so it has no seams at the joins.
+
+    Args:
+    segment_worker (Callable): Module-level function called in a worker
+        process as ``segment_worker(*worker_args, first_frame, frames, part_path, threads)``.
+    worker_args (tuple): Leading, picklable arguments of ``segment_worker``.
+    duration (float): Output duration in seconds.
+    fps (float): Output frame rate.
+    segments (int): Number of parts, see ``segment_count``.
+    output_path (str): Destination file.
+    render_audio (Callable): Writes the output's audio to the given path and
+        returns it, or returns None when the output has no audio.
+    threads (int): Encoder threads of each part.
+    progress (ProgressSink): Receives frame progress as parts finish.
+    progress_label (str): Clip name of the progress events.
+    progress_stage (str): Stage name of the progress events.
+    shortest (bool): Trim the output to the shorter stream, see ``mux``.
+    """
+    parts = segment_frames(duration, fps, segments)
+    total_frames = sum(frames for _, frames in parts)
+    started = time.perf_counter()
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as workdir:
+        part_paths = [os.path.join(workdir, f"part{idx:03d}.mp4") for idx in range(len(parts))]
+        with ProcessPoolExecutor(max_workers=len(parts), mp_context=get_context("spawn")) as executor:
+            futures = [
+                executor.submit(segment_worker, *worker_args, first_frame, frames, part_path, threads)
+                for (first_frame, frames), part_path in zip(parts, part_paths)
+            ]
+            with render_profiler.span("audio"):
+                audio_path = render_audio(os.path.join(workdir, "audio.m4a"))
+
+            frames_done = 0
+            for future, (_, frames) in zip(futures, parts):
+                future.result()
+                frames_done += frames
+                if progress is not None:
+                    progress.frames(progress_label, progress_stage, "video", frames_done, total_frames,
+                                    time.perf_counter() - started)
+
+        video_only = os.path.join(workdir, "video.mp4")
+        with render_profiler.span("concat"):
+            if len(part_paths) == 1:
+                os.replace(part_paths[0], video_only)
+            else:
+                concat_copy(part_paths, video_only, workdir)
+        with render_profiler.span("mux"):
+            mux(video_only, audio_path, output_path, shortest)
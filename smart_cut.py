@@ -0,0 +1,540 @@
+import os
+import re
+import subprocess
+import tempfile
+from bisect import bisect_right
+from fractions import Fraction
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from moviepy.config import FFMPEG_BINARY
+from moviepy.tools import subprocess_call
+
+import render_profiler
+from media_probe import keyframe_times, media_infos
+
+CUT_MODES = ("reencode", "copy", "smart")
+
+# Codecs we can re-encode edges for and still concat losslessly with the copied middle
+SMART_CUT_CODECS = {"h264"}
+
+# x264 profiles by the profile_idc of an H.264 sequence parameter set
+X264_PROFILES = {66: "baseline", 77: "main", 100: "high", 110: "high10", 122: "high422", 244: "high444"}
+
+# Sequence and picture parameter set fields re-encoded edges must share with the copied middle
+MATCHED_SPS_FIELDS = (
+    "profile_idc", "level_idc", "chroma_format_idc", "bit_depth_luma_minus8", "frame_mbs_only_flag",
+    "entropy_coding_mode_flag", "video_full_range_flag", "colour_primaries", "transfer_characteristics",
+    "matrix_coefficients",
+)
+
+_TIME_BASE_RE = re.compile(r"^#tb 0: (\d+)/(\d+)", re.MULTILINE)
+_SPS_FIELD_RE = re.compile(r"\]\s+\d+\s+(\w+)\s+[01]+ = (\d+)$")
+
+
+class Packet(NamedTuple):
+    """A video packet as listed by ffmpeg's framecrc muxer, timestamps in the stream's time base."""
+    dts: int
+    pts: int
+    duration: int
+    size: int
+    crc: str
+    key: bool
+    discard: bool
+
+
+def _ffmpeg(args: List[str]) -> None:
+    subprocess_call([FFMPEG_BINARY, "-y", "-hide_banner", *args], logger=None)
+
+
+def _parse_packet(line: str) -> Packet:
+    fields = [field.strip() for field in line.split(",")]
+    flags = int(fields[6].split("=")[1], 16) if len(fields) > 6 else 1
+    return Packet(int(fields[1]), int(fields[2]), int(fields[3]), int(fields[4]), fields[5], bool(flags & 1),
+                  bool(flags & 4))
+
+
+def list_packets(
+    args: List[str],
+    stop: Optional[Callable[[Packet, Fraction], bool]] = None
+) -> Tuple[Fraction, List[Packet]]:
+    """
+    Time base and packets, in decode order, of the first video stream ffmpeg ``args`` read.
+
+    Packets are stream-copied to framecrc, nothing is decoded. ``stop``
+    ends the listing early at the first packet it returns True for, given
+    the packet and the time base.
+    """
+    cmd = [FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", *args, "-map", "0:v:0", "-c", "copy",
+           "-f", "framecrc", "-"]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL, text=True)
+    time_base, packets, stopped = None, [], False
+    try:
+        for line in proc.stdout:
+            if line.startswith("#"):
+                match = _TIME_BASE_RE.match(line)
+                if match:
+                    time_base = Fraction(int(match.group(1)), int(match.group(2)))
+                continue
+            packets.append(_parse_packet(line))
+            if stop is not None and stop(packets[-1], time_base):
+                stopped = True
+                break
+    finally:
+        if stopped:
+            proc.kill()
+        stderr = proc.stderr.read()
+        proc.stdout.close()
+        proc.stderr.close()
+        proc.wait()
+    if not stopped and proc.returncode or time_base is None:
+        raise IOError(stderr)
+    return time_base, packets
+
+
+def _sps_fields(video_path: str) -> Dict[str, int]:
+    """Parameter set fields of the first video packet of an H.264 file, see MATCHED_SPS_FIELDS."""
+    proc = subprocess.run(
+        [FFMPEG_BINARY, "-hide_banner", "-i", video_path, "-map", "0:v:0", "-c", "copy",
+         "-bsf:v", "trace_headers", "-frames:v", "1", "-f", "null", "-"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL, text=True
+    )
+    fields = {}
+    for line in proc.stderr.splitlines():
+        match = _SPS_FIELD_RE.search(line)
+        # The first parameter sets are the stream's, later ones belong to its slices
+        if match and match.group(1) in MATCHED_SPS_FIELDS and match.group(1) not in fields:
+            fields[match.group(1)] = int(match.group(2))
+    # Defaults of fields that are only coded when they differ from them
+    fields.setdefault("chroma_format_idc", 1)
+    fields.setdefault("bit_depth_luma_minus8", 0)
+    fields.setdefault("video_full_range_flag", 0)
+    return fields
+
+
+def _reorder_delay(packets: List[Packet]) -> int:
+    """Frames a decoder holds back before the first one is shown, from the gap between decode and display order."""
+    display = {pts: idx for idx, pts in enumerate(sorted(packet.pts for packet in packets))}
+    return max((idx - display[packet.pts] for idx, packet in enumerate(packets)), default=0)
+
+
+def edge_encoder_args(sps: Dict[str, int], reorder_delay: int) -> Optional[List[str]]:
+    """
+    x264 settings whose output shares the source's profile, level, entropy
+    coder and reorder delay, None when x264 can't produce them.
+
+    Colour and range signalling follow the decoded frames.
+    """
+    profile = X264_PROFILES.get(sps.get("profile_idc"))
+    if profile is None or not sps.get("frame_mbs_only_flag", 1) or sps.get("level_idc", 0) < 10:
+        return None
+    if reorder_delay > 2 or profile == "baseline" and reorder_delay:
+        return None
+    params = [
+        f"cabac={sps.get('entropy_coding_mode_flag', 0)}",
+        # x264 writes the lowest profile its tools need, 8x8 transforms keep it at high
+        f"8x8dct={int(profile.startswith('high'))}",
+        ["bframes=0", "bframes=1", "bframes=3:b-pyramid=normal"][reorder_delay],
+    ]
+    return ["-profile:v", profile, "-level:v", f"{sps['level_idc'] / 10:.1f}", "-x264-params", ":".join(params)]
+
+
+def _encode_video_range(
+    src: str,
+    first_pts: float,
+    frames: int,
+    fps: float,
+    output_path: str,
+    preset: str,
+    threads: Optional[int] = None,
+    encoder_args: Optional[List[str]] = None,
+    time_base: Optional[Fraction] = None
+) -> None:
+    """Re-encode ``frames`` source frames from the one shown at ``first_pts``, with in-band parameter sets."""
+    time_base_args = []
+    if time_base is not None:
+        time_base_args = ["-enc_time_base", f"{time_base.numerator}/{time_base.denominator}",
+                          "-video_track_timescale", str(time_base.denominator // time_base.numerator)]
+    # The input seek decodes from the keyframe before and drops every frame shown before the cut
+    _ffmpeg([
+        "-ss", f"{max(0.0, first_pts - 0.5 / fps):.6f}", "-i", src,
+        "-map", "0:v:0", "-an", "-frames:v", str(frames), "-fps_mode", "passthrough",
+        "-c:v", "libx264", "-preset", preset, "-crf", "18",
+        *(encoder_args if encoder_args is not None else ["-pix_fmt", "yuv420p"]),
+        *(["-threads", str(threads)] if threads else []),
+        *time_base_args,
+        "-bsf:v", "h264_mp4toannexb,setts=pts=PTS-STARTPTS:dts=DTS-STARTPTS",
+        output_path,
+    ])
+
+
+def _copy_packets(src: str, first: Packet, count: int, time_base: Fraction, fps: float, output_path: str) -> List[Packet]:
+    """
+    Stream-copy ``count`` packets in decode order from the keyframe ``first``
+    and return the packets written, as the source lists them.
+
+    The seek lands on the keyframe and every packet from it on is kept, so
+    the copy starts and ends on packet boundaries rather than times.
+    """
+    proc = subprocess.run(
+        [FFMPEG_BINARY, "-y", "-hide_banner", "-loglevel", "error", "-copyts",
+         "-ss", f"{float(first.pts * time_base) + 0.25 / fps:.6f}", "-i", src,
+         "-map", "0:v:0", "-c", "copy", "-frames:v", str(count),
+         "-bsf:v", "h264_mp4toannexb,setts=pts=PTS-STARTPTS:dts=DTS-STARTPTS",
+         "-video_track_timescale", str(time_base.denominator // time_base.numerator), output_path,
+         "-map", "0:v:0", "-c", "copy", "-frames:v", str(count), "-f", "framecrc", "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL, text=True
+    )
+    if proc.returncode:
+        raise IOError(proc.stderr)
+    return [_parse_packet(line) for line in proc.stdout.splitlines() if line and not line.startswith("#")]
+
+
+def _copy_audio_range(src: str, start: float, end: float, output_path: str) -> None:
+    _ffmpeg([
+        "-ss", f"{start:.6f}", "-i", src,
+        "-t", f"{end - start:.6f}",
+        "-map", "0:a:0", "-vn", "-c", "copy",
+        output_path,
+    ])
+
+
+def encode_audio_range(src: str, start: float, end: float, output_path: str) -> None:
+    """Encode the audio of ``[start, end]`` in one piece, so it has no gaps at video joins."""
+    _ffmpeg([
+        "-ss", f"{start:.6f}", "-i", src,
+        "-t", f"{end - start:.6f}",
+        "-map", "0:a:0", "-vn",
+        "-c:a", "aac",
+        output_path,
+    ])
+
+
+def concat_copy(parts: List[str], output_path: str, workdir: str) -> None:
+    """Join parts with identical encoder parameters using the concat demuxer, without re-encoding."""
+    list_path = os.path.join(workdir, "parts.txt")
+    with open(list_path, "w") as file:
+        for part in parts:
+            file.write(f"file '{os.path.abspath(part)}'\n")
+    _ffmpeg(["-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", output_path])
+
+
+def _concat_frames(parts: List[Tuple[str, int]], fps: Fraction, time_base: Fraction, output_path: str,
+                   workdir: str) -> None:
+    """
+    Join parts of ``(path, frames)`` whose parameter sets are in-band, each
+    starting where the frames before it end.
+    """
+    list_path = os.path.join(workdir, "parts.txt")
+    with open(list_path, "w") as file:
+        for part, frames in parts:
+            # Exact durations, a container's own can be a frame off and send timestamps backwards at the join
+            file.write(f"file '{os.path.abspath(part)}'\nduration {float(frames / fps):.9f}\n")
+    _ffmpeg([
+        "-f", "concat", "-safe", "0", "-i", list_path, "-map", "0:v:0", "-c", "copy",
+        "-video_track_timescale", str(time_base.denominator // time_base.numerator), output_path,
+    ])
+
+
+def verify_frames(video_path: str, frames: int) -> bool:
+    """Whether a video shows exactly ``frames`` frames with strictly increasing timestamps."""
+    try:
+        _, packets = list_packets(["-i", video_path])
+    except IOError:
+        return False
+    shown = [packet for packet in packets if not packet.discard]
+    return (
+        len(shown) == frames
+        and all(later.dts > earlier.dts for earlier, later in zip(packets, packets[1:]))
+        and len({packet.pts for packet in shown}) == frames
+    )
+
+
+def mux(video_path: str, audio_path: Optional[str], output_path: str, shortest: bool = True) -> None:
+    """
+    Stream-copy a video-only file and an audio file into ``output_path``.
+
+    ``shortest`` trims the output to the shorter stream; turn it off when
+    the audio is copied AAC that may end a few ms before the last frame.
+    """
+    if audio_path is None:
+        os.replace(video_path, output_path)
+        return
+    _ffmpeg([
+        "-i", video_path, "-i", audio_path,
+        "-map", "0:v:0", "-map", "1:a:0",
+        "-c", "copy", *(["-shortest"] if shortest else []),
+        output_path,
+    ])
+
+
+def _source_window(video_path: str, start_time: float, end_time: float, keyframes: List[float],
+                   tolerance: float) -> Tuple[Fraction, List[Packet], bool]:
+    """
+    Packets of the source from a keyframe before the clip to two keyframes
+    after it, with their source timestamps, and whether they reach the end
+    of the stream.
+    """
+    # One more keyframe back, so the first one of the clip has packets before it to check its GOP against
+    seek_idx = bisect_right(keyframes, start_time + tolerance) - 2
+    seek_args = ["-copyts", "-ss", f"{keyframes[seek_idx]:.6f}"] if seek_idx >= 0 else []
+    keys_after = []
+
+    def past_clip(packet: Packet, time_base: Fraction) -> bool:
+        if packet.key and packet.pts * time_base >= end_time - tolerance:
+            keys_after.append(packet)
+        return len(keys_after) > 2
+
+    time_base, packets = list_packets([*seek_args, "-i", video_path], past_clip)
+    return time_base, packets, len(keys_after) <= 2
+
+
+def _clean_keys(packets: List[Packet], complete: bool) -> List[int]:
+    """
+    Decode indices of the keyframes the stream can be cut at: every packet
+    before one is shown before it and every packet from it on is shown from
+    it on, as in a closed GOP.
+    """
+    prefix_max, running = [], None
+    for packet in packets:
+        prefix_max.append(running)
+        running = packet.pts if running is None else max(running, packet.pts)
+    suffix_min, running = [0] * len(packets), None
+    for idx in range(len(packets) - 1, -1, -1):
+        running = packets[idx].pts if running is None else min(running, packets[idx].pts)
+        suffix_min[idx] = running
+    return [
+        idx for idx, packet in enumerate(packets)
+        if packet.key and not packet.discard and (prefix_max[idx] is None or prefix_max[idx] < packet.pts)
+        and suffix_min[idx] >= packet.pts
+        # The last listed keyframe's GOP may go on past the listing
+        and (complete or any(later.key for later in packets[idx + 1:]))
+    ]
+
+
+def cut_clip(
+    video_path: str,
+    start_time: float,
+    end_time: float,
+    output_path: str,
+    mode: str = "smart",
+    keyframes: Optional[List[float]] = None,
+    preset: str = "veryfast",
+    threads: Optional[int] = None,
+    render_audio: Optional[Callable[[float, float, str], Optional[str]]] = None,
+) -> Dict:
+    """
+    Cut ``[start_time, end_time]`` out of a video without a full re-encode.
+
+    The clip is the source frames shown from ``start_time`` up to
+    ``end_time``. ``copy`` stream-copies whole packets from the keyframe at
+    or before the start, so it is only frame accurate when the cut points
+    land on keyframes. ``smart`` stream-copies the GOPs inside the clip,
+    counted in packets from a keyframe, and re-encodes the partial GOPs at
+    each edge with the source's profile, level, entropy coder and reorder
+    delay. Every part carries its parameter sets in-band and the parts are
+    joined on the source's time base. When the edges can't match the
+    source, the GOPs aren't closed or the joined clip doesn't check out,
+    the whole range is re-encoded instead.
+
+    Args:
+    video_path (str): Path to the source video.
+    start_time (float): Clip start in seconds.
+    end_time (float): Clip end in seconds.
+    output_path (str): Destination file.
+    mode (str): Either "copy" or "smart".
+    keyframes (List[float]): Keyframe timestamps, probed when not given.
+    preset (str): x264 preset used for the re-encoded edges.
+    threads (int): Encoder thread limit, None lets x264 decide.
+    render_audio (Callable): Writes the audio of ``(start, end)`` to the
+        given path and returns it, or None for no audio. By default the
+        source's audio range is re-encoded (copied in "copy" mode).
+
+    Returns:
+    Dict: Report with the method used, the actual cut range and whether
+        the output was checked to hold exactly the requested frames.
+    """
+    if mode not in ("copy", "smart"):
+        raise ValueError(f"Unsupported cut mode '{mode}' for cut_clip")
+
+    infos = media_infos(video_path)
+    fps = infos.get("video_fps") or 25.0
+    duration = infos.get("duration") or end_time
+    has_audio = infos.get("audio_found", False)
+    end_time = min(end_time, duration)
+    if keyframes is None:
+        with render_profiler.span("keyframes"):
+            keyframes = keyframe_times(video_path)
+
+    # Anything closer than half a frame counts as being on the frame
+    tolerance = 0.5 / fps
+    report = {
+        "mode": mode,
+        "requested_start": start_time,
+        "requested_end": end_time,
+        "actual_start": start_time,
+        "actual_end": end_time,
+        "copied_seconds": 0.0,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+
+    with render_profiler.span("packets"):
+        time_base, packets, complete = _source_window(video_path, start_time, end_time, keyframes, tolerance)
+    shown = sorted(packet.pts for packet in packets if not packet.discard)
+    clip = [pts for pts in shown if start_time - tolerance <= pts * time_base < end_time - tolerance]
+    if not clip:
+        raise ValueError(f"No frames between {start_time:.3f}s and {end_time:.3f}s of {video_path}")
+    after_clip = next((pts for pts in shown if pts > clip[-1]), None)
+    durations = {packet.duration for packet in packets}
+    # Exact frame rate of a constant frame rate stream, from its packet duration
+    frame_rate = 1 / (durations.pop() * time_base) if len(durations) == 1 else Fraction(fps).limit_denominator(1001)
+    clean = _clean_keys(packets, complete)
+    by_pts = {packets[idx].pts: idx for idx in clean}
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as workdir:
+        video_only = os.path.join(workdir, "video.mp4")
+
+        if mode == "copy":
+            # A stream copy always begins on the keyframe at or before the start
+            first = max((idx for idx in clean if packets[idx].pts <= clip[0]), default=clean[0] if clean else 0)
+            last = max(idx for idx, packet in enumerate(packets) if packet.pts <= clip[-1])
+            with render_profiler.span("copy"):
+                copied = _copy_packets(video_path, packets[first], last + 1 - first, time_base, fps, video_only)
+            actual_start = float(packets[first].pts * time_base)
+            expected_frames = len([pts for pts in shown if packets[first].pts <= pts <= clip[-1]])
+            exact = (
+                copied == packets[first:last + 1] and packets[first].pts == clip[0]
+                and expected_frames == last + 1 - first and verify_frames(video_only, len(clip))
+            )
+            with render_profiler.span("audio"):
+                if render_audio is not None:
+                    audio_path = render_audio(actual_start, end_time, os.path.join(workdir, "audio.m4a"))
+                elif has_audio:
+                    audio_path = os.path.join(workdir, "audio.m4a")
+                    _copy_audio_range(video_path, actual_start, end_time, audio_path)
+                else:
+                    audio_path = None
+            with render_profiler.span("mux"):
+                mux(video_only, audio_path, output_path, shortest=render_audio is not None)
+            report.update(
+                method="copy",
+                actual_start=actual_start,
+                actual_end=actual_start + float(expected_frames / frame_rate),
+                copied_seconds=end_time - actual_start,
+                frame_accurate=exact,
+            )
+            return report
+
+        method = _smart_cut(video_path, packets, clip, after_clip, clean, by_pts, complete, time_base, frame_rate,
+                            fps, infos, preset, threads, video_only, workdir, report)
+        exact = verify_frames(video_only, len(clip))
+        if method == "smart" and not exact:
+            # A join that doesn't check out is re-encoded whole rather than shipped
+            method, report["copied_seconds"] = "reencode", 0.0
+            with render_profiler.span("encode full range"):
+                _encode_video_range(video_path, float(clip[0] * time_base), len(clip), fps, video_only, preset,
+                                    threads, time_base=time_base)
+            exact = verify_frames(video_only, len(clip))
+
+        audio_path = None
+        if render_audio is not None:
+            with render_profiler.span("audio"):
+                audio_path = render_audio(start_time, end_time, os.path.join(workdir, "audio.m4a"))
+        elif has_audio:
+            # Audio is re-encoded once for the whole range so it stays continuous across the joins
+            audio_path = os.path.join(workdir, "audio.m4a")
+            with render_profiler.span("encode audio"):
+                encode_audio_range(video_path, start_time, end_time, audio_path)
+
+        with render_profiler.span("mux"):
+            mux(video_only, audio_path, output_path)
+
+    actual_start = float(clip[0] * time_base)
+    report.update(
+        method=method,
+        actual_start=actual_start,
+        actual_end=actual_start + float(len(clip) / frame_rate),
+        frame_accurate=exact,
+    )
+    return report
+
+
+def _smart_cut(
+    video_path: str,
+    packets: List[Packet],
+    clip: List[int],
+    after_clip: Optional[int],
+    clean: List[int],
+    by_pts: Dict[int, int],
+    complete: bool,
+    time_base: Fraction,
+    frame_rate: Fraction,
+    fps: float,
+    infos: Dict,
+    preset: str,
+    threads: Optional[int],
+    video_only: str,
+    workdir: str,
+    report: Dict
+) -> str:
+    """Write the clip's video to ``video_only`` for cut_clip's "smart" mode and return the method used."""
+    # Clean keyframes inside the clip bound the copied middle; the clip's end is one too at the end of the stream
+    inside = [packets[idx].pts for idx in clean if clip[0] <= packets[idx].pts <= clip[-1]]
+    middle_start = inside[0] if inside else None
+    if after_clip is None and complete:
+        middle_end = None
+    else:
+        bounds = [pts for pts in inside if pts > (middle_start or 0)] + (
+            [after_clip] if after_clip in by_pts else []
+        )
+        middle_end = bounds[-1] if bounds else middle_start
+    middle = [pts for pts in clip if middle_start is not None and pts >= middle_start
+              and (middle_end is None or pts < middle_end)]
+
+    encoder_args = None
+    if infos.get("video_codec_name") in SMART_CUT_CODECS and middle:
+        sps = _sps_fields(video_path)
+        encoder_args = edge_encoder_args(sps, _reorder_delay(packets))
+
+    if encoder_args is None:
+        # No complete GOP inside the clip, open GOPs or edges x264 can't match: re-encode the whole range
+        with render_profiler.span("encode full range"):
+            _encode_video_range(video_path, float(clip[0] * time_base), len(clip), fps, video_only, preset, threads,
+                                time_base=time_base)
+        return "reencode"
+
+    head = [pts for pts in clip if pts < middle[0]]
+    tail = [pts for pts in clip if pts > middle[-1]]
+    first = by_pts[middle[0]]
+    parts = []
+    for name, frames in (("head", head), ("middle", middle), ("tail", tail)):
+        if not frames:
+            continue
+        part = os.path.join(workdir, f"{name}.mp4")
+        if name == "middle":
+            with render_profiler.span("copy middle"):
+                copied = _copy_packets(video_path, packets[first], len(middle), time_base, fps, part)
+            if copied != packets[first:first + len(middle)]:
+                return _reencode_fallback(video_path, clip, time_base, fps, preset, threads, video_only)
+        else:
+            with render_profiler.span(f"encode {name}"):
+                _encode_video_range(video_path, float(frames[0] * time_base), len(frames), fps, part, preset,
+                                    threads, encoder_args, time_base)
+            matched = {key: value for key, value in _sps_fields(part).items() if key in sps}
+            if matched != {key: value for key, value in sps.items() if key in matched} or \
+                    _reorder_delay(list_packets(["-i", part])[1]) != _reorder_delay(packets):
+                # The edge came out with other parameters than the source's, it can't be spliced in
+                return _reencode_fallback(video_path, clip, time_base, fps, preset, threads, video_only)
+        parts.append((part, len(frames)))
+
+    with render_profiler.span("concat"):
+        _concat_frames(parts, frame_rate, time_base, video_only, workdir)
+    report["copied_seconds"] = float(len(middle) / frame_rate)
+    return "smart"
+
+
+def _reencode_fallback(video_path: str, clip: List[int], time_base: Fraction, fps: float, preset: str,
+                       threads: Optional[int], video_only: str) -> str:
+    with render_profiler.span("encode full range"):
+        _encode_video_range(video_path, float(clip[0] * time_base), len(clip), fps, video_only, preset, threads,
+                            time_base=time_base)
+    return "reencode"
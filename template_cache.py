@@ -0,0 +1,190 @@
+import hashlib
+import json
+import math
+import os
+import subprocess
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from moviepy.config import FFMPEG_BINARY
+
+from media_probe import media_infos
+from render_cache import file_fingerprint
+
+TEMPLATE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "video_automation", "templates")
+
+# Decoded frames kept per template; a 1080x1920 frame is about 6 MB, so this
+# holds a minute of a moving background, or any length of a static one
+DEFAULT_TEMPLATE_CACHE_MB = 2048
+
+# Decoded templates kept on disk, least recently used ones beyond it are removed
+DEFAULT_KEPT_TEMPLATES = 4
+
+# Bump when the cache layout changes, older caches are decoded again
+TEMPLATE_CACHE_VERSION = 1
+
+
+def loop_frame_index(t: float, fps: float, frame_count: Optional[int]) -> int:
+    """Frame shown at ``t`` of a template looped every ``frame_count`` frames, as MoviePy rounds times."""
+    index = int(fps * t + 0.00001)
+    return index % frame_count if frame_count else index
+
+
+class TemplateFrames:
+    """
+    Decoded frames of a background template, memory-mapped from disk.
+
+    A template is decoded once into an RGB frame store shared by every
+    clip, process and worker that composes on it, instead of each compose
+    decoding it again from its first frame. Consecutive identical frames
+    are stored once, so a still background costs a single frame. The
+    template loops seamlessly when a clip is longer than it.
+
+    Use ``template_frames`` to get one, which decodes on first use.
+    """
+
+    def __init__(self, meta: Dict, frames_path: str):
+        self.fps = meta["fps"]
+        self.size: Tuple[int, int] = tuple(meta["size"])
+        # Frames of the whole template, None when only its first ``len(slots)`` are stored
+        self.frame_count: Optional[int] = meta["frame_count"]
+        self.slots = np.asarray(meta["slots"], dtype=np.int64)
+        width, height = self.size
+        self.frames = np.memmap(frames_path, dtype=np.uint8, mode="r", shape=(meta["stored"], height, width, 3))
+
+    def covers(self, duration: float) -> bool:
+        """Whether every frame of an output of ``duration`` seconds is stored."""
+        return self.frame_count is not None or len(self.slots) >= math.ceil(duration * self.fps)
+
+    def get_frame(self, t: float) -> np.ndarray:
+        """
+        Read-only frame at ``t``, looping past the template's end.
+
+        Same signature as ``VideoFileClip.get_frame``, so it can be the
+        background of a ``LayerCompositor``.
+        """
+        index = loop_frame_index(t, self.fps, self.frame_count)
+        # Past the stored frames of a partial cache, see covers()
+        return self.frames[self.slots[min(index, len(self.slots) - 1)]]
+
+
+def _cache_paths(template_path: str, cache_dir: str) -> Tuple[str, str]:
+    key = hashlib.sha256(
+        f"{TEMPLATE_CACHE_VERSION}\0{file_fingerprint(template_path)}".encode("utf8")
+    ).hexdigest()[:32]
+    return os.path.join(cache_dir, f"{key}.json"), os.path.join(cache_dir, f"{key}.rgb")
+
+
+def _load(meta_path: str, frames_path: str) -> Optional[TemplateFrames]:
+    try:
+        with open(meta_path, "r") as file:
+            meta = json.load(file)
+        return TemplateFrames(meta, frames_path)
+    except (FileNotFoundError, json.JSONDecodeError, KeyError, ValueError):
+        return None
+
+
+def _evict(cache_dir: str, keep: int) -> None:
+    metas = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith(".json")]
+    metas.sort(key=os.path.getmtime, reverse=True)
+    for meta_path in metas[keep:]:
+        for path in (meta_path, meta_path[:-len(".json")] + ".rgb"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def _decode(template_path: str, frames: Optional[int], frames_path: str, max_bytes: int) -> Optional[Dict]:
+    """Decode up to ``frames`` frames into ``frames_path``, None when they don't fit in ``max_bytes``."""
+    infos = media_infos(template_path)
+    width, height = infos["video_size"]
+    frame_bytes = width * height * 3
+    cmd = [
+        FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-i", template_path, "-map", "0:v:0",
+        *(["-frames:v", str(frames)] if frames else []),
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "-",
+    ]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL,
+                            bufsize=frame_bytes)
+    slots, stored, previous = [], 0, None
+    try:
+        with open(frames_path, "wb") as file:
+            while frames is None or len(slots) < frames:
+                raw = proc.stdout.read(frame_bytes)
+                if len(raw) < frame_bytes:
+                    break
+                if raw != previous:
+                    if (stored + 1) * frame_bytes > max_bytes:
+                        return None
+                    file.write(raw)
+                    stored, previous = stored + 1, raw
+                slots.append(stored - 1)
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        stderr = proc.stderr.read()
+        proc.stderr.close()
+        proc.wait()
+    if not slots:
+        raise IOError(f"No frames decoded from {template_path}: {stderr.decode('utf8', errors='replace')}")
+    return {
+        "fps": infos["video_fps"],
+        "size": [width, height],
+        # Fewer frames than asked for means the decode reached the end of the template
+        "frame_count": len(slots) if frames is None or len(slots) < frames else None,
+        "stored": stored,
+        "slots": slots,
+    }
+
+
+def template_frames(
+    template_path: str,
+    duration: Optional[float] = None,
+    max_mb: float = DEFAULT_TEMPLATE_CACHE_MB,
+    cache_dir: str = TEMPLATE_CACHE_DIR
+) -> Optional[TemplateFrames]:
+    """
+    The template's decoded frames, decoding them on first use.
+
+    Args:
+    template_path (str): Background template.
+    duration (float): Longest output composed on it; only the frames it
+        needs are decoded, the whole template by default.
+    max_mb (float): Size limit of the stored frames.
+    cache_dir (str): Where decoded templates are kept, keyed by content.
+
+    Returns:
+    TemplateFrames: The frames, or None when they would exceed ``max_mb``
+        and the template should be decoded per clip instead.
+    """
+    meta_path, frames_path = _cache_paths(template_path, cache_dir)
+    cached = _load(meta_path, frames_path)
+    if cached is not None and (duration is None and cached.frame_count is not None
+                               or duration is not None and cached.covers(duration)):
+        # Mark it recently used
+        os.utime(meta_path)
+        return cached
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fps = media_infos(template_path)["video_fps"]
+    frames = math.ceil(duration * fps) if duration is not None else None
+    # Write then rename so concurrent composes never map a partial store
+    tmp_frames_path = f"{frames_path}.{os.getpid()}.tmp"
+    try:
+        meta = _decode(template_path, frames, tmp_frames_path, int(max_mb * 1024 * 1024))
+        if meta is None:
+            print(f"Decoded frames of {template_path} exceed {max_mb:g} MB, decoding it per clip")
+            return None
+        tmp_meta_path = f"{meta_path}.{os.getpid()}.tmp"
+        with open(tmp_meta_path, "w") as file:
+            json.dump(meta, file)
+        os.replace(tmp_frames_path, frames_path)
+        os.replace(tmp_meta_path, meta_path)
+    finally:
+        if os.path.exists(tmp_frames_path):
+            os.remove(tmp_frames_path)
+    frames = TemplateFrames(meta, frames_path)
+    # Removed stores stay readable through the mappings of the composes using them
+    _evict(cache_dir, DEFAULT_KEPT_TEMPLATES)
+    return frames
@@ -0,0 +1,278 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+# The upload engine lives at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import upload_engine
+from render_cache import file_fingerprint
+from upload_engine import CHUNK_GRANULARITY, UPLOAD_PATH, SessionStore, TokenBucket, UploadEngine
+
+METADATA = {"snippet": {"title": "clip"}, "status": {"privacyStatus": "private"}}
+
+
+class FakeYouTube(ThreadingHTTPServer):
+    """
+    Local stand-in for YouTube's resumable upload endpoint.
+
+    Keeps the bytes received per session and logs every request. ``faults``
+    are served, in order, to the next chunk PUTs instead of storing them:
+    an int is answered with that status, "partial" keeps only half of the
+    chunk and answers 308 with the shorter range. Unknown sessions get 404.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.sessions = {}
+        self.requests = []
+        self.faults = []
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def open_session(self, total: int, received: bytes = b"") -> str:
+        with self.lock:
+            session_id = str(len(self.sessions))
+            self.sessions[session_id] = {"total": total, "data": bytearray(received)}
+        return f"{self.base_url}/session/{session_id}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append(("POST", self.path, None))
+        assert self.path.startswith(UPLOAD_PATH + "?uploadType=resumable")
+        assert json.loads(body) == METADATA
+        location = self.server.open_session(int(self.headers["X-Upload-Content-Length"]))
+        self._reply(200, {"Location": location})
+
+    def do_PUT(self):
+        content_range = self.headers["Content-Range"]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append(("PUT", self.path, content_range))
+        session = self.server.sessions.get(self.path.rpartition("/")[2])
+        if session is None:
+            self._reply(404)
+            return
+        data, total = session["data"], session["total"]
+
+        fault = None
+        if not content_range.startswith("bytes */"):
+            with self.server.lock:
+                fault = self.server.faults.pop(0) if self.server.faults else None
+            first = int(content_range.split()[1].split("-")[0])
+            assert first == len(data), "chunk doesn't start where the server's bytes end"
+            assert len(body) == int(content_range.split("-")[1].split("/")[0]) - first + 1
+            if isinstance(fault, int):
+                self._reply(fault)
+                return
+            data.extend(body[:len(body) // 2] if fault == "partial" else body)
+
+        if len(data) == total:
+            self._reply(201, body=json.dumps({"id": "video-id"}).encode())
+        else:
+            self._reply(308, {"Range": f"bytes=0-{len(data) - 1}"} if data else {})
+
+    def _reply(self, status, headers=None, body=b""):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    server = FakeYouTube()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def media_file(tmp_path):
+    path = tmp_path / "final_clip.mp4"
+    path.write_bytes(os.urandom(5 * CHUNK_GRANULARITY + 1000))
+    return str(path)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Backoff delays of the engine, recorded instead of slept."""
+    delays = []
+    monkeypatch.setattr(upload_engine.time, "sleep", delays.append)
+    return delays
+
+
+def _engine(server, tmp_path, **kwargs) -> UploadEngine:
+    store = SessionStore(str(tmp_path / "sessions.json"))
+    return UploadEngine(requests.Session(), store, base_url=server.base_url, **kwargs)
+
+
+def _chunk_ranges(server):
+    return [content_range for method, _, content_range in server.requests
+            if method == "PUT" and not content_range.startswith("bytes */")]
+
+
+def _uploaded(server, media_file) -> bool:
+    with open(media_file, "rb") as file:
+        return [bytes(session["data"]) for session in server.sessions.values()] == [file.read()]
+
+
+def test_uploads_in_chunks_with_content_range(server, tmp_path, media_file):
+    engine = _engine(server, tmp_path, chunk_size=2 * CHUNK_GRANULARITY + 1)
+    total = os.path.getsize(media_file)
+
+    assert engine.upload(media_file, METADATA) == "video-id"
+
+    chunk = 2 * CHUNK_GRANULARITY
+    assert _chunk_ranges(server) == [
+        f"bytes 0-{chunk - 1}/{total}",
+        f"bytes {chunk}-{2 * chunk - 1}/{total}",
+        f"bytes {2 * chunk}-{total - 1}/{total}",
+    ]
+    assert _uploaded(server, media_file)
+    assert SessionStore(str(tmp_path / "sessions.json")).get(file_fingerprint(media_file)) is None
+
+
+def test_retries_5xx_with_backoff_from_the_servers_offset(server, tmp_path, media_file, sleeps):
+    engine = _engine(server, tmp_path, chunk_size=2 * CHUNK_GRANULARITY)
+    server.faults = [None, 503, 500, 502]
+
+    assert engine.upload(media_file, METADATA) == "video-id"
+
+    assert len(sleeps) == 3
+    # Exponential backoff with up to a second of jitter
+    assert [int(delay) for delay in sleeps] == [1, 2, 4]
+    # Every failure asks the server what it has before sending again
+    statuses = [content_range for method, _, content_range in server.requests if method == "PUT"]
+    assert statuses.count(f"bytes */{os.path.getsize(media_file)}") == 3
+    assert _uploaded(server, media_file)
+
+
+def test_gives_up_after_max_retries(server, tmp_path, media_file, sleeps):
+    engine = _engine(server, tmp_path, max_retries=2)
+    server.faults = [503] * 3
+
+    with pytest.raises(upload_engine.UploadError, match="after 2 retries"):
+        engine.upload(media_file, METADATA)
+    assert len(sleeps) == 2
+
+
+def test_resends_what_a_308_says_is_missing(server, tmp_path, media_file, sleeps):
+    engine = _engine(server, tmp_path, chunk_size=2 * CHUNK_GRANULARITY)
+    server.faults = ["partial"]
+
+    assert engine.upload(media_file, METADATA) == "video-id"
+
+    assert _chunk_ranges(server)[1].startswith(f"bytes {CHUNK_GRANULARITY}-")
+    assert not sleeps
+    assert _uploaded(server, media_file)
+
+
+def test_resumes_a_stored_session(server, tmp_path, media_file):
+    with open(media_file, "rb") as file:
+        received = file.read(3 * CHUNK_GRANULARITY)
+    total = os.path.getsize(media_file)
+    session_uri = server.open_session(total, received)
+    SessionStore(str(tmp_path / "sessions.json")).put(file_fingerprint(media_file), session_uri)
+    engine = _engine(server, tmp_path, chunk_size=CHUNK_GRANULARITY)
+
+    assert engine.upload(media_file, METADATA) == "video-id"
+
+    # No new session, the first request asks where the stored one stands
+    assert [method for method, _, _ in server.requests].count("POST") == 0
+    assert server.requests[0] == ("PUT", "/session/0", f"bytes */{total}")
+    assert _chunk_ranges(server)[0] == f"bytes {3 * CHUNK_GRANULARITY}-{4 * CHUNK_GRANULARITY - 1}/{total}"
+    assert _uploaded(server, media_file)
+
+
+def test_starts_over_when_the_stored_session_expired(server, tmp_path, media_file):
+    SessionStore(str(tmp_path / "sessions.json")).put(file_fingerprint(media_file), f"{server.base_url}/session/gone")
+    engine = _engine(server, tmp_path)
+
+    assert engine.upload(media_file, METADATA) == "video-id"
+
+    assert [method for method, _, _ in server.requests][:2] == ["PUT", "POST"]
+    assert _uploaded(server, media_file)
+
+
+def test_token_bucket_limits_the_rate():
+    bucket = TokenBucket(1_000_000)
+    started = time.monotonic()
+    # A second's worth of burst goes at once, the next half second is paced
+    for _ in range(30):
+        bucket.consume(50_000)
+    assert 0.45 < time.monotonic() - started < 1.0
+
+
+def test_engine_uploads_within_the_bandwidth_limit(server, tmp_path, media_file):
+    rate = 2 * CHUNK_GRANULARITY
+    engine = _engine(server, tmp_path, chunk_size=CHUNK_GRANULARITY, max_bytes_per_second=rate)
+    started = time.monotonic()
+
+    assert engine.upload(media_file, METADATA) == "video-id"
+
+    # Everything beyond the first second's burst is sent at ``rate``
+    assert time.monotonic() - started >= (os.path.getsize(media_file) - rate) / rate * 0.95
+    assert _uploaded(server, media_file)
+
+
+class _DropsFirstChunk(requests.Session):
+    """Loses the connection in the middle of the first chunk's response."""
+
+    dropped = False
+
+    def request(self, method, url, *args, **kwargs):
+        content_range = kwargs.get("headers", {}).get("Content-Range", "")
+        if method == "PUT" and not content_range.startswith("bytes */") and not self.dropped:
+            self.dropped = True
+            super().request(method, url, *args, **kwargs)
+            raise requests.exceptions.ChunkedEncodingError("Connection broken: IncompleteRead")
+        return super().request(method, url, *args, **kwargs)
+
+
+def test_resumes_after_a_connection_drops_mid_response(server, tmp_path, media_file, sleeps):
+    store = SessionStore(str(tmp_path / "sessions.json"))
+    engine = UploadEngine(_DropsFirstChunk(), store, base_url=server.base_url, chunk_size=2 * CHUNK_GRANULARITY)
+
+    assert engine.upload(media_file, METADATA) == "video-id"
+
+    assert len(sleeps) == 1
+    assert _uploaded(server, media_file)
+
+
+def test_refreshes_credentials_on_401_and_resends(server, tmp_path, media_file, sleeps):
+    pytest.importorskip("google.auth")
+
+    class Credentials:
+        refreshed = 0
+
+        def refresh(self, request):
+            self.refreshed += 1
+
+    http = requests.Session()
+    http.credentials = Credentials()
+    engine = UploadEngine(http, SessionStore(str(tmp_path / "sessions.json")), base_url=server.base_url,
+                          chunk_size=2 * CHUNK_GRANULARITY)
+    server.faults = [None, 401]
+
+    assert engine.upload(media_file, METADATA) == "video-id"
+
+    assert http.credentials.refreshed == 1
+    assert _uploaded(server, media_file)
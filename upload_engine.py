@@ -0,0 +1,404 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Dict, List, Optional
+
+import requests
+
+from progress_events import ProgressSink
+from render_cache import file_fingerprint
+from video_config import ConfigError, load_config, require_valid
+
+YOUTUBE_BASE_URL = "https://www.googleapis.com"
+UPLOAD_PATH = "/upload/youtube/v3/videos"
+
+# Chunks other than the last must be a multiple of 256 KiB
+CHUNK_GRANULARITY = 256 * 1024
+
+# The "upload" section of config.json, see upload_folder
+DEFAULT_UPLOAD = {
+    "base_url": YOUTUBE_BASE_URL,
+    "concurrency": 2,
+    "chunk_mb": 8,
+    "max_retries": 8,
+    "max_bytes_per_second": None,
+    "privacy_status": "private",
+    "category_id": "22",
+    "tags": [],
+}
+
+RETRY_STATUSES = (500, 502, 503, 504)
+# A connection dropped mid-response surfaces as ChunkedEncodingError rather than ConnectionError
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+class UploadError(Exception):
+    """The server rejected an upload for a reason retrying won't fix."""
+
+
+class _Retryable(Exception):
+    """A connection error or 5xx response, worth another try."""
+
+
+class _SessionExpired(Exception):
+    """The server no longer knows the session URI."""
+
+
+class TokenBucket:
+    """
+    Thread-safe bandwidth limit shared by every concurrent upload.
+
+    ``consume`` blocks until ``amount`` bytes fit in the budget, refilled at
+    ``rate`` bytes per second up to one second's worth of burst.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # A block larger than the bucket may go once the bucket is full
+                wanted = min(amount, self.capacity)
+                if self.tokens >= wanted:
+                    self.tokens -= amount
+                    return
+                wait = (wanted - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SessionStore:
+    """
+    Resumable session URIs persisted to a JSON file.
+
+    Sessions are keyed by the file's content fingerprint, so a restarted
+    process resumes the same file mid-way, while an edited file starts a
+    new upload. Finished uploads are forgotten.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._load().get(key)
+
+    def put(self, key: str, session_uri: str) -> None:
+        with self._lock:
+            sessions = self._load()
+            sessions[key] = session_uri
+            self._save(sessions)
+
+    def forget(self, key: str) -> None:
+        with self._lock:
+            sessions = self._load()
+            if sessions.pop(key, None) is not None:
+                self._save(sessions)
+
+    def _load(self) -> Dict[str, str]:
+        try:
+            with open(self.path, "r") as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save(self, sessions: Dict[str, str]) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(sessions, file, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class _ChunkReader:
+    """File-like view of one chunk that reads through the bandwidth limit."""
+
+    BLOCK = 64 * 1024
+
+    def __init__(self, file, length: int, bucket: Optional[TokenBucket]):
+        self.file = file
+        self.remaining = length
+        self.bucket = bucket
+
+    def __len__(self) -> int:
+        return self.remaining
+
+    def read(self, size: int = -1) -> bytes:
+        size = self.BLOCK if size is None or size < 0 else min(size, self.BLOCK)
+        size = min(size, self.remaining)
+        if size <= 0:
+            return b""
+        if self.bucket is not None:
+            self.bucket.consume(size)
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+class UploadEngine:
+    """
+    Upload videos with YouTube's resumable upload protocol.
+
+    Every file gets a session URI, persisted in ``session_store``, and is
+    sent in ``chunk_size`` pieces. Connection errors and 5xx responses are
+    retried with exponential backoff, each time asking the server how many
+    bytes it already has, so nothing is sent twice. A 401 refreshes the
+    ``credentials`` of ``http``, if it has any, and is retried the same
+    way. All uploads of an engine share one bandwidth limit.
+
+    Args:
+    http (requests.Session): Sends the requests, e.g. a google-auth
+        ``AuthorizedSession``; a plain session works against a local server.
+    session_store (SessionStore): Where resumable session URIs are kept.
+    base_url (str): Scheme and host of the upload endpoint.
+    chunk_size (int): Bytes per request, rounded down to a multiple of 256 KiB.
+    max_retries (int): Consecutive failures tolerated per file.
+    max_bytes_per_second (float): Total upload bandwidth, None for unlimited.
+    """
+
+    def __init__(
+        self,
+        http: requests.Session,
+        session_store: SessionStore,
+        base_url: str = YOUTUBE_BASE_URL,
+        chunk_size: int = DEFAULT_UPLOAD["chunk_mb"] * 1024 * 1024,
+        max_retries: int = DEFAULT_UPLOAD["max_retries"],
+        max_bytes_per_second: Optional[float] = None,
+        timeout: float = 60.0
+    ):
+        self.http = http
+        self.sessions = session_store
+        self.base_url = base_url.rstrip("/")
+        self.chunk_size = max(CHUNK_GRANULARITY, chunk_size // CHUNK_GRANULARITY * CHUNK_GRANULARITY)
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(max_bytes_per_second) if max_bytes_per_second else None
+        self.timeout = timeout
+
+    def upload(
+        self,
+        media_file: str,
+        metadata: Dict,
+        progress: Optional[ProgressSink] = None,
+        progress_label: str = ""
+    ) -> str:
+        """
+        Upload one file, resuming a previous session of it if there is one.
+
+        Args:
+        media_file (str): Video to upload.
+        metadata (Dict): The video resource, i.e. its ``snippet`` and ``status``.
+        progress (ProgressSink): Receives bytes sent as "upload" progress events.
+        progress_label (str): Clip name of the events.
+
+        Returns:
+        str: The id of the uploaded video.
+        """
+        total = os.path.getsize(media_file)
+        key = file_fingerprint(media_file)
+        started = time.perf_counter()
+        failures = 0
+
+        with open(media_file, "rb") as file:
+            session_uri = self.sessions.get(key)
+            offset = None
+            while True:
+                try:
+                    if session_uri is None:
+                        session_uri = self._start_session(metadata, total)
+                        self.sessions.put(key, session_uri)
+                        offset = 0
+                    if offset is None:
+                        # After a restart or a failure the server knows best what it has
+                        offset, video = self._query_offset(session_uri, total)
+                        if video is not None:
+                            break
+                    offset, video = self._send_chunk(file, session_uri, offset, total)
+                    failures = 0
+                    if progress is not None:
+                        progress.frames(progress_label, "upload", "bytes", offset, total,
+                                        time.perf_counter() - started)
+                    if video is not None:
+                        break
+                except _SessionExpired:
+                    self.sessions.forget(key)
+                    session_uri, offset = None, None
+                except _Retryable as e:
+                    failures += 1
+                    if failures > self.max_retries:
+                        raise UploadError(f"Giving up on {media_file} after {self.max_retries} retries: {e}")
+                    delay = min(2 ** (failures - 1), 64) + random.random()
+                    print(f"Upload of {media_file} interrupted ({e}), retrying in {delay:.1f}s")
+                    time.sleep(delay)
+                    offset = None
+
+        self.sessions.forget(key)
+        return video["id"]
+
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        try:
+            response = self.http.request(method, url, timeout=self.timeout, **kwargs)
+        except RETRY_EXCEPTIONS as e:
+            raise _Retryable(f"{type(e).__name__}: {e}")
+        if response.status_code in RETRY_STATUSES:
+            raise _Retryable(f"HTTP {response.status_code}")
+        if response.status_code == 401 and getattr(self.http, "credentials", None) is not None:
+            # The session doesn't refresh and resend itself (see engine_for_folder), a chunk's
+            # body can only be read once; refresh here and send again from the server's offset
+            from google.auth.transport.requests import Request
+
+            self.http.credentials.refresh(Request())
+            raise _Retryable("HTTP 401, access token refreshed")
+        return response
+
+    def _start_session(self, metadata: Dict, total: int) -> str:
+        response = self._request(
+            "POST",
+            f"{self.base_url}{UPLOAD_PATH}",
+            params={"uploadType": "resumable", "part": ",".join(metadata)},
+            json=metadata,
+            headers={"X-Upload-Content-Length": str(total), "X-Upload-Content-Type": "video/*"},
+        )
+        if response.status_code != 200 or "Location" not in response.headers:
+            raise UploadError(f"Could not start an upload session: HTTP {response.status_code} {response.text}")
+        return response.headers["Location"]
+
+    def _query_offset(self, session_uri: str, total: int):
+        response = self._request("PUT", session_uri, headers={"Content-Range": f"bytes */{total}"}, data=b"")
+        return self._parse_progress(response)
+
+    def _send_chunk(self, file, session_uri: str, offset: int, total: int):
+        length = min(self.chunk_size, total - offset)
+        file.seek(offset)
+        # An empty file is a single zero-length request
+        content_range = f"bytes {offset}-{offset + length - 1}/{total}" if length else f"bytes */{total}"
+        response = self._request(
+            "PUT",
+            session_uri,
+            data=_ChunkReader(file, length, self.bucket),
+            headers={"Content-Range": content_range, "Content-Length": str(length)},
+        )
+        return self._parse_progress(response)
+
+    @staticmethod
+    def _parse_progress(response: requests.Response):
+        """(bytes the server has, the video resource once the upload is complete)"""
+        if response.status_code in (200, 201):
+            return None, response.json()
+        if response.status_code == 308:
+            # "Range: bytes=0-N" is the last byte received, missing when nothing arrived
+            received = response.headers.get("Range")
+            return (int(received.rpartition("-")[2]) + 1 if received else 0), None
+        if response.status_code in (404, 410):
+            raise _SessionExpired()
+        raise UploadError(f"Upload failed: HTTP {response.status_code} {response.text}")
+
+
+def video_metadata(clip_config: Dict, settings: Dict) -> Dict:
+    """The YouTube video resource of a clip from its config.json entry."""
+    return {
+        "snippet": {
+            "categoryId": str(clip_config.get("category_id", settings["category_id"])),
+            "title": clip_config["title"],
+            "description": clip_config.get("description", ""),
+            "tags": list(clip_config.get("tags", settings["tags"])),
+        },
+        "status": {
+            "privacyStatus": clip_config.get("privacy_status", settings["privacy_status"]),
+        },
+    }
+
+
+def engine_for_folder(folder_path: str, config: Dict, http: Optional[requests.Session] = None) -> UploadEngine:
+    """
+    An engine configured from the ``upload`` section of config.json.
+
+    Sessions are stored in ``<folder>/.upload_sessions.json``; without
+    ``http`` the YouTube credentials of ``youtube_uploader`` are used.
+    """
+    settings = dict(DEFAULT_UPLOAD, **config.get("upload", {}))
+    if http is None:
+        from google.auth.transport.requests import AuthorizedSession
+        from youtube_uploader import authenticate
+
+        # No refresh-and-resend inside the session, UploadEngine._request refreshes on a 401
+        http = AuthorizedSession(authenticate(), refresh_status_codes=())
+    return UploadEngine(
+        http,
+        SessionStore(os.path.join(folder_path, ".upload_sessions.json")),
+        base_url=settings["base_url"],
+        chunk_size=int(settings["chunk_mb"] * 1024 * 1024),
+        max_retries=settings["max_retries"],
+        max_bytes_per_second=settings["max_bytes_per_second"],
+    )
+
+
+def upload_folder(
+    folder_path: str,
+    config: Dict,
+    engine: Optional[UploadEngine] = None,
+    progress: Optional[ProgressSink] = None
+) -> List[Dict]:
+    """
+    Upload the final clip of every configured clip of a folder.
+
+    Titles, descriptions and tags come from ``clips_config``; at most
+    ``upload.concurrency`` files are uploaded at once.
+
+    Args:
+    folder_path (str): Video folder containing config.json.
+    config (Dict): The folder's parsed config.
+    engine (UploadEngine): Engine to use, built from the config if None.
+    progress (ProgressSink): Receives per-clip "upload" events.
+
+    Returns:
+    List[Dict]: One report per clip with name, status, final_clip and
+        video_id or error.
+    """
+    require_valid(config, ("upload",))
+    settings = dict(DEFAULT_UPLOAD, **config.get("upload", {}))
+    final_folder = config.get("final_folder", os.path.join(folder_path, "final"))
+    engine = engine or engine_for_folder(folder_path, config)
+
+    def upload_clip(clip_config: Dict) -> Dict:
+        name = clip_config.get("name")
+        report = {"name": name, "final_clip": os.path.join(final_folder, f"final_{name}.mp4")}
+        try:
+            with progress.stage(name, "upload") if progress else nullcontext():
+                report["video_id"] = engine.upload(
+                    report["final_clip"], video_metadata(clip_config, settings), progress, name
+                )
+            report["status"] = "ok"
+            print(f"Clip '{name}' uploaded with ID: {report['video_id']}")
+        except Exception as e:
+            report.update(status="failed", error=f"{type(e).__name__}: {e}")
+            print(f"Clip '{name}' failed to upload: {report['error']}")
+        return report
+
+    with ThreadPoolExecutor(max_workers=max(1, settings["concurrency"]), thread_name_prefix="upload") as pool:
+        return list(pool.map(upload_clip, config.get("clips_config", [])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upload every final clip of a video folder to YouTube.")
+    parser.add_argument("folder", help="Video folder containing config.json, e.g. videos/video1")
+    args = parser.parse_args()
+
+    try:
+        config = load_config(os.path.join(args.folder, "config.json"))
+        require_valid(config, ("upload",))
+    except ConfigError as e:
+        raise SystemExit("\n".join(e.problems))
+    upload_folder(args.folder, config)
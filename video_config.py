@@ -0,0 +1,384 @@
+import json
+import math
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Tuple, TypedDict
+
+# Default template, relative to the raw clips folder
+DEFAULT_TEMPLATE_NAME = "start.mp4"
+
+# Output format of the template_video, every clip's only format by default
+REEL_FORMAT = "reel"
+
+_NUMBER = r"\d+(?:\.\d+)?"
+_UNITS_RE = re.compile(rf"(?:(?P<h>{_NUMBER})h)?(?:(?P<m>{_NUMBER})m)?(?:(?P<s>{_NUMBER})s?)?")
+_CLOCK_PART_RE = re.compile(_NUMBER)
+
+
+class ClipConfig(TypedDict, total=False):
+    """One entry of ``clips_config``. Times are seconds once loaded."""
+    name: str
+    start_time: float
+    end_time: float
+    title: str
+    description: str
+    tags: List[str]
+    category_id: str
+    privacy_status: str
+    formats: List[str]
+
+
+class VideoConfig(TypedDict, total=False):
+    """
+    A video folder's config.json.
+
+    Optional settings fall back to the defaults of the code using them:
+
+    - ``cut_mode``: how split_video cuts clips, "reencode" (default),
+      "copy" (fast, starts on the keyframe before each clip) or "smart"
+      (stream-copies whole GOPs, re-encodes the edges).
+    - ``workers``: clips split_video cuts at once, each in its own process,
+      1 by default; raise it to the cores the machine can spare.
+    - ``compose_backend``: how clips are placed on the template,
+      "moviepy" (default), "ffmpeg" (one filtergraph), "layers" (numpy
+      layer compositor) or "stream" (pooled frame buffers).
+    """
+    main_video_path: str
+    output_folder: str
+    clips_config: List[ClipConfig]
+    template_video: str
+    final_folder: str
+    cut_mode: str
+    compose_backend: str
+    workers: int
+    thread_budget: int
+    segments: int
+    render_cache_max_mb: float
+    allow_overlaps: bool
+    profile: bool
+    pipeline: Dict
+    upload: Dict
+    audio: Dict
+    suggest: Dict
+    formats: Dict[str, Dict]
+    encoding_profile: str
+    encoding_profiles: Dict[str, Dict]
+    template_cache_mb: float
+    memory_limit_mb: float
+
+
+# Expected JSON types of the optional top-level settings
+_SETTING_TYPES = {
+    "template_video": str,
+    "final_folder": str,
+    "cut_mode": str,
+    "compose_backend": str,
+    "workers": int,
+    "thread_budget": int,
+    "segments": int,
+    "render_cache_max_mb": (int, float),
+    "allow_overlaps": bool,
+    "profile": bool,
+    "pipeline": dict,
+    "upload": dict,
+    "audio": dict,
+    "suggest": dict,
+    "formats": dict,
+    # A profile name for every stage, or one per stage
+    "encoding_profile": (str, dict),
+    "encoding_profiles": dict,
+    "template_cache_mb": (int, float),
+    "memory_limit_mb": (int, float),
+}
+
+
+class ConfigError(ValueError):
+    """A config that can't be rendered, listing every problem found."""
+
+    def __init__(self, problems: List[str]):
+        self.problems = problems
+        super().__init__(f"{len(problems)} config problem(s): " + "; ".join(problems))
+
+
+def parse_timestamp(value) -> float:
+    """
+    Seconds from a clip timestamp.
+
+    Accepts numbers and strings in seconds (``212``, ``"212.5"``), clock
+    notation (``"3:32"``, ``"1:03:32.5"``) or units (``"3m32s"``, ``"1h2m"``).
+
+    Raises:
+    ValueError: If the value isn't a non-negative timestamp.
+    """
+    if isinstance(value, bool):
+        raise ValueError(f"not a timestamp: {value!r}")
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    elif isinstance(value, str):
+        text = value.strip().lower()
+        if ":" in text:
+            parts = text.split(":")
+            if len(parts) > 3 or not all(_CLOCK_PART_RE.fullmatch(part) for part in parts):
+                raise ValueError(f"not a timestamp: {value!r}")
+            seconds = 0.0
+            for part in parts:
+                seconds = seconds * 60 + float(part)
+        else:
+            match = _UNITS_RE.fullmatch(text)
+            if not text or match is None:
+                raise ValueError(f"not a timestamp: {value!r}")
+            seconds = sum(float(match[unit] or 0) * scale for unit, scale in (("h", 3600), ("m", 60), ("s", 1)))
+    else:
+        raise ValueError(f"not a timestamp: {value!r}")
+    if seconds < 0 or not math.isfinite(seconds):
+        raise ValueError(f"not a timestamp: {value!r}")
+    return seconds
+
+
+def format_timestamp(seconds: float) -> str:
+    """Clock notation of seconds to the hundredth, ``"3:32.44"`` or ``"1:03:32"``, that parse_timestamp reads back."""
+    hundredths = round(seconds * 100)
+    minutes, hundredths = divmod(hundredths, 6000)
+    hours, minutes = divmod(minutes, 60)
+    text = f"{hours}:{minutes:02d}:{hundredths // 100:02d}" if hours else f"{minutes}:{hundredths // 100:02d}"
+    fraction = f"{hundredths % 100:02d}".rstrip("0")
+    return f"{text}.{fraction}" if fraction else text
+
+
+def parse_range(value: str) -> Tuple[float, float]:
+    """Start and end seconds of a range like ``"3m32s-5m10s"`` or ``"3:32-5:10"``."""
+    start, separator, end = value.partition("-")
+    if not separator:
+        raise ValueError(f"not a range: {value!r}")
+    return parse_timestamp(start), parse_timestamp(end)
+
+
+def normalize_clip(clip_config: Dict) -> ClipConfig:
+    """
+    A clip with its times in seconds.
+
+    ``"range": "3m32s-5m10s"`` may stand in for start_time and end_time.
+    Times that don't parse are kept as they are for validate_config to report.
+    """
+    clip = dict(clip_config)
+    if "range" in clip and "start_time" not in clip and "end_time" not in clip:
+        try:
+            clip["start_time"], clip["end_time"] = parse_range(str(clip["range"]))
+        except ValueError:
+            pass
+    for key in ("start_time", "end_time"):
+        try:
+            clip[key] = parse_timestamp(clip[key])
+        except (KeyError, ValueError):
+            pass
+    return clip
+
+
+def load_config(file_path: str) -> VideoConfig:
+    """
+    Load a video folder's config.json with clip times parsed to seconds.
+
+    Raises:
+    ConfigError: If the file is missing or isn't a JSON object.
+    """
+    try:
+        with open(file_path, "r") as file:
+            config = json.load(file)
+    except FileNotFoundError:
+        raise ConfigError([f"Config file '{file_path}' not found"])
+    except json.JSONDecodeError as e:
+        raise ConfigError([f"Invalid JSON in '{file_path}': {e}"])
+    if not isinstance(config, dict):
+        raise ConfigError([f"'{file_path}' must hold a JSON object"])
+
+    clips = config.get("clips_config")
+    if isinstance(clips, list):
+        config["clips_config"] = [normalize_clip(clip) if isinstance(clip, dict) else clip for clip in clips]
+    return config
+
+
+def clip_index(config: VideoConfig) -> Dict[str, ClipConfig]:
+    """Clips by name."""
+    return {clip["name"]: clip for clip in config.get("clips_config", []) if isinstance(clip, dict) and "name" in clip}
+
+
+def template_path_for(config: VideoConfig) -> str:
+    """Background template of the compose stage."""
+    return config.get("template_video", os.path.join(config.get("output_folder", ""), DEFAULT_TEMPLATE_NAME))
+
+
+def clip_formats(config: VideoConfig, clip: ClipConfig) -> Dict[str, Dict]:
+    """
+    Output formats of a clip by name, each with its ``template_video`` and layout.
+
+    A clip lists its formats as ``"formats": ["reel", "square"]``, naming
+    entries of the config's ``formats`` section like
+    ``{"square": {"template_video": ..., "overlay_scale": 0.9, "title_y": 0.06}}``.
+    ``reel`` is the config's own template_video and the default.
+    """
+    definitions = config.get("formats") or {}
+    formats = {}
+    for name in clip.get("formats") or [REEL_FORMAT]:
+        spec = dict(definitions.get(name, {}))
+        if name == REEL_FORMAT:
+            spec.setdefault("template_video", template_path_for(config))
+        formats[name] = spec
+    return formats
+
+
+def _check_formats(config: VideoConfig) -> List[str]:
+    problems = []
+    for name, spec in (config.get("formats") or {}).items():
+        if not isinstance(spec, dict):
+            problems.append(f"Format '{name}' must be an object")
+            continue
+        template = spec.get("template_video")
+        if template is None and name == REEL_FORMAT:
+            template = template_path_for(config)
+        if not isinstance(template, str):
+            problems.append(f"Format '{name}': needs a template_video")
+        elif not os.path.isfile(template):
+            problems.append(f"Format '{name}': template video not found: {template}")
+        scale = spec.get("overlay_scale", 1.0)
+        if isinstance(scale, bool) or not isinstance(scale, (int, float)) or not 0 < scale <= 1:
+            problems.append(f"Format '{name}': overlay_scale must be a number in (0, 1]")
+        title_y = spec.get("title_y", 0.0)
+        if isinstance(title_y, bool) or not isinstance(title_y, (int, float)) or not 0 <= title_y < 1:
+            problems.append(f"Format '{name}': title_y must be a number in [0, 1)")
+    return problems
+
+
+def _is_seconds(value) -> bool:
+    return isinstance(value, float)
+
+
+def _check_clips(config: VideoConfig, stages: Iterable[str], duration: Optional[float], tolerance: float) -> List[str]:
+    problems = []
+    clips = config.get("clips_config")
+    if not isinstance(clips, list) or not clips:
+        return ["clips_config must be a non-empty list of clips"]
+
+    seen = set()
+    ranges = []
+    for idx, clip in enumerate(clips):
+        if not isinstance(clip, dict):
+            problems.append(f"Clip #{idx + 1} must be an object")
+            continue
+        name = clip.get("name")
+        label = f"Clip '{name}'" if name else f"Clip #{idx + 1}"
+        if not isinstance(name, str) or not name:
+            problems.append(f"{label}: needs a name")
+        elif name in seen:
+            problems.append(f"{label}: name used more than once")
+        seen.add(name)
+        if ("compose" in stages or "upload" in stages) and not clip.get("title"):
+            problems.append(f"{label}: needs a title")
+        if "compose" in stages and "formats" in clip:
+            formats = clip["formats"]
+            known = set(config.get("formats") or {}) | {REEL_FORMAT}
+            if not isinstance(formats, list) or not formats or not all(isinstance(name, str) for name in formats):
+                problems.append(f"{label}: formats must be a non-empty list of format names")
+            elif set(formats) - known:
+                problems.append(f"{label}: unknown format(s) {', '.join(sorted(set(formats) - known))}")
+        if "split" not in stages:
+            continue
+
+        start_time, end_time = clip.get("start_time"), clip.get("end_time")
+        bad_times = [
+            f"{key} {clip[key]!r} is not a timestamp" if key in clip else f"no {key}"
+            for key, value in (("start_time", start_time), ("end_time", end_time)) if not _is_seconds(value)
+        ]
+        if bad_times:
+            problems.append(f"{label}: " + ", ".join(bad_times))
+            continue
+        if end_time <= start_time:
+            problems.append(f"{label}: ends at {end_time:g}s, not after its start at {start_time:g}s")
+            continue
+        if duration is not None and end_time > duration + tolerance:
+            problems.append(f"{label}: ends at {end_time:g}s, after the end of the video at {duration:.2f}s")
+        ranges.append((start_time, end_time, label))
+
+    if not config.get("allow_overlaps"):
+        ranges.sort()
+        for (_, end_time, label), (next_start, _, next_label) in zip(ranges, ranges[1:]):
+            if end_time > next_start + tolerance:
+                problems.append(
+                    f"{label} overlaps {next_label} ({next_start:g}s-{end_time:g}s), "
+                    "set allow_overlaps to cut both"
+                )
+    return problems
+
+
+def validate_config(config: VideoConfig, stages: Iterable[str] = ("split", "compose")) -> List[str]:
+    """
+    Everything that would make ``stages`` fail on this config, before any
+    decode or encode starts.
+
+    Checks the settings' types and encoding profiles, clip names, times
+    and titles, reversed or overlapping ranges, ranges past the source's
+    probed duration and, for the compose stage, the templates, output
+    formats and title font.
+    Probing goes through the media index, so repeat checks are instant.
+
+    Returns:
+    List[str]: Problems, empty when the config is good to run.
+    """
+    from encoding_profiles import encoding_problems
+    from mobile_video_generator import COMPOSE_BACKENDS, TITLE_FONT_PATH
+    from smart_cut import CUT_MODES
+
+    stages = tuple(stages)
+    problems = []
+    for key, expected in _SETTING_TYPES.items():
+        value = config.get(key)
+        if value is not None and (not isinstance(value, expected) or (expected is int and isinstance(value, bool))):
+            problems.append(f"{key} has the wrong type ({type(value).__name__})")
+    if config.get("cut_mode", "reencode") not in CUT_MODES:
+        problems.append(f"cut_mode must be one of {', '.join(CUT_MODES)}")
+    if config.get("compose_backend", "moviepy") not in COMPOSE_BACKENDS:
+        problems.append(f"compose_backend must be one of {', '.join(COMPOSE_BACKENDS)}")
+    problems += encoding_problems(config)
+
+    duration, tolerance = None, 0.02
+    if "split" in stages:
+        main_video_path = config.get("main_video_path")
+        if not config.get("output_folder"):
+            problems.append("output_folder is missing")
+        if not main_video_path:
+            problems.append("main_video_path is missing")
+        elif not os.path.isfile(main_video_path):
+            problems.append(f"Source video not found: {main_video_path}")
+        else:
+            from media_probe import media_infos
+
+            infos = media_infos(main_video_path)
+            duration = infos.get("duration") or 0.0
+            # Half a frame of slack for ends typed as the source's rounded duration
+            tolerance = 0.5 / (infos.get("video_fps") or 25.0)
+
+    if "compose" in stages:
+        template_path = template_path_for(config)
+        clips = config.get("clips_config") if isinstance(config.get("clips_config"), list) else []
+        uses_reel = not clips or any(
+            not isinstance(clip, dict) or REEL_FORMAT in (clip.get("formats") or [REEL_FORMAT]) for clip in clips
+        )
+        if uses_reel and not os.path.isfile(template_path):
+            problems.append(f"Template video not found: {template_path}")
+        if not os.path.isfile(TITLE_FONT_PATH):
+            problems.append(f"Title font not found: {TITLE_FONT_PATH}")
+        if isinstance(config.get("formats"), dict):
+            problems += _check_formats(config)
+
+    return problems + _check_clips(config, stages, duration, tolerance)
+
+
+def require_valid(config: VideoConfig, stages: Iterable[str] = ("split", "compose")) -> None:
+    """
+    Raise if ``stages`` can't succeed on this config, see validate_config.
+
+    Raises:
+    ConfigError: Listing every problem found.
+    """
+    problems = validate_config(config, stages)
+    if problems:
+        raise ConfigError(problems)
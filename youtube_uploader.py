@@ -1,48 +1,118 @@
 import os
+import sys
+import threading
 import google_auth_httplib2
 import google_auth_oauthlib
+import google.oauth2.credentials
+import google.auth.exceptions
+import google.auth.transport.requests
 import googleapiclient.discovery
 import googleapiclient.errors
 import googleapiclient.http
 
 SCOPES = ["https://www.googleapis.com/auth/youtube.upload"]
-TOKEN_FILE = 'token.json'
+# Credentials live in the project directory unless VIDEO_AUTOMATION_CONFIG_DIR points elsewhere,
+# so they are found whatever directory the pipeline is started from
+CONFIG_DIR_ENV = "VIDEO_AUTOMATION_CONFIG_DIR"
+CONFIG_DIR = os.environ.get(CONFIG_DIR_ENV) or os.path.dirname(os.path.abspath(__file__))
+TOKEN_FILE = os.path.join(CONFIG_DIR, "token.json")
+CLIENT_SECRETS_FILE = os.path.join(CONFIG_DIR, "client.json")
+
+# One set of credentials and one API client per process
+_credentials = None
+_youtube = None
+_auth_lock = threading.Lock()
+
+
+class AuthorizationRequired(Exception):
+    """No usable token and no terminal to run the browser OAuth flow from."""
+
+
+def _save_credentials(credentials, token_file=TOKEN_FILE):
+    # The refresh token grants upload access, keep it private to the user
+    fd = os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as file:
+        file.write(credentials.to_json())
+
+def load_credentials(token_file=TOKEN_FILE, client_secrets_file=CLIENT_SECRETS_FILE, interactive=None):
+    """
+    Credentials from the token store, refreshed when expired.
+
+    The browser OAuth flow only runs when there is no usable token, e.g. on
+    the very first run or after access was revoked, and only when
+    ``interactive`` (by default, when stdin is a terminal). Otherwise
+    AuthorizationRequired is raised instead of waiting for a login nobody
+    can complete.
+    """
+    credentials = None
+    if os.path.exists(token_file):
+        credentials = google.oauth2.credentials.Credentials.from_authorized_user_file(token_file, SCOPES)
+
+    if credentials is not None and not credentials.valid and credentials.refresh_token:
+        try:
+            credentials.refresh(google.auth.transport.requests.Request())
+        except google.auth.exceptions.RefreshError:
+            # Revoked or expired refresh token, log in again
+            credentials = None
+
+    if credentials is None or not credentials.valid:
+        if interactive is None:
+            interactive = sys.stdin is not None and sys.stdin.isatty()
+        if not interactive:
+            raise AuthorizationRequired(
+                f"No valid YouTube token in {token_file}. Run the upload once from a terminal to log in "
+                f"with {client_secrets_file}, or set {CONFIG_DIR_ENV} to the directory holding token.json."
+            )
+        os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+        flow = google_auth_oauthlib.flow.InstalledAppFlow.from_client_secrets_file(
+            client_secrets_file, SCOPES)
+        credentials = flow.run_local_server()
+
+    _save_credentials(credentials, token_file)
+    return credentials
+
+def authenticate():
+    """The process-wide credentials, loaded on first use."""
+    global _credentials
+    with _auth_lock:
+        if _credentials is None:
+            _credentials = load_credentials()
+        return _credentials
 
 def authenticate_youtube():
-    os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
-
-    if os.path.exists(TOKEN_FILE):
-        os.remove(TOKEN_FILE)
-
-    # Load client secrets file, put the path of your file
-    client_secrets_file = "client.json"
-
-    
-    flow = google_auth_oauthlib.flow.InstalledAppFlow.from_client_secrets_file(
-        client_secrets_file, SCOPES)
-    credentials = flow.run_local_server()
-
-    youtube = googleapiclient.discovery.build(
-        "youtube", "v3", credentials=credentials)
-
-    return youtube
-
-def upload_video(youtube):
+    """
+    The process-wide YouTube API client.
+
+    Built from the discovery document bundled with google-api-python-client,
+    so startup doesn't fetch it over the network.
+    """
+    global _youtube
+    credentials = authenticate()
+    with _auth_lock:
+        if _youtube is None:
+            _youtube = googleapiclient.discovery.build(
+                "youtube", "v3", credentials=credentials, static_discovery=True, cache_discovery=False)
+        return _youtube
+
+def upload_video(
+    youtube,
+    media_file="./final/test.mp4",
+    title="Uploaded from Python",
+    description="This is the most awsome description ever",
+    tags=("test", "python", "api")
+):
     request_body = {
         "snippet": {
             "categoryId": "22",
-            "title": "Uploaded from Python",
-            "description": "This is the most awsome description ever",
-            "tags": ["test","python", "api" ]
+            "title": title,
+            "description": description,
+            "tags": list(tags)
         },
         "status":{
             "privacyStatus": "private"
         }
     }
 
-    # put the path of the video that you want to upload
-    media_file = "./final/test.mp4"
-
     request = youtube.videos().insert(
         part="snippet,status",
         body=request_body,
@@ -56,7 +126,8 @@ def upload_video(youtube):
         if status:
             print(f"Upload {int(status.progress()*100)}%")
 
-        print(f"Video uploaded with ID: {response['id']}")
+    print(f"Video uploaded with ID: {response['id']}")
+    return response['id']
 
 if __name__ == "__main__":
     youtube = authenticate_youtube()